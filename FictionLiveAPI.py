@@ -1,6 +1,8 @@
 import requests
 from bs4 import BeautifulSoup
 import itertools
+import collections
+import copy
 import simpleaudio as sa
 import sys
 import logging
@@ -12,12 +14,33 @@ import string
 from datetime import datetime
 import os
 import re
+import argparse
+import contextlib
+import threading
+import bisect
+import hashlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from html.entities import html5 as html5_entities
 from colorama import Fore, Style
+import FictionLiveHTTP
+import FictionLiveEpub
+import FictionLiveImages
+import FictionLiveMetrics
+import FictionLiveTransforms
 
 session = requests.Session()
-achievements = []
+achievements = {} # achievement index of the story being downloaded, set by use_book_info before the download threads start and only read by them; see build_achievement_index
+DEFAULT_JOBS = 4 # number of chapter downloads allowed in flight at once
+RANGE_REQUEST_BYTES = 2 * 1024 * 1024 # rough cap on the response to a coalesced chapter-range request (see chapters_per_request)
+BYTES_PER_WORD = 12 # chunk JSON per word of story text, counting the markup and the votes of polls
+MAX_CHAPTERS_PER_REQUEST = 64 # keeps enough requests in a short story to spread them over the download threads
+CHAPTERS_AHEAD_PER_JOB = 4 # how many chapters per download thread may be downloaded before the one being added to the book (see read_ahead)
+PARSER_BACKEND = "lxml" # make_soup backend: "lxml" (html5lib fallback for malformed chunks) or "html5lib"
 ALERT_SOUND_PATH = r"Sound\alert.wav"
 SUCCESS_SOUND_PATH = r"Sound\success.wav"
+ROUTE_URL = "https://fiction.live/api/anonkun/route/{route_id}/chapters"
+# Matches a story URL in any of the forms fiction.live links to it; group 2 is the story id
+STORY_URL_PATTERN = r"^https://fiction.live/stories/([-A-Za-z0-9]+)?/([A-Za-z0-9]{17})(/[-A-Za-z0-9]+/[A-Za-z0-9]+)?"
 
 def process_urls(urls):
     """
@@ -34,15 +57,12 @@ def process_urls(urls):
         >>> process_urls(urls)
         [{'story': 'https://fiction.live/stories//1234567890abcdef', 'meta': 'https://fiction.live/api/node/1234567890abcdef'}, ...]
     """
-    # Regular expression pattern to match valid URLs
-    pattern = r"^https://fiction.live/stories/([-A-Za-z0-9]+)?/([A-Za-z0-9]{17})(/[-A-Za-z0-9]+/[A-Za-z0-9]+)?"
-
     valid_urls = []
     invalid_urls = []
 
     # Loop through each URL and check if it is valid
     for url in urls:
-        if url_match := re.match(pattern, url): # If it is valid, ensure proper formatting and then append
+        if url_match := re.match(STORY_URL_PATTERN, url): # If it is valid, ensure proper formatting and then append
             valid_urls.append(
                 {
                     'story': f"https://fiction.live/stories//{url_match[2]}",
@@ -62,6 +82,7 @@ def process_urls(urls):
 
     return valid_urls
 
+@FictionLiveMetrics.traced("get_book_info")
 def get_book_info(metadata_url):
     """
     Retrieves the metadata of a story from the provided URL.
@@ -77,20 +98,30 @@ def get_book_info(metadata_url):
         >>> get_book_info(metadata_url)
         {'title': 'Story Title', 'author': 'Author Name', ...}
     """
-
+    FictionLiveMetrics.annotate(story=metadata_url.rstrip('/').rsplit('/', 1)[-1])
     if story_metadata := session.get(metadata_url).text:
         if story_metadata != "null" and "Cannot GET" not in story_metadata:
             story_metadata = json.loads(story_metadata)
-            # gonna need these later for adding details to achievement-granting links in the text
-            try:
-                achievements = story_metadata['achievements']['achievements']
-            except KeyError:
-                achievements = []
+            use_book_info(story_metadata)
             return story_metadata
     print(f"{Fore.RED}Error fetching story data at: ({metadata_url}){Style.RESET_ALL}")
     #play_sound(ALERT_SOUND_PATH)
     return None
 
+def use_book_info(story_metadata):
+    """
+    Makes a story the one being downloaded, as get_book_info does once its metadata is in; call it directly
+    with metadata fetched some other way (e.g. by FictionLiveWatch). It must be called before the story's
+    download threads start, as they share the achievement index it builds.
+
+    Args:
+        story_metadata (dict): The story metadata.
+    """
+    # gonna need these later for adding details to achievement-granting links in the text
+    global achievements
+    achievements = build_achievement_index(story_metadata)
+    FictionLiveMetrics.annotate(title=story_metadata.get('t'))
+
 def get_book_map(book_data):
     """
     Retrieves the chapters, appendices, and routes from the provided book data.
@@ -140,7 +171,7 @@ def get_book_map(book_data):
         Returns:
             None
         """
-        chapter_url = f"https://fiction.live/api/anonkun/route/{route_id}/chapters"
+        chapter_url = ROUTE_URL.format(route_id=route_id)
         routes_list.append({'title': title, 'url': chapter_url})
 
     def pair(iterable):
@@ -213,12 +244,160 @@ def parse_timestamp(timestamp):
 
     return datetime.fromtimestamp(timestamp / 1000.0, None)
 
-def make_soup(data):
+## elements that never have an end tag
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'}
+## elements that implicitly close an open <p> (which html5lib and lxml repair differently)
+P_CLOSING_ELEMENTS = {
+    'address', 'article', 'aside', 'blockquote', 'center', 'details', 'dialog', 'dir', 'div', 'dl', 'dd', 'dt', 'fieldset',
+    'figcaption', 'figure', 'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hgroup', 'hr', 'li', 'listing',
+    'main', 'menu', 'nav', 'ol', 'p', 'pre', 'section', 'summary', 'table', 'ul',
+}
+## the only elements a block element may be opened inside of without one of the parsers closing something first
+BLOCK_CONTAINERS = {
+    'address', 'article', 'aside', 'blockquote', 'center', 'details', 'dialog', 'div', 'fieldset', 'figure', 'footer', 'header',
+    'main', 'nav', 'section', 'ul', 'ol', 'li', 'dl', 'dd',
+}
+## list items and the only elements they may appear directly inside of (and vice versa)
+LIST_ITEM_PARENTS = {'li': {'ul', 'ol'}, 'dd': {'dl'}, 'dt': {'dl'}}
+## elements the html5 tree builder treats specially (implied children, raw text, foster parenting, foreign content)
+SPECIAL_ELEMENTS = {
+    'html', 'head', 'body', 'title', 'script', 'style', 'textarea', 'select', 'option', 'optgroup', 'frameset', 'frame',
+    'svg', 'math', 'template', 'iframe', 'plaintext', 'xmp', 'noembed', 'noframes', 'image', 'isindex', 'button', 'nobr',
+    'table', 'caption', 'colgroup', 'col', 'tbody', 'thead', 'tfoot', 'tr', 'td', 'th', 'ruby', 'rb', 'rp', 'rt', 'rtc',
+    'form', 'base', 'link', 'meta', 'marquee', 'object', 'applet', 'pre', 'listing',
+}
+MARKUP_PATTERN = re.compile(
+    r"<!--.*?-->"                                                                          # comment
+    r"|<(/?)([A-Za-z][A-Za-z0-9_:-]*)"                                                     # tag name
+    r"((?:\s+[^\s\"'=<>/`]+(?:\s*=\s*(?:\"[^\"]*\"|'[^']*'|[^\s\"'=<>`]+))?)*)\s*(/?)>"  # attributes
+    r"|<[/!?A-Za-z]"                                                                       # anything else that looks like markup
+    r"|&(#[0-9]+|#[xX][0-9a-fA-F]+|[A-Za-z][A-Za-z0-9]*)(;?)",                             # character reference
+    re.DOTALL,
+)
+
+def is_well_formed(data):
+    """
+    Checks whether an HTML fragment is simple and well-formed enough that every HTML parser builds the same tree from it.
+
+    Such fragments can skip html5lib's error recovery, since there is nothing to recover from. A fragment passes if all
+    of its tags are balanced and properly nested, it uses no elements with implicit parsing rules (tables, forms, raw text, ...),
+    block elements only open inside other plain block containers, lists only hold list items, links aren't nested, and every character reference is complete and unambiguous.
+
+    Args:
+        data (str): The HTML fragment.
+
+    Returns:
+        bool: True if the fragment is well-formed.
+
+    Examples:
+        >>> is_well_formed("<p>Chapter <b>content</b>&nbsp;here.</p>")
+        True
+        >>> is_well_formed("<p><b>Chapter</p> content")
+        False
+    """
+    if any(char in data for char in "\0\r\t\f\v"):
+        return False # libxml2 normalizes some whitespace-only text differently
+    open_tags = []
+    position = 0
+    for markup in MARKUP_PATTERN.finditer(data):
+        text = data[position:markup.start()]
+        if position == 0:
+            if text.strip():
+                return False # libxml2 may wrap leading bare text in a <p>
+            if markup[0].startswith("<!--"):
+                return False # a leading comment lands outside <html>
+        elif len(text) > 1 and not text.strip():
+            return False # libxml2 collapses runs of whitespace between tags
+        position = markup.end()
+        if markup[0].startswith("<!--"):
+            continue
+        if markup[0].startswith("&"):
+            reference, semicolon = markup[5], markup[6]
+            if not semicolon:
+                return False
+            if reference.startswith("#"):
+                codepoint = int(reference[2:], 16) if reference[1] in "xX" else int(reference[1:])
+                if codepoint == 0 or 0x80 <= codepoint <= 0x9F or 0xD800 <= codepoint <= 0xDFFF or codepoint > 0x10FFFF:
+                    return False
+            elif reference + ";" not in html5_entities:
+                return False
+            continue
+        if markup[2] is None:
+            return False # a '<' that starts something other than a plain tag or comment
+        closing, name, self_closing = markup[1], markup[2].lower(), markup[4]
+        if name in SPECIAL_ELEMENTS:
+            return False
+        if not closing:
+            if name in P_CLOSING_ELEMENTS and not BLOCK_CONTAINERS.issuperset(open_tags):
+                return False # lxml and html5lib close different elements to make room for it
+            parent = open_tags[-1] if open_tags else None
+            if (name in LIST_ITEM_PARENTS) != (parent in ('ul', 'ol', 'dl')) or parent not in LIST_ITEM_PARENTS.get(name, {parent}):
+                return False # list items outside their list, or anything else directly inside a list
+            if name == 'a' and 'a' in open_tags:
+                return False
+        if name in VOID_ELEMENTS:
+            if closing:
+                return False
+            continue
+        if self_closing:
+            return False # <span/> is an open tag to HTML parsers
+        if closing:
+            if not open_tags or open_tags.pop() != name:
+                return False
+            continue
+        open_tags.append(name)
+    if data[position:].strip() or data[position:] != data[position:].rstrip():
+        return False # trailing text or whitespace after the last tag is normalized differently
+    return not open_tags
+
+def is_balanced(data):
+    """
+    Checks whether the tags of an HTML fragment all close in the order they opened, so html.parser builds the
+    same tree from it on its own as inside a larger document.
+
+    Args:
+        data (str): The HTML fragment.
+
+    Returns:
+        bool: True if the fragment is balanced.
+
+    Examples:
+        >>> is_balanced("<table><tr><td>Fight</td></tr></table>")
+        True
+        >>> is_balanced("<td>Fight</div>")
+        False
+    """
+    open_tags = []
+    for markup in MARKUP_PATTERN.finditer(data):
+        if markup[0].startswith(("<!--", "&")):
+            continue
+        if markup[2] is None:
+            return False # a '<' that starts something other than a plain tag or comment
+        closing, name, self_closing = markup[1], markup[2].lower(), markup[4]
+        if name in ('script', 'style'):
+            return False # raw text, which html.parser reads up to its end tag
+        if name in VOID_ELEMENTS or self_closing:
+            if closing:
+                return False
+            continue
+        if closing:
+            if not open_tags or open_tags.pop() != name:
+                return False
+            continue
+        open_tags.append(name)
+    return not open_tags
+
+def make_soup(data, backend=None):
     """
     Creates a BeautifulSoup object from the provided HTML data.
 
+    With the "lxml" backend, fragments that pass is_well_formed are parsed once with lxml and given the same
+    <html><head></head><body> structure html5lib would have built. Anything else, and everything with the
+    "html5lib" backend, goes through the slower but more forgiving double html5lib parse.
+
     Args:
         data (str): The HTML data to be parsed.
+        backend (str, optional): "lxml" or "html5lib". Defaults to PARSER_BACKEND.
 
     Returns:
         BeautifulSoup: The BeautifulSoup object representing the parsed HTML.
@@ -228,6 +407,20 @@ def make_soup(data):
         >>> make_soup(data)
         <BeautifulSoup object at 0x...>
     """
+    return parse_html(data, backend)[0]
+
+def parse_html(data, backend=None):
+    """
+    Parses an HTML fragment like make_soup does, also telling which parser built the tree.
+
+    Args:
+        data (str): The HTML data to be parsed.
+        backend (str, optional): "lxml" or "html5lib". Defaults to PARSER_BACKEND.
+
+    Returns:
+        tuple: The BeautifulSoup object, and whether html5lib built it (because the fragment isn't
+               well-formed, or because that is the backend) rather than lxml.
+    """
 
     ## html5lib handles <noscript> oddly.  See:
     ## https://bugs.launchpad.net/beautifulsoup/+bug/1277464 This
@@ -237,15 +430,21 @@ def make_soup(data):
     ## re.sub() in simple test
     data = data.replace("<noscript","<hide_noscript").replace("</noscript","</hide_noscript")
 
-    ## soup and re-soup because BS4/html5lib is more forgiving of
-    ## incorrectly nested tags that way.
-    soup = BeautifulSoup(data,'html5lib')
-    soup = BeautifulSoup(unicode(soup),'html5lib')
+    repaired = not ((backend or PARSER_BACKEND) == "lxml" and data.strip() and is_well_formed(data))
+    if not repaired:
+        soup = BeautifulSoup(data,'lxml')
+        if soup.html.head is None: # html5lib always adds an empty head
+            soup.html.insert(0, soup.new_tag('head'))
+    else:
+        ## soup and re-soup because BS4/html5lib is more forgiving of
+        ## incorrectly nested tags that way.
+        soup = BeautifulSoup(data,'html5lib')
+        soup = BeautifulSoup(unicode(soup),'html5lib')
 
     for ns in soup.find_all('hide_noscript'):
         ns.name = 'noscript'
 
-    return soup
+    return soup, repaired
 
 def format_chapter(chunk):
     """
@@ -265,11 +464,22 @@ def format_chapter(chunk):
         "<p>Chapter content</p>"
     """
 
-    soup = make_soup(chunk['b'] if 'b' in chunk else "")
-    soup = add_spoiler_legends(soup)
-    soup = append_achievments(soup)
+    return str(format_chapter_tree(chunk)[0])
+
+def format_chapter_tree(chunk):
+    """
+    Does the work of format_chapter, returning the tree instead of its text.
 
-    return str(soup)
+    Args:
+        chunk (dict): The chunk containing the chapter body text.
+
+    Returns:
+        tuple: The BeautifulSoup object, and whether html5lib built it (see parse_html).
+    """
+    soup, repaired = parse_html(chunk['b'] if 'b' in chunk else "")
+    soup = FictionLiveTransforms.apply_transforms(soup, [transform() for transform in CHUNK_TRANSFORMS])
+
+    return soup, repaired
 
 def add_spoiler_legends(soup):
     """
@@ -286,13 +496,26 @@ def add_spoiler_legends(soup):
         >>> add_spoiler_legends(soup)
         <BeautifulSoup object at 0x...>
     """
-    spoilers = soup.find_all('a', class_="tydai-spoiler")
-    for link_tag in spoilers:
-        link_tag.name = 'fieldset'
-        legend = soup.new_tag('legend')
-        legend.string = "Spoiler"
-        link_tag.insert(0, legend)
-    return soup
+    return FictionLiveTransforms.apply_transforms(soup, [SpoilerLegends()])
+
+def has_class(tag, class_name):
+    """Whether a tag has a class, like find_all's class_ matches it."""
+    classes = tag.get('class') or ()
+    return class_name in (classes.split() if isinstance(classes, str) else classes)
+
+class SpoilerLegends(FictionLiveTransforms.Transform):
+    """Turns spoiler links into fieldsets with a "Spoiler" legend."""
+    tags = {'a'}
+
+    def start(self, soup):
+        self.soup = soup
+
+    def enter(self, link_tag):
+        if has_class(link_tag, "tydai-spoiler"):
+            link_tag.name = 'fieldset'
+            legend = self.soup.new_tag('legend')
+            legend.string = "Spoiler"
+            link_tag.insert(0, legend)
 
 def fictionlive_normalize(string):
     """
@@ -317,6 +540,57 @@ def fictionlive_normalize(string):
 
     return string.lower().replace(" ", "-").translate({ord(x) : None for x in special_chars})
 
+ACHIEVEMENT_SOURCE = "<br />\n<fieldset><legend>&#x26A1; Achievement obtained!</legend>\n<h4>{}</h4>\n{}</fieldset>\n"
+ACHIEVEMENT_ERROR_SOURCE = "<br />\n<fieldset><legend>Error: Achievement not found.</legend>Couldn't find '{}'. Ask the story author to check if the achievment exists."
+
+def render_achievement(a_id, details=None):
+    """
+    Renders the end-of-chunk announcement for an achievement, or the error block for an achievement the story doesn't have.
+
+    Args:
+        a_id (str): The normalized achievement id.
+        details (dict, optional): The achievement's entry in the story metadata, with an optional title 't' and description 'd'.
+                                  Defaults to None, for an achievement that wasn't found.
+
+    Returns:
+        Tag: The parsed announcement, ready to be copied into chunks.
+
+    Examples:
+        >>> render_achievement("first-blood", {'t': 'First Blood', 'd': 'Won a fight.'})
+        <html><head></head><body><br/>\n<fieldset><legend>⚡ Achievement obtained!</legend>...</body></html>
+    """
+    if details is None:
+        fragment = ACHIEVEMENT_ERROR_SOURCE.format(a_id.title())
+    else:
+        a_title = details['t'] if 't' in details else a_id.title()
+        a_text = details['d'] if 'd' in details else ""
+        fragment = ACHIEVEMENT_SOURCE.format(a_title, a_text)
+    return make_soup(fragment).html.extract()
+
+def build_achievement_index(story_metadata):
+    """
+    Builds the achievement index of a story: the pre-rendered announcement of each of its achievements, keyed by normalized id.
+
+    Args:
+        story_metadata (dict): The story metadata, as returned by get_book_info.
+
+    Returns:
+        dict: The rendered announcements (see render_achievement), keyed by normalized achievement id.
+
+    Examples:
+        >>> build_achievement_index({'achievements': {'achievements': {'First Blood': {'t': 'First Blood'}}}})
+        {'first-blood': <html><head></head><body>...</body></html>}
+    """
+    story_achievements = story_metadata.get('achievements') or {}
+    if isinstance(story_achievements, dict):
+        story_achievements = story_achievements.get('achievements') or {}
+    if not isinstance(story_achievements, dict): # optional, like most things in the api
+        return {}
+    return {
+        fictionlive_normalize(a_id): render_achievement(fictionlive_normalize(a_id), details if isinstance(details, dict) else {})
+        for a_id, details in story_achievements.items()
+    }
+
 def append_achievments(soup):
     """
     Appends achievements to the provided BeautifulSoup object.
@@ -332,14 +606,24 @@ def append_achievments(soup):
         >>> append_achievments(soup)
         <BeautifulSoup object at 0x...>
     """
+    return FictionLiveTransforms.apply_transforms(soup, [Achievements()])
+
+class Achievements(FictionLiveTransforms.Transform):
+    """Marks up achievement links and announces each achievement at the end of the chunk."""
     # achivements are present in the text as a kind of link, and you get the shiny popup by clicking them.
-    achievement_links = soup.find_all('a', class_="tydai-achievement")
+    tags = {'a'}
 
-    achieved_ids = []
-    for link_tag in achievement_links:
+    def start(self, soup):
+        self.soup = soup
+        self.achieved_ids = []
+        self.index = achievements # shared by the download threads, so it is never written to here
+
+    def enter(self, link_tag): # spoiler links are never inside achievement links, as links can't be nested
+        if not has_class(link_tag, "tydai-achievement"):
+            return
         # these are not only prepended by a unicode lightning-bolt, but also format clearly as a link
         # should use .u css selector -- part of output_css defaults? or just let replace_tags_with_spans do it?
-        new_u = soup.new_tag('u')
+        new_u = self.soup.new_tag('u')
         new_u.string = link_tag.text # copy out the link text into a new element
         # html entities for improved compatability with AZW3 conversion
         link_tag.string = "&#x26A1;" # then overwrite
@@ -349,26 +633,24 @@ def append_achievments(soup):
         a_id = link_tag['data-id']
         a_id = fictionlive_normalize(a_id)
 
-        achieved_ids.append(a_id)
-
-    if achieved_ids:
-        logger.debug("achievements (this chunk): " + ", ".join(achieved_ids))
+        self.achieved_ids.append(a_id)
 
-    # can't replicate the animated shiny announcement popup, so have an end-of-chunk announcement instead
-    # TODO: achievement images -- does anyone use them?
-    a_source = "<br />\n<fieldset><legend>&#x26A1; Achievement obtained!</legend>\n<h4>{}</h4>\n{}</fieldset>\n"
+    def finish(self, soup):
+        if self.achieved_ids:
+            logger.debug("achievements (this chunk): " + ", ".join(self.achieved_ids))
 
-    for a_id in achieved_ids:
-        if a_id in achievements:
-            a_title = achievements[a_id]['t']  if 't' in achievements[a_id] else a_id.title()
-            a_text = achievements[a_id]['d'] if 'd' in achievements[a_id] else ""
-            soup.append(make_soup(a_source.format(a_title, a_text)))
-        else:
-            a_title = a_id.title()
-            error = "<br />\n<fieldset><legend>Error: Achievement not found.</legend>Couldn't find '{}'. Ask the story author to check if the achievment exists."
-            soup.append(make_soup(error.format(a_title)))
+        # can't replicate the animated shiny announcement popup, so have an end-of-chunk announcement instead
+        # TODO: achievement images -- does anyone use them?
+        missing = {}
+        for a_id in self.achieved_ids:
+            if (announcement := self.index.get(a_id)) is None:
+                # render the error block once per chunk, a missing achievement tends to be linked more than once
+                if a_id not in missing:
+                    missing[a_id] = render_achievement(a_id)
+                announcement = missing[a_id]
+            soup.append(copy.copy(announcement)) # copying the parsed tree is much cheaper than parsing it again
 
-    return soup
+CHUNK_TRANSFORMS = [SpoilerLegends, Achievements] # applied to every chapter chunk, in one walk (see FictionLiveTransforms)
 
 def count_votes(chunk):
     """
@@ -387,39 +669,12 @@ def count_votes(chunk):
     """
     # optional.
     choices = chunk['choices'] if 'choices' in chunk else []
-
-    def counter(votes):
-        """
-        Counts the votes for each choice option.
-
-        Args:
-            votes (dict): A dictionary containing the votes, where the keys are voter IDs and the values are the chosen option(s).
-
-        Returns:
-            list: A list containing the count of votes for each choice option.
-
-        Examples:
-            >>> votes = {'uid1': [0, 1], 'uid2': 2, ...}
-            >>> counter(votes)
-            [1, 1, 1, 0, ...]
-        """
-        output = [0] * len(choices)
-        for vote in votes.values():
-            ## votes are either a single option-index or a list of option-indicies, depending on the choice type
-            if 'multiple' in chunk and chunk['multiple'] == False:
-                vote = [vote] # normalize to list
-            for v in vote:
-                # v should only be int, but there is at least one story where some unrelated string was returned,
-                #   so let's just ignore non-int values here
-                if not isinstance(v, int):
-                    continue
-                if 0 <= v <= len(choices):
-                    output[v] += 1
-        return output
+    ## votes are either a single option-index or a list of option-indicies, depending on the choice type
+    multiple = not ('multiple' in chunk and chunk['multiple'] == False)
 
     # I believe that verified is always a subset of all votes, but that's not enforced here
-    total_votes = counter(chunk['votes'] if 'votes' in chunk else {})
-    verified_votes = counter(chunk['userVotes'] if 'userVotes' in chunk else {})
+    total_votes = tally_votes(chunk['votes'] if 'votes' in chunk else {}, len(choices), multiple)
+    verified_votes = tally_votes(chunk['userVotes'] if 'userVotes' in chunk else {}, len(choices), multiple)
 
     # Choices can link to route chapters, where the index of the choice in list 'choices' is a key in the
     #   'routes' dict and the dict value is the route id.
@@ -430,8 +685,7 @@ def count_votes(chunk):
         for i, choice in enumerate(choices):
             choice_index = str(i)
             if choice_index in routes.keys():
-                route_chunkrange_url = "https://fiction.live/api/anonkun/route/{c_id}/chapters"
-                route_url = route_chunkrange_url.format(c_id=routes[choice_index])
+                route_url = ROUTE_URL.format(route_id=routes[choice_index])
                 choice_link = f"<a data-orighref='{route_url}' >{choice}</a>"
                 altered_choices.append(choice_link)
             else:
@@ -440,6 +694,64 @@ def count_votes(chunk):
 
     return (choices, verified_votes, total_votes)
 
+def flatten_votes(votes, multiple):
+    """
+    Flattens the votes of a poll into one list of the option indices voted for.
+
+    Args:
+        votes (dict): The votes, keyed by voter id: an option index each, or a list of them for a multiple-choice poll.
+        multiple (bool): Whether the poll is multiple-choice.
+
+    Returns:
+        list: The option indices, as they are in the votes (they may not all be ints).
+    """
+    if not multiple:
+        return list(votes.values())
+    try:
+        return list(itertools.chain.from_iterable(votes.values()))
+    except TypeError: # a lone index instead of a list; count it as a list of one
+        flat = []
+        for vote in votes.values():
+            if isinstance(vote, list):
+                flat.extend(vote)
+            else:
+                flat.append(vote)
+        return flat
+
+def tally_votes(votes, choice_count, multiple=True):
+    """
+    Counts the votes for each option of a poll.
+
+    The votes are flattened into one list and counted in a single pass with collections.Counter. Votes that
+    aren't ints or that don't index an option are ignored.
+
+    Args:
+        votes (dict): The votes, keyed by voter id (see flatten_votes).
+        choice_count (int): The number of options.
+        multiple (bool, optional): Whether the poll is multiple-choice. Defaults to True.
+
+    Returns:
+        list: The number of votes for each option.
+
+    Examples:
+        >>> tally_votes({'uid1': [0, 1], 'uid2': [1], 'uid3': [7]}, 2)
+        [1, 2]
+        >>> tally_votes({'uid1': 0, 'uid2': "Write-in"}, 2, multiple=False)
+        [1, 0]
+    """
+    flat = flatten_votes(votes, multiple)
+    try:
+        counts = collections.Counter(flat)
+    except TypeError: # unhashable junk, e.g. a list in a single-choice poll
+        counts = collections.Counter([v for v in flat if isinstance(v, int)])
+    output = [0] * choice_count
+    for v, count in counts.items():
+        # v should only be int, but there is at least one story where some unrelated string was returned,
+        #   so let's just ignore non-int values here (JSON never gives a float like 1.0 that Counter would merge with 1)
+        if isinstance(v, int) and 0 <= v < choice_count:
+            output[v] += count
+    return output
+
 def format_choice(chunk):
     """
     Formats the choice options and vote counts from the provided chunk.
@@ -482,25 +794,25 @@ def format_choice(chunk):
 
     vote_title = chunk['b'] if 'b' in chunk else "Choices"
 
-    output = ""
+    output = [] # joined at the end, rather than copying the growing string for every piece
     # start with the header
-    output += f"<h4><span>{vote_title} — <small>Voting {closed}"
-    output += f" — {num_voters}" + " voters</small></span></h4>\n"
+    output.append(f"<h4><span>{vote_title} — <small>Voting {closed}")
+    output.append(f" — {num_voters}" + " voters</small></span></h4>\n")
 
     # we've got everything needed to build the html for our vote table.
-    output += "<table class=\"voteblock\">\n"
+    output.append("<table class=\"voteblock\">\n")
 
     # Generate HTML for the winning options
     for choice_text, verified_votes, total_votes in winning_options:
-        output += "<tr class=\"choiceitem\"><td>" + str(choice_text) + "</td><td class=\"votecount\">"
+        output.append("<tr class=\"choiceitem\"><td>" + str(choice_text) + "</td><td class=\"votecount\">")
         if verified_votes > 0:
-            output += f"★{str(verified_votes)}/"
-        output += str(total_votes) + " </td></tr>\n"
+            output.append(f"★{str(verified_votes)}/")
+        output.append(str(total_votes) + " </td></tr>\n")
 
 
-    output += "</table>\n"
+    output.append("</table>\n")
 
-    return output
+    return "".join(output)
 
 def format_readerposts(chunk):
     """
@@ -530,9 +842,9 @@ def format_readerposts(chunk):
 
     posts_title = chunk['b'] if 'b' in chunk else "Choices"
 
-    output = ""
-    output += f"<h4><span>{posts_title} — <small> Posting {closed}"
-    output += f" — {num_votes}" + "</small></span></h4>\n"
+    output = []
+    output.append(f"<h4><span>{posts_title} — <small> Posting {closed}")
+    output.append(f" — {num_votes}" + "</small></span></h4>\n")
 
     ## so. a voter can roll with their post. these rolls are in a seperate dict, but have the **same uid**.
     ## they're then formatted with the roll above the writein for that user.
@@ -544,27 +856,33 @@ def format_readerposts(chunk):
         return ''
     
     for uid, roll in dice.items():
-        output += '<div class="choiceitem">'
+        output.append('<div class="choiceitem">')
         if roll: # optional. just because there's a list entry for it doesn't mean it has a value!
-            output += f'<div class="dice">{str(roll)}' + '</div>\n'
+            output.append(f'<div class="dice">{str(roll)}' + '</div>\n')
         if uid in posts and keepReaderPosts:
             if post := posts[uid]:
-                output += str(post)
+                output.append(str(post))
             del posts[uid] # it's handled here with the roll instead of later
-        output += '</div>'
+        output.append('</div>')
 
     if keepReaderPosts:
         for post in posts.values():
             if post:
-                output += f'<div class="choiceitem">{str(post)}' + '</div>\n'
+                output.append(f'<div class="choiceitem">{str(post)}' + '</div>\n')
 
-    return output
+    return "".join(output)
 
 def format_unknown(chunk):
     raise NotImplementedError(
         f"Unknown chunk type ({chunk}) in fiction.live story."
     )
 
+CHUNK_HANDLERS = {
+    "choice"     : format_choice,
+    "readerPost" : format_readerposts,
+    "chapter"    : format_chapter
+}
+
 def getChapterText(url):
     """
     Retrieves the text content of a chapter from the provided URL.
@@ -580,40 +898,125 @@ def getChapterText(url):
         >>> getChapterText(url)
         <BeautifulSoup object at 0x...>
     """
-    chunk_handler = {
-        "choice"     : format_choice,
-        "readerPost" : format_readerposts,
-        "chapter"    : format_chapter
-    }
+    with FictionLiveMetrics.span("getChapterText", url=url):
+        data = fetch_chunks(url)
 
-    response = session.get(url)
-    data = json.loads(response.text)
+        if data == []:
+            return ""
+        # and *now* we can assume there's at least one chunk in the data -- chapters can be totally empty.
+        return build_chapter(data)
 
-    if data == []:
-        return ""
-    # and *now* we can assume there's at least one chunk in the data -- chapters can be totally empty.
+def fetch_chunks(url):
+    """
+    Downloads the chunks of a chapter range or route.
 
+    Args:
+        url (str): The chapter-range or route URL.
+
+    Returns:
+        list: The chunks, as the API returns them.
+    """
+    with FictionLiveMetrics.span("fetch"):
+        response = session.get(url)
+        return json.loads(response.text)
+
+def is_skipped_chunk(data, chunk):
+    """Whether a chunk is an appendix mixed in with other things, which only shows up in its own appendix chapter."""
     # are we trying to read an appendix? check the first chunk to find out.
     getting_appendix = len(data) == 1 and 't' in data[0] and data[0]['t'].startswith("#special")
+    return not getting_appendix and 't' in chunk and chunk['t'].startswith("#special") # t = title = bookmark
+
+def build_chapter(data):
+    """
+    Builds the tree of a chapter from its chunks in a single pass.
+
+    Every chunk is wrapped in a <div>, followed by a newline. Chapter chunks are parsed once (see
+    format_chapter_tree) and their trees are moved straight into the chapter instead of being turned back
+    into text and parsed again; the HTML of the other handlers is parsed on its own, a chunk at a time. The
+    result is the same tree build_chapter_text makes by joining all the chunks' HTML and parsing it with
+    html.parser, which remains the fallback for a chapter with a chunk whose HTML isn't balanced (see
+    is_balanced), since that may reach into the markup around it.
+
+    Args:
+        data (list): The chunks of the chapter, as the chapter-range API returns them.
+
+    Returns:
+        BeautifulSoup: The chapter.
+    """
+    chapter = BeautifulSoup("", "html.parser")
+    parent = chapter
+    for chunk in data:
+        div = chapter.new_tag('div') # chapter chunks aren't always well-delimited in their contents
+        parent.append(div)
+        if is_skipped_chunk(data, chunk):
+            parent = div # its <div> is never closed, so the chunks after it end up inside it
+            continue
+
+        nt = chunk['nt'] # nt = node type
+        with FictionLiveMetrics.span(f"chunk.{nt}"):
+            if nt == "chapter":
+                soup, repaired = format_chapter_tree(chunk)
+                if repaired: # html5lib trees can hold names html.parser would read back differently
+                    soup = BeautifulSoup(str(soup), "html.parser")
+                nodes = list(soup.contents)
+            else:
+                html = CHUNK_HANDLERS.get(nt, format_unknown)(chunk)
+                if not is_balanced(html):
+                    logger.debug(f"Unbalanced {nt} chunk, parsing the chapter as a whole")
+                    return build_chapter_text(data)
+                nodes = parse_fragment(html)
+        FictionLiveMetrics.count('chunks', nt=nt)
+        div.extend(nodes)
+        parent.append("\n")
+    return chapter
+
+def parse_fragment(html):
+    """
+    Parses a balanced HTML fragment into the nodes html.parser would make of it.
+
+    Fragments simple enough for every parser to agree on (see is_well_formed) are parsed with the faster lxml.
+
+    Args:
+        html (str): The fragment.
+
+    Returns:
+        list: The top-level nodes.
+    """
+    if html and is_well_formed(html):
+        return list(BeautifulSoup(html, 'lxml').body.contents)
+    return list(BeautifulSoup(html, "html.parser").contents)
 
-    text = ""
+def build_chapter_text(data):
+    """
+    Builds the tree of a chapter by joining the HTML of all its chunks and parsing it with html.parser.
+
+    Args:
+        data (list): The chunks of the chapter.
+
+    Returns:
+        BeautifulSoup: The chapter.
+    """
+    text = []
 
     for count, chunk in enumerate(data):
 
         # logger.debug(count) # pollutes the debug log, shows which chunk crashed the handler
 
-        text += "<div>" # chapter chunks aren't always well-delimited in their contents
+        text.append("<div>") # chapter chunks aren't always well-delimited in their contents
 
         # appendix chunks are mixed in with other things
-        if not getting_appendix and 't' in chunk and chunk['t'].startswith("#special"): # t = title = bookmark
+        if is_skipped_chunk(data, chunk):
             continue
 
-        handler = chunk_handler.get(chunk['nt'], format_unknown) # nt = node type
-        text += handler(chunk)
-        text += "</div>\n"
+        handler = CHUNK_HANDLERS.get(chunk['nt'], format_unknown) # nt = node type
+        with FictionLiveMetrics.span(f"chunk.{chunk['nt']}"):
+            text.append(handler(chunk))
+        FictionLiveMetrics.count('chunks', nt=chunk['nt'])
+        text.append("</div>\n")
 
     ## soup to repair the most egregious HTML errors.
-    return BeautifulSoup(text, "html.parser")
+    with FictionLiveMetrics.span("parse_chapter"):
+        return BeautifulSoup("".join(text), "html.parser")
 
 # Function to print messages with carriage return for loading effect
 def print_loading(message):
@@ -629,9 +1032,10 @@ def print_loading(message):
     sys.stdout.write('\r' + message)
     sys.stdout.flush()
 
+@FictionLiveMetrics.traced("remove_empty_tags")
 def remove_empty_tags(soup):
     """
-    Removes empty tags from the provided BeautifulSoup object.
+    Removes empty tags from the provided BeautifulSoup object, along with tags left empty by their removal.
 
     Args:
         soup (BeautifulSoup): The BeautifulSoup object to modify.
@@ -644,19 +1048,8 @@ def remove_empty_tags(soup):
         >>> remove_empty_tags(soup)
         <div><p>Soup.</p></div>
     """
-    # Find all tags in the BeautifulSoup object
-    if not (all_tags := soup.find_all()):
-        return ""
-        
-    # Loop through all tags
-    for tag in all_tags:
-        # Check if the tag is empty (no content)
-        if not tag.contents and not tag.text.strip() and tag.name != 'img' and tag.name != 'br':
-            # Remove the empty tag
-            tag.decompose()
-
-    # Return the modified BeautifulSoup object
-    return soup if soup.find_all() else ""
+    FictionLiveTransforms.apply_transforms(soup, [FictionLiveTransforms.RemoveEmptyTags()])
+    return soup if soup.find() else ""
 
 def img_url_trans(imgurl):
     """
@@ -679,6 +1072,7 @@ def img_url_trans(imgurl):
     # logger.debug("post-imgurl:%s"%imgurl)
     return imgurl
 
+@FictionLiveMetrics.traced("format_images")
 def format_images(img_elements):
     """
     Formats the image elements in the provided list.
@@ -703,6 +1097,19 @@ def format_images(img_elements):
                 f"Parsing for img tags failed--probably poor input HTML.  Skipping img({img})"
             )
 
+class ImageUrls(FictionLiveTransforms.Transform):
+    """Points img tags at the current CDN like format_images, keeping them in `images` for the image pipeline."""
+    tags = {'img'}
+
+    def start(self, soup):
+        self.images = []
+
+    def enter(self, img):
+        # some pre-existing epubs have img tags that had src stripped off.
+        if img.has_attr('src'):
+            img['src'] = img_url_trans(img['src'])
+        self.images.append(img)
+
 def add_title(title, chapter_content = BeautifulSoup()):
     # Create a new tag to hold the chapter title
     title_tag = chapter_content.new_tag('h3')  # 'h1' for large text
@@ -711,32 +1118,580 @@ def add_title(title, chapter_content = BeautifulSoup()):
     # Add the title tag to the top of the chapter content
     chapter_content.insert(0, title_tag)
 
-def download_and_add_to_book(book, item_list, item_type, file_prefix):
-    for count, item in enumerate(item_list):
-        item['content'] = getChapterText(item['url'])
-        if type(item['content']) != BeautifulSoup:
-            continue
-        remove_empty_tags(item['content'])
-        if img_elements := item['content'].find_all('img'):
-            format_images(img_elements)
-        add_title(item['title'], item['content'])
-        item['content'] = item['content'].encode_contents()
-        epub_chapter = epub.EpubHtml(title=item['title'], file_name=f"{file_prefix}_{count+1}.xhtml", lang="en")
-        epub_chapter.content = item['content']
+class ChapterTitle(FictionLiveTransforms.Transform):
+    """Adds the chapter title with add_title once the rest of the chapter has been walked."""
+    def __init__(self, title):
+        self.title = title
+
+    def finish(self, soup):
+        add_title(self.title, soup)
+
+class RouteLinks(FictionLiveTransforms.Transform):
+    """Points the choice links to routes (see count_votes) at the route chapters in the book, if they are in it."""
+    tags = {'a'}
+
+    def __init__(self, routes):
+        self.routes = routes # the book's RouteCrawler
+        self.changed = False
+
+    def enter(self, link_tag):
+        url = link_tag.get('data-orighref')
+        if not url or not FictionLiveHTTP.ROUTE_URL_PATTERN.match(url):
+            return
+        file_name = self.routes.file_name(url, link_tag.get_text())
+        if file_name is None and re.match(r"^route_\d+\.xhtml$", link_tag.get('href', "")):
+            del link_tag['href'] # a chapter from an existing book, linking to a route no longer in it
+            self.changed = True
+        elif file_name is not None and link_tag.get('href') != file_name:
+            link_tag['href'] = file_name
+            self.changed = True
+
+def relink_routes(content, routes):
+    """
+    Points the route links of a chapter copied from an existing book (see update_book) at the routes of the
+    book being built, whose files may be numbered differently, and lets the RouteCrawler see them.
+
+    Args:
+        content (bytes): The chapter body, as copied.
+        routes (RouteCrawler): The book's routes.
+
+    Returns:
+        bytes: The chapter body with its route links re-pointed, or None if none of them changed.
+    """
+    if b"data-orighref" not in content: # most chapters have no route links, so don't parse them
+        return None
+    tree = BeautifulSoup(content, "html.parser")
+    route_links = RouteLinks(routes)
+    FictionLiveTransforms.apply_transforms(tree, [route_links])
+    content = tree.encode_contents() if route_links.changed else None
+    tree.decompose()
+    return content
+
+CHAPTER_TRANSFORMS = [FictionLiveTransforms.RemoveEmptyTags] # applied to every chapter along with ImageUrls, RouteLinks and ChapterTitle, in one walk
+
+@FictionLiveMetrics.traced("clean_chapter")
+def clean_chapter(content, title, routes=None):
+    """
+    Gets a downloaded chapter ready for the book in one walk over its tree: applies CHAPTER_TRANSFORMS (removing
+    empty tags), points its route links at the route chapters, its images at the current CDN and adds its title.
+
+    Args:
+        content (BeautifulSoup): The chapter, as getChapterText returns it. Changed in place.
+        title (str): The chapter title.
+        routes (RouteCrawler, optional): The book's routes, for RouteLinks. Defaults to None, leaving route links as they are.
+
+    Returns:
+        list: The chapter's img tags, for FictionLiveImages.ImagePipeline.embed.
+    """
+    image_urls = ImageUrls()
+    transforms = [transform() for transform in CHAPTER_TRANSFORMS]
+    if routes is not None:
+        transforms.append(RouteLinks(routes))
+    FictionLiveTransforms.apply_transforms(content, transforms + [image_urls, ChapterTitle(title)])
+    return image_urls.images
+
+def download_and_add_to_book(book, item_list, item_type, file_prefix, progress=None, images=None, fetch=None, routes=None):
+    """
+    Adds the chapters in the provided list to the EPUB book, in list order.
+
+    This is the clean and package end of the get_book_content pipeline. With a FetchStage, each chapter is
+    started on the download threads a few chapters before it is needed (see read_ahead). If an item carries a
+    'future', its already-downloaded text is used, and if it carries 'reused' content (from update_book), that
+    is added without downloading anything, only with its route links re-pointed (see relink_routes). Otherwise
+    the chapter is downloaded here. Each chapter's tree is let go of as soon as its XHTML has been added to the book. The XHTML file name of each added item is
+    recorded in item['file_name'], and the SHA-1 of its XHTML body in item['hash'].
+
+    Args:
+        book (epub.EpubBook): The EPUB book to which the content will be added.
+        item_list (list): A list of dictionaries containing the title, URL and optionally the pending download of each item.
+        item_type (str): The name of the item type, used in progress messages.
+        file_prefix (str): The prefix of the XHTML file names, e.g. 'chap' for chap_1.xhtml.
+        progress (callable, optional): Called with the size in bytes of each item added to the book. Defaults to None.
+        images (FictionLiveImages.ImagePipeline, optional): Embeds the items' images in the book. Defaults to None, linking to them.
+        fetch (FetchStage, optional): Starts the items' downloads ahead of them. Defaults to None.
+        routes (RouteCrawler, optional): The book's routes, to point the items' route links at (see clean_chapter). Defaults to None.
+
+    Returns:
+        epub.EpubBook: The EPUB book with the added content.
+    """
+    items = read_ahead(item_list, fetch.start, fetch.window) if fetch else item_list
+    for count, item in enumerate(items):
+        # the content is kept out of the item, so only the book holds on to it (or not even that, when streaming)
+        content_hash = None
+        if 'reused' in item: # already cleaned and titled when the existing book was made
+            content = item.pop('reused')
+            content_hash = item.pop('reused_hash', None) # the body as read back isn't byte for byte the body that was hashed
+            if routes is not None and (relinked := relink_routes(content, routes)) is not None:
+                content, content_hash = relinked, None
+            if images:
+                images.embed_reused(book, content)
+        else:
+            # pop the future so the finished download isn't kept alive by the item after this iteration
+            with FictionLiveMetrics.span("wait_for_chapter"):
+                tree = item.pop('future').result() if 'future' in item else getChapterText(item['url'])
+            if type(tree) != BeautifulSoup:
+                continue
+            img_elements = clean_chapter(tree, item['title'], routes)
+            if images and img_elements:
+                images.embed(book, img_elements)
+            content = tree.encode_contents()
+            # the tree's parent and sibling links are reference cycles, which would otherwise wait for the garbage collector
+            tree.decompose()
+            del tree, img_elements
+        item['file_name'] = f"{file_prefix}_{count+1}.xhtml"
+        item['hash'] = content_hash or hashlib.sha1(content).hexdigest()
+        epub_chapter = epub.EpubHtml(title=item['title'], file_name=item['file_name'], lang="en")
+        epub_chapter.content = content
         book.add_item(epub_chapter)
-        book.toc += (epub.Link(f"{file_prefix}_{count+1}.xhtml", item['title'], f"{item['title']}"),)
+        FictionLiveMetrics.count('chapter_bytes', len(content))
+        book.toc += (epub.Link(item['file_name'], item['title'], f"{item['title']}"),)
         print_loading(f"{item_type} {count+1}/{len(item_list)} downloaded.")
+        if progress:
+            progress(len(content))
     return book
 
-def get_book_content(chapters_list, appendices_list, routes_list, book):
+def get_chapter_and_images(url, images=None):
+    """
+    Downloads a chapter with getChapterText and starts downloading its images, without waiting for them.
+
+    Args:
+        url (str): The URL of the chapter.
+        images (FictionLiveImages.ImagePipeline, optional): The pipeline to download the images with. Defaults to None.
+
+    Returns:
+        BeautifulSoup: The chapter, as getChapterText returns it.
+    """
+    content = getChapterText(url)
+    if images and type(content) == BeautifulSoup:
+        images.prefetch(img_url_trans(img['src']) for img in content.find_all('img', src=True))
+    return content
+
+def build_route_and_images(data, images=None):
+    """
+    Builds a route chapter from chunks the RouteCrawler downloaded, and starts downloading its images.
+
+    Args:
+        data (list): The route's chunks, without those already in an earlier route, or None if it never had any.
+        images (FictionLiveImages.ImagePipeline, optional): The pipeline to download the images with. Defaults to None.
+
+    Returns:
+        BeautifulSoup: The route chapter (with nothing but its title to come, if all its chunks are in earlier routes), or "" if it has no chunks at all.
+    """
+    if data is None:
+        return ""
+    return build_chapter_and_images(data, images) if data else BeautifulSoup("", "html.parser")
+
+def linked_routes(chunk):
+    """
+    Finds the routes a choice chunk links to.
+
+    Args:
+        chunk (dict): A chunk.
+
+    Returns:
+        list: (route id, choice text) of each choice that leads to a route, in choice order.
+    """
+    if chunk.get('nt') != "choice" or not isinstance(chunk.get('routes'), dict):
+        return []
+    choices = chunk.get('choices') or []
+    links = []
+    for choice_index, route_id in chunk['routes'].items(): # keyed by the index of the choice, as a string
+        index = int(choice_index) if str(choice_index).isdigit() else len(choices)
+        links.append((route_id, str(choices[index]) if index < len(choices) else str(route_id)))
+    return links
+
+class RouteCrawler:
+    """
+    Downloads every route of a story: those in its route metadata, and those only linked to from choices in
+    the main text or in other routes.
+
+    The routes are downloaded on the book's download threads. As each one comes in, the choices in it are
+    checked for links to routes that haven't been seen yet, and those are downloaded too. The choices in the
+    chapters and appendices are checked as they are cleaned (see RouteLinks and file_name), so the crawl is
+    only done once they are all in the book and the whole route graph is in. Then the routes are put in a
+    fixed order (the route metadata first, then the routes found by following the links) and each chunk is
+    kept only in the first route it appears in, since nested and shared routes repeat the chunks of the routes
+    they branch from. The chunks left in each route are kept in its item['chunks'], for the FetchStage to
+    build the route chapter from when it's almost the route's turn to be added to the book. A route with no
+    chunks at all is left out of the book.
+
+    The routes' XHTML files are numbered in that order, and files maps each route URL to its file so
+    RouteLinks can point choice links at them. A chapter can link to a route before the crawl is done, so a
+    route is given its file the first time a link to it is pointed at it, once it is known to have chunks,
+    and keeps it: the metadata routes are numbered first, then the routes linked to from the main text in
+    the order they are linked, then the rest breadth first.
+
+    Args:
+        routes_list (list): The routes of the story, as get_book_map returns them.
+        executor (concurrent.futures.Executor): The download threads.
+
+    Examples:
+        >>> crawler = RouteCrawler(routes_list, executor)
+        >>> crawler.file_name(route_url, "Go left") # while the chapters are cleaned
+        'route_2.xhtml'
+        >>> routes_list = crawler.routes() # once they are in; each route now has its 'chunks'
+    """
+    def __init__(self, routes_list, executor):
+        self.executor = executor
+        self.known = list(routes_list) # metadata routes, in order
+        self.files = {} # route URL -> XHTML file name, for the routes that are in the book
+        self._items = {item['url']: item for item in self.known} # and then the routes linked to from the main text, in the order they were linked
+        self._numbered = [] # routes with a file, in file order
+        self._chunks = {} # route URL -> downloaded chunks, None until they are in
+        self._pending = 0
+        self._error = None
+        self._done = threading.Condition(threading.RLock()) # reentrant, as a future may run its callback right away
+        self._ordered = None
+        self._held = True
+        with self._done:
+            self._pending += 1 # held until routes() is called, as the main text can still link to more routes
+            for item in self.known:
+                self._fetch(item['url'])
+
+    def _fetch(self, url):
+        self._chunks[url] = None
+        self._pending += 1
+        try:
+            future = self.executor.submit(fetch_chunks, url)
+        except RuntimeError as e: # the executor is shutting down
+            self._fetched(url, None, e)
+            return
+        future.add_done_callback(lambda future: self._fetched(url, future))
+
+    def _fetched(self, url, future, error=None):
+        with self._done:
+            try:
+                if error is not None:
+                    raise error
+                data = future.result()
+                self._chunks[url] = data if isinstance(data, list) else []
+                for chunk in self._chunks[url]:
+                    for route_id, _ in linked_routes(chunk):
+                        if (linked_url := ROUTE_URL.format(route_id=route_id)) not in self._chunks:
+                            self._fetch(linked_url)
+            except Exception as e:
+                self._error = self._error or e
+            self._release()
+
+    def _release(self):
+        """Counts a download as done, and finishes the crawl after the last one. Called with the lock held."""
+        self._pending -= 1
+        if self._pending == 0:
+            self._finish()
+        self._done.notify_all()
+
+    def _wait_for(self, urls):
+        """Waits for the routes to come in, or for a download to fail. Called with the lock held."""
+        while self._error is None and any(self._chunks[url] is None for url in urls):
+            self._done.wait()
+
+    def _number(self, item):
+        """Gives a route with chunks the next file. Called with the lock held."""
+        self._numbered.append(item)
+        self.files[item['url']] = f"route_{len(self._numbered)}.xhtml"
+
+    def file_name(self, url, choice_text=""):
+        """
+        Returns the XHTML file of a route, to point a link at. While the crawl is still going, a route that hasn't
+        been seen yet is downloaded, and this waits for it (and, the first time, for the metadata routes) to come in.
+
+        Args:
+            url (str): The route URL.
+            choice_text (str, optional): The text of the choice linking to it, for the title of a route that isn't in the route metadata.
+
+        Returns:
+            str: The route's file name, or None if it isn't in the book (it has no chunks, or a route failed to download).
+        """
+        with self._done:
+            if self._ordered is None:
+                if url not in self._items:
+                    self._items[url] = {'title': f"Route: {choice_text}", 'url': url}
+                    if url not in self._chunks: # not already found by a link in another route
+                        self._fetch(url)
+                if not self._numbered and self.known:
+                    self._wait_for([item['url'] for item in self.known])
+                    for item in self.known:
+                        if self._chunks[item['url']]:
+                            self._number(item)
+                self._wait_for([url])
+                if self._error is None and url not in self.files and self._chunks[url]:
+                    self._number(self._items[url])
+            return self.files.get(url)
+
+    def _finish(self):
+        """Orders and numbers the routes with chunks and drops the chunks already in earlier routes."""
+        if self._error is not None:
+            self._ordered = self.known
+            return
+        found = list(self._items.values())
+        listed = set(self._items)
+        position = 0
+        while position < len(found): # breadth first: found grows as the links are followed
+            for chunk in self._chunks[found[position]['url']]:
+                for route_id, choice_text in linked_routes(chunk):
+                    if (url := ROUTE_URL.format(route_id=route_id)) not in listed:
+                        listed.add(url)
+                        found.append({'title': f"Route: {choice_text}", 'url': url})
+            position += 1
+        FictionLiveMetrics.count('routes_found', len(found) - len(self.known))
+
+        for item in found:
+            if item['url'] not in self.files and self._chunks[item['url']]:
+                self._number(item)
+        seen_ids = set()
+        for item in self._numbered:
+            data = self._chunks[item['url']]
+            kept = [chunk for chunk in data if chunk.get('_id') is None or chunk['_id'] not in seen_ids]
+            seen_ids.update(chunk['_id'] for chunk in data if chunk.get('_id') is not None)
+            FictionLiveMetrics.count('route_chunks_skipped', len(data) - len(kept))
+            item['chunks'] = kept
+        self._chunks.clear()
+        self._ordered = self._numbered
+
+    def routes(self):
+        """
+        Ends the crawl once the chapters and appendices are in the book, and waits for it to finish.
+
+        Returns:
+            list: Every route with chunks, in book order, each with its 'chunks' (see build_route_and_images).
+
+        Raises:
+            Exception: The first error downloading a route, as the route's chapter download would have raised it.
+        """
+        with self._done:
+            if self._held:
+                self._held = False
+                self._release()
+            while self._ordered is None:
+                self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._ordered
+
+def chapters_per_request(book_data, chapter_count):
+    """
+    Works out how many neighbouring chapters to fetch with each chapter-range request.
+
+    The response size is estimated from the story's word count, so a request is expected to stay under
+    RANGE_REQUEST_BYTES, and the number of requests grows with the size of the story rather than its number
+    of chapters. The result is a power of two, so it (and with it the request URLs the HTTP cache keys on)
+    stays the same while the story grows, as long as its chapters keep about the same length.
+
+    Args:
+        book_data (dict): The story metadata.
+        chapter_count (int): The number of main-text chapters.
+
+    Returns:
+        int: The number of chapters per request, from 1 to MAX_CHAPTERS_PER_REQUEST.
+    """
+    words = book_data.get('w')
+    if not chapter_count or not isinstance(words, (int, float)) or words <= 0:
+        return 1
+    count = int(RANGE_REQUEST_BYTES // max(1.0, words * BYTES_PER_WORD / chapter_count))
+    count = min(MAX_CHAPTERS_PER_REQUEST, max(1, count))
+    return 1 << (count.bit_length() - 1)
+
+def chunk_range(item):
+    """Returns the (story id, first, last) chunk timestamps a chapter-range item covers, or None for other URLs."""
+    if range_match := FictionLiveHTTP.RANGE_URL_PATTERN.match(item['url']):
+        return range_match[1], int(range_match[2]), int(range_match[3])
+    return None
+
+def plan_range_requests(chapters_list, appendices_list, per_request=1):
+    """
+    Groups the chapters and appendices still to be downloaded into chapter-range requests.
+
+    Runs of neighbouring chapters are fetched together, up to `per_request` at a time, in blocks aligned on
+    multiples of `per_request` so the same chapters are grouped the same way on every run. The last chapter
+    is always fetched alone, since it is the one still growing and the HTTP cache revalidates it every time.
+    An appendix is a single chunk inside the main text, so it is picked out of the request of the chapters
+    around it when there is one, and fetched alone otherwise.
+
+    Args:
+        chapters_list (list): The chapters, as get_book_map returns them.
+        appendices_list (list): The appendices, as get_book_map returns them.
+        per_request (int, optional): The most chapters per request (see chapters_per_request). Defaults to 1, a request per chapter.
+
+    Returns:
+        list: (URL, items) for each request, in chapter order; a request with a single item uses that item's own URL.
+    """
+    requests_planned = []
+    run = [] # neighbouring chapters of the current block
+    for position, item in enumerate(chapters_list):
+        if run and ('reused' in item or position % per_request == 0 or position == len(chapters_list) - 1):
+            requests_planned.append(run)
+            run = []
+        if 'reused' not in item and chunk_range(item):
+            run.append(item)
+        elif 'reused' not in item:
+            requests_planned.append([item])
+    if run:
+        requests_planned.append(run)
+
+    planned = []
+    spans = [] # (first, last) timestamps of each request of several chapters, in order
+    for items in requests_planned:
+        if len(items) == 1:
+            planned.append((items[0]['url'], items))
+            continue
+        story_id, first, _ = chunk_range(items[0])
+        last = chunk_range(items[-1])[2]
+        planned.append((f"https://fiction.live/api/anonkun/chapters/{story_id}/{first}/{last}/", items))
+        spans.append((first, last, len(planned) - 1))
+
+    starts = [first for first, _, _ in spans]
+    for item in appendices_list:
+        if 'reused' in item:
+            continue
+        if bounds := chunk_range(item):
+            index = bisect.bisect_right(starts, bounds[1]) - 1
+            if index >= 0 and spans[index][1] >= bounds[2]:
+                planned[spans[index][2]][1].append(item)
+                continue
+        planned.append((item['url'], [item]))
+    return planned
+
+def build_chapter_and_images(data, images=None):
+    """
+    Builds a chapter from chunks that have already been downloaded, like getChapterText, and starts downloading its images.
+
+    Args:
+        data (list): The chunks of the chapter.
+        images (FictionLiveImages.ImagePipeline, optional): The pipeline to download the images with. Defaults to None.
+
+    Returns:
+        BeautifulSoup: The chapter, or "" if it has no chunks.
+    """
+    if data == []:
+        return ""
+    with FictionLiveMetrics.span("build_chapter"):
+        content = build_chapter(data)
+    if images:
+        images.prefetch(img_url_trans(img['src']) for img in content.find_all('img', src=True))
+    return content
+
+def settle(future, function, *args):
+    """Runs a function, passing its result or exception on to a Future."""
+    try:
+        future.set_result(function(*args))
+    except Exception as e:
+        future.set_exception(e)
+
+def fetch_range_request(url, targets, executor, images=None):
+    """
+    Downloads a chapter-range request covering several chapters, splits its chunks back into them by their
+    'ct' timestamps, and queues each chapter to be built. Runs on the download threads.
+
+    Args:
+        url (str): The URL of the request.
+        targets (list): (first, last, future) of each chapter and appendix it covers: the chunk timestamps
+                        of the chapter, and the Future to pass it on to once built.
+        executor (concurrent.futures.Executor): The download threads, to build the chapters on.
+        images (FictionLiveImages.ImagePipeline, optional): Downloads the chapters' images. Defaults to None.
+    """
+    try:
+        with FictionLiveMetrics.span("fetch_range", url=url, chapters=len(targets)):
+            data = fetch_chunks(url)
+        data = sorted(data, key=lambda chunk: chunk.get('ct', 0)) # stable, in case they don't come sorted
+        times = [chunk.get('ct', 0) for chunk in data]
+        for first, last, future in targets:
+            chunks = data[bisect.bisect_left(times, first):bisect.bisect_right(times, last)]
+            executor.submit(settle, future, build_chapter_and_images, chunks, images)
+    except Exception as e: # including the executor shutting down because another chapter failed
+        for _, _, future in targets:
+            if not future.done():
+                future.set_exception(e)
+
+def read_ahead(item_list, start, window):
+    """
+    Yields the items of a list in order, starting each one `window` items before it is yielded.
+
+    This is the bounded queue between the download threads and whoever adds the chapters to the book: as the
+    next item is only asked for once the last one has been added, at most `window` items are ever started and
+    not yet added, however long the book, and the downloads wait for the book to catch up (a chapter-range
+    request may start the few chapters after these along with them).
+
+    Args:
+        item_list (list): The items.
+        start (callable): Starts an item, e.g. FetchStage.start.
+        window (int): How many items to start ahead of the one yielded.
+
+    Yields:
+        dict: Each item, once the `window` items after it have been started.
+    """
+    started = collections.deque()
+    for item in item_list:
+        start(item)
+        started.append(item)
+        if len(started) > window:
+            yield started.popleft()
+    while started:
+        yield started.popleft()
+
+class FetchStage:
+    """
+    Starts the downloads of the chapters, appendices and routes of a book on the download threads, as
+    read_ahead asks for them.
+
+    A chapter or appendix is started by queueing the request plan_range_requests put it in, which starts the
+    other items of that request too; a route by building its chapter from the chunks the RouteCrawler
+    downloaded. Either way the item gets the 'future' of its chapter tree. Items that are reused, or that
+    aren't in the plan, are left to download_and_add_to_book.
+
+    Args:
+        planned (list): The requests, as plan_range_requests returns them.
+        executor (concurrent.futures.Executor): The download threads.
+        window (int): How many items read_ahead may start before the one being added to the book.
+        images (FictionLiveImages.ImagePipeline, optional): Downloads the chapters' images as soon as their text is in. Defaults to None.
+    """
+    def __init__(self, planned, executor, window, images=None):
+        self.executor = executor
+        self.window = window
+        self.images = images
+        self._requests = {id(item): (url, items) for url, items in planned for item in items} # requests not queued yet
+
+    def start(self, item):
+        if 'future' in item or 'reused' in item:
+            return
+        if 'chunks' in item:
+            item['future'] = self.executor.submit(build_route_and_images, item.pop('chunks'), self.images)
+            return
+        if (request := self._requests.get(id(item))) is None:
+            return
+        url, items = request
+        for planned_item in items:
+            del self._requests[id(planned_item)]
+        if len(items) == 1 and item['url'] == url:
+            item['future'] = self.executor.submit(get_chapter_and_images, url, self.images)
+            return
+        targets = []
+        for planned_item in items:
+            planned_item['future'] = Future()
+            targets.append((*chunk_range(planned_item)[1:], planned_item['future']))
+        self.executor.submit(fetch_range_request, url, targets, self.executor, self.images)
+
+def get_book_content(chapters_list, appendices_list, routes_list, book, jobs=DEFAULT_JOBS, progress=None, images=None, per_request=1):
     """
     Downloads and adds chapters, appendices, and routes to the provided EPUB book.
 
+    The book goes through a pipeline of stages: the requests are planned (plan_range_requests, and the
+    RouteCrawler for the routes), fetched and rendered into chapter trees on a pool of `jobs` download threads
+    (FetchStage), then cleaned and packaged into the book one at a time in get_book_map order
+    (download_and_add_to_book). Only CHAPTERS_AHEAD_PER_JOB chapters (or two chapter-range requests) per
+    thread are downloaded ahead of the one being packaged, and each tree is let go of once it is in the book, so a streamed book (see
+    FictionLiveEpub.StreamingEpubBook) is built in the same memory whatever its length. The RouteCrawler also
+    follows choice links to routes missing from the story's route metadata, in the chapters, appendices and
+    routes; those are added to routes_list, after the others, and routes with no chunks are taken out of it.
+
     Args:
         chapters_list (list): A list of dictionaries containing chapter information, including title and URL.
         appendices_list (list): A list of dictionaries containing appendix information, including title and URL.
         routes_list (list): A list of dictionaries containing route information, including title and URL.
         book (epub.EpubBook): The EPUB book to which the content will be added.
+        jobs (int, optional): The number of chapters to download at once. Defaults to DEFAULT_JOBS.
+        progress (callable, optional): Called with the size in bytes of each chapter, appendix or route added to the book. Defaults to None.
+        images (FictionLiveImages.ImagePipeline, optional): Downloads the chapters' images as soon as their text is in, and embeds them. Defaults to None.
+        per_request (int, optional): The most neighbouring chapters to fetch with one request (see plan_range_requests). Defaults to 1.
 
     Returns:
         epub.EpubBook: The EPUB book with the added content.
@@ -749,19 +1704,31 @@ def get_book_content(chapters_list, appendices_list, routes_list, book):
         >>> get_book_content(chapters_list, appendices_list, routes_list, book)
         <epub.EpubBook object at 0x...>
     """
-    # Download Chapters
-    print("Downloading Chapters...")
-    book = download_and_add_to_book(book, chapters_list, "Chapter", "chap")
-
-    # Download Appendices
-    if appendices_list:
-        print("\nDownloading Appendices...")
-        book = download_and_add_to_book(book, appendices_list, "Appendix", "appendix")
-
-    # Download Routes
-    if routes_list:
-        print("\nDownloading Routes...")
-        book = download_and_add_to_book(book, routes_list, "Route", "route")
+    jobs = max(1, jobs)
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        crawler = RouteCrawler(routes_list, executor) # the route graph is small, so it is crawled alongside the chapters
+        # at least two chapter-range requests per thread, so each has the next one queued when it's done
+        fetch = FetchStage(plan_range_requests(chapters_list, appendices_list, per_request), executor,
+                           jobs * max(CHAPTERS_AHEAD_PER_JOB, 2 * per_request), images)
+
+        # Download Chapters
+        print("Downloading Chapters...")
+        book = download_and_add_to_book(book, chapters_list, "Chapter", "chap", progress, images, fetch, crawler)
+
+        # Download Appendices
+        if appendices_list:
+            print("\nDownloading Appendices...")
+            book = download_and_add_to_book(book, appendices_list, "Appendix", "appendix", progress, images, fetch, crawler)
+
+        # Download Routes
+        routes_list[:] = crawler.routes() # with the routes found by following choice links, less those with no chunks
+        if routes_list:
+            print("\nDownloading Routes...")
+            book = download_and_add_to_book(book, routes_list, "Route", "route", progress, images, fetch, crawler)
+    finally:
+        # if a chapter failed, don't keep downloading the rest of the book before raising
+        executor.shutdown(wait=True, cancel_futures=True)
     return book
 
 def create_title_page(book_data, book, includeSpoilerTags, book_map):
@@ -796,16 +1763,45 @@ def create_title_page(book_data, book, includeSpoilerTags, book_map):
     title_page.content = title_page_html.encode('utf-8') # Set the title page content
     book.add_item(title_page)
     book.toc += (epub.Link("title.xhtml", 'Title Page', "Title Page"),)  # Add the title page to the table of contents
+    return title_page
+
+def get_cover_url(book_data):
+    """
+    Returns the URL of the story's cover image.
+
+    Args:
+        book_data (dict): The story metadata.
+
+    Returns:
+        str: The cover URL, or None if the story has no cover.
+    """
+    cover = book_data.get('i')
+    if isinstance(cover, list):
+        cover = cover[0] if cover else None
+    return img_url_trans(cover) if isinstance(cover, str) and cover else None
 
 # Function to create the EPUB file
-def create_book(book_data, book_number, total_books):
+@FictionLiveMetrics.traced("create_book")
+def create_book(book_data, book_number, total_books, jobs=DEFAULT_JOBS, reuse=None, stream_path=None, progress=None, images=None):
     """
     Creates an EPUB book based on the provided book data.
 
+    With a stream_path, the book is a FictionLiveEpub.StreamingEpubBook that writes each chapter to that file
+    as soon as it is ready, and write_book only has to add the table of contents.
+
+    The story's 'cht' and the source URL and content hash of every chapter file are stored in the book's
+    metadata, so update_book and the batch library (see FictionLiveLibrary) can later tell which chapters are still current.
+
     Args:
         book_data (dict): A dictionary containing the book data, including title, author, chapters, appendices, routes, and other metadata.
         book_number (int): The number of the book being created.
         total_books (int): The total number of books to be created.
+        jobs (int, optional): The number of chapters to download at once. Defaults to DEFAULT_JOBS.
+        reuse (dict, optional): (content, hash) of chapters to use instead of downloading them, keyed by chapter URL,
+                                as find_reusable_chapters returns them. Defaults to None.
+        stream_path (str, optional): The temporary file to stream the book into. Defaults to None, building the book in memory.
+        progress (callable, optional): Called with the size in bytes of each chapter, appendix or route as it is added. Defaults to None.
+        images (FictionLiveImages.ImagePipeline, optional): Embeds the cover and every image in the book. Defaults to None, linking to the images online.
 
     Returns:
         epub.EpubBook: The created EPUB book.
@@ -818,7 +1814,7 @@ def create_book(book_data, book_number, total_books):
         <epub.EpubBook object at 0x...>
     """
     print(f'Creating book {book_number}/{total_books} "{book_data["t"]}".')
-    book = epub.EpubBook() # Create the book
+    book = FictionLiveEpub.StreamingEpubBook(stream_path) if stream_path else epub.EpubBook() # Create the book
 
     # Set metadata properties
     book.set_title(book_data['t']) # Set the title
@@ -845,17 +1841,171 @@ def create_book(book_data, book_number, total_books):
         book.add_metadata('DC', 'subject', tag) # Add tags
     
     chapters_list, appendices_list, routes_list = get_book_map(book_data)
-    create_title_page(book_data, book, includeSpoilerTags, [chapters_list, appendices_list, routes_list]) # Create the title page
+    for item in itertools.chain(chapters_list, appendices_list, routes_list):
+        if reuse and item['url'] in reuse:
+            item['reused'], item['reused_hash'] = reuse[item['url']]
+    if images and (cover_url := get_cover_url(book_data)):
+        images.add_cover(book, cover_url) # the cover page comes before the title page
+    front_pages = sum(isinstance(item, epub.EpubHtml) for item in book.get_items())
+    front_links = len(book.toc)
 
     book.add_item(epub.EpubNav()) # Add the navigation
 
-    get_book_content(chapters_list, appendices_list, routes_list, book)
-
-    book.spine = list(book.get_items()) # Set the spine to the list of chapters
+    try:
+        get_book_content(chapters_list, appendices_list, routes_list, book, jobs, progress, images,
+                         chapters_per_request(book_data, len(chapters_list)))
+    except BaseException:
+        if stream_path: # don't leave half a book behind
+            book.abort()
+        raise
+
+    # the title page counts the routes the crawl found, so it is made last and moved in front of the chapters
+    title_page = create_title_page(book_data, book, includeSpoilerTags, [chapters_list, appendices_list, routes_list])
+    book.toc = book.toc[:front_links] + book.toc[-1:] + book.toc[front_links:-1]
+
+    # remember where every chapter came from, for update_book
+    added = [item for item in itertools.chain(chapters_list, appendices_list, routes_list) if 'file_name' in item]
+    book.add_metadata(None, 'meta', '', {'name': 'fictionlive:cht', 'content': str(book_data.get('cht', ''))})
+    book.add_metadata(None, 'meta', '', {'name': 'fictionlive:sources', 'content': json.dumps({item['file_name']: item['url'] for item in added})})
+    book.add_metadata(None, 'meta', '', {'name': 'fictionlive:hashes', 'content': json.dumps({item['file_name']: item['hash'] for item in added})})
+
+    pages = [item for item in book.get_items() if isinstance(item, epub.EpubHtml) and item is not title_page]
+    book.spine = pages[:front_pages] + [title_page] + pages[front_pages:] # Set the spine to the list of chapters
+    if images:
+        print(f"\n{images.summary()}")
     book.add_item(epub.EpubNcx()) # Add the table of contents
 
     return book
 
+def book_meta(book):
+    """
+    Returns the named <meta> entries of a book (e.g. 'fictionlive:cht'), whether create_book just made it or it was read from a file.
+
+    Args:
+        book (epub.EpubBook): The book.
+
+    Returns:
+        dict: The content of each entry, by name.
+    """
+    entries = itertools.chain(book.metadata.get(None, {}).get('meta', []), book.metadata.get(epub.NAMESPACES['OPF'], {}).get('meta', []))
+    return {attributes.get('name'): attributes.get('content') for _, attributes in entries if attributes}
+
+def read_existing_book(epub_path):
+    """
+    Reads the story id, update time and chapters of an EPUB file previously created by create_book.
+
+    Args:
+        epub_path (str): The path of the EPUB file.
+
+    Returns:
+        dict: A dictionary with the 'story_id', 'cht' (None for books made before it was recorded), 'sources' (chapter file name -> URL),
+              'hashes' (chapter file name -> SHA-1 of its body, if recorded), 'titles' (chapter file name -> TOC title) and 'book'
+              (the epub.EpubBook), or None if the file isn't a fiction.live book.
+
+    Examples:
+        >>> read_existing_book("Story_Title.epub")
+        {'story_id': '12345678912345678', 'cht': 1700000000000, 'sources': {'chap_1.xhtml': 'https://fiction.live/api/anonkun/chapters/...'}, ...}
+    """
+    try:
+        book = epub.read_epub(epub_path)
+    except Exception as e:
+        print(f"{Fore.RED}Could not read EPUB file at: ({epub_path}): {e}{Style.RESET_ALL}")
+        return None
+
+    story_id = None
+    for identifier, _ in book.get_metadata('DC', 'identifier'):
+        if id_match := re.match(r"^url:https://fiction\.live/stories//([A-Za-z0-9]+)", identifier or ""):
+            story_id = id_match[1]
+    if story_id is None:
+        print(f"{Fore.RED}Not a fiction.live EPUB: ({epub_path}){Style.RESET_ALL}")
+        return None
+
+    meta = book_meta(book)
+    return {
+        'story_id': story_id,
+        'cht': int(meta['fictionlive:cht']) if meta.get('fictionlive:cht') else None,
+        'sources': json.loads(meta['fictionlive:sources']) if meta.get('fictionlive:sources') else {},
+        'hashes': json.loads(meta['fictionlive:hashes']) if meta.get('fictionlive:hashes') else {},
+        'titles': {link.href: link.title for link in book.toc if isinstance(link, epub.Link)},
+        'book': book,
+    }
+
+def find_reusable_chapters(existing, book_map):
+    """
+    Works out which chapters of an existing book can be copied into the updated book instead of being downloaded again.
+
+    A chapter range that had already ended when the existing book was made (its end is before the book's 'cht')
+    is reused if the same range is still in the story. Books made before the source URLs were recorded are matched
+    by file position and title instead, and their last chapter is always downloaded again. Routes are always downloaded.
+
+    Args:
+        existing (dict): The existing book, as returned by read_existing_book.
+        book_map (tuple): The chapters, appendices and routes lists of the current story, as returned by get_book_map.
+
+    Returns:
+        dict: The reusable chapters' (content, hash), keyed by chapter URL: the XHTML body bytes, and their
+              SHA-1 as recorded when they were added to the existing book (None for older books).
+    """
+    chapters_list, appendices_list, _ = book_map
+    current_urls = {item['url'] for item in itertools.chain(chapters_list, appendices_list)}
+    reusable_files = {}
+    if existing['sources']:
+        for file_name, url in existing['sources'].items():
+            range_match = FictionLiveHTTP.RANGE_URL_PATTERN.match(url)
+            if range_match and existing['cht'] is not None and int(range_match[3]) < existing['cht'] and url in current_urls:
+                reusable_files[file_name] = url
+    else:
+        for file_prefix, item_list in (("chap", chapters_list), ("appendix", appendices_list)):
+            numbers = sorted(int(file_match[1]) for href in existing['titles'] if (file_match := re.match(rf"^{file_prefix}_(\d+)\.xhtml$", href)))
+            if file_prefix == "chap" and numbers:
+                numbers.pop() # the last chapter is probably the one that has grown since
+            for number in numbers:
+                file_name = f"{file_prefix}_{number}.xhtml"
+                if number <= len(item_list) and item_list[number-1]['title'] == existing['titles'][file_name]:
+                    reusable_files[file_name] = item_list[number-1]['url']
+
+    reuse = {}
+    for file_name, url in reusable_files.items():
+        if item := existing['book'].get_item_with_href(file_name):
+            reuse[url] = (item.get_body_content(), existing['hashes'].get(file_name))
+    return reuse
+
+def update_book(epub_path, jobs=DEFAULT_JOBS, stream=False, images=None):
+    """
+    Rebuilds an EPUB file previously created by create_book, only downloading the chapters that are new or have changed.
+
+    Args:
+        epub_path (str): The path of the existing EPUB file.
+        jobs (int, optional): The number of chapters to download at once. Defaults to DEFAULT_JOBS.
+        stream (bool, optional): Whether to stream the book to disk as it is built (see create_book). Defaults to False.
+        images (FictionLiveImages.ImagePipeline, optional): Embeds the book's images (see create_book), keeping those of reused chapters. Defaults to None.
+
+    Returns:
+        epub.EpubBook: The updated EPUB book, or None if the file couldn't be read, the story couldn't be fetched, or it is already up to date.
+
+    Examples:
+        >>> update_book("Story_Title.epub")
+        <epub.EpubBook object at 0x...>
+    """
+    if (existing := read_existing_book(epub_path)) is None:
+        return None
+    if (book_data := get_book_info(f"https://fiction.live/api/node/{existing['story_id']}")) is None:
+        return None
+
+    book_map = get_book_map(book_data)
+    current_urls = [item['url'] for item in itertools.chain(*book_map)]
+    # not the routes: those with no chunks are never in the book, and the crawl finds more than the metadata lists
+    text_urls = {item['url'] for item in itertools.chain(book_map[0], book_map[1])}
+    if existing['cht'] == book_data.get('cht') and text_urls <= set(existing['sources'].values()):
+        print(f'"{book_data["t"]}" is already up to date.')
+        return None
+
+    reuse = find_reusable_chapters(existing, book_map)
+    print(f"Reusing {len(reuse)} of {len(current_urls)} chapters from {epub_path}")
+    if images:
+        images.adopt(existing['book'])
+    return create_book(book_data, 1, 1, jobs, reuse, f"{epub_path}.part" if stream else None, images=images)
+
 def get_valid_directory():
     while True:
         dir_path = input("Enter the directory where you want to save the EPUB file(s): ")
@@ -876,6 +2026,7 @@ def get_valid_directory():
     return dir_path
 
 # Save the EPUB file
+@FictionLiveMetrics.traced("save_book")
 def save_book(book, dir_path):
     # Check if the directory already contains a file with the same name
     book_title = book.title
@@ -885,17 +2036,51 @@ def save_book(book, dir_path):
     epub_path = validate_filename(book, dir_path, epub_path, book_title)
 
     # Write the EPUB file to the specified directory
+    write_book(book, epub_path)
+    #play_sound(SUCCESS_SOUND_PATH)
+
+@FictionLiveMetrics.traced("write_book")
+def write_book(book, epub_path):
+    """
+    Writes the EPUB book to the given path, replacing any existing file only once the new one is complete.
+
+    Args:
+        book (epub.EpubBook): The EPUB book to write.
+        epub_path (str): The path of the EPUB file.
+
+    Returns:
+        None
+    """
     print("\nWriting EPUB file...")
-    with open(epub_path, 'wb') as epub_file:
-        epub.write_epub(epub_file, book)
+    if isinstance(book, FictionLiveEpub.StreamingEpubBook): # the chapters are already on disk
+        book.finish(epub_path)
+    else:
+        temp_path = f"{epub_path}.{os.getpid()}.tmp" # batch workers may be writing the same name
+        with open(temp_path, 'wb') as epub_file:
+            epub.write_epub(epub_file, book)
+        os.replace(temp_path, epub_path)
     print(f"EPUB file written to {Fore.GREEN}{epub_path}{Style.RESET_ALL}\n")
-    #play_sound(SUCCESS_SOUND_PATH)
 
-def validate_filename(book, dir_path, epub_path, book_title):
+def clean_title(book_title):
+    """
+    Replaces the characters that can't be used in a file name with '-'.
+
+    Args:
+        book_title (str): The book title.
+
+    Returns:
+        str: The title, safe to use as a file name.
+
+    Examples:
+        >>> clean_title("What? A Quest!")
+        'What- A Quest-'
+    """
     invalid_chars = set(string.punctuation.replace('_', '')) | {'\n', '\r'}
-    if any(char in invalid_chars for char in book_title):
+    return "".join(["-" if char in invalid_chars else char for char in book_title])
+
+def validate_filename(book, dir_path, epub_path, book_title):
+    if (new_title := clean_title(book_title)) != book_title:
         print(f"\n{Fore.YELLOW}The book title contains invalid characters. Invalid characters will be replaced with '-'{Style.RESET_ALL}\r")
-        new_title = "".join(["-" if char in invalid_chars else char for char in book_title])
         epub_path = os.path.join(dir_path, f"{new_title.replace(' ', '_')}.epub")
         book.set_title(new_title)
     while os.path.isfile(epub_path):
@@ -913,8 +2098,36 @@ def validate_filename(book, dir_path, epub_path, book_title):
             #play_sound(ALERT_SOUND_PATH)
     return epub_path
 
+def image_pipeline(image_options):
+    """
+    Returns a FictionLiveImages.ImagePipeline for one book, or a stand-in yielding None if images aren't being embedded.
+
+    Args:
+        image_options (dict): ImagePipeline options, or None.
+
+    Returns:
+        contextlib.AbstractContextManager: The pipeline, to use in a with statement.
+    """
+    if image_options is None:
+        return contextlib.nullcontext()
+    return FictionLiveImages.ImagePipeline(session, **image_options)
+
+def print_transfer_stats(transfer_stats):
+    """
+    Prints what the last book cost in requests, bytes and time to first byte, then starts counting afresh for the next one.
+
+    Args:
+        transfer_stats (FictionLiveHTTP.TransferStats): The session's transfer counts.
+
+    Returns:
+        None
+    """
+    print(f"{Style.DIM}{transfer_stats.report()}{Style.RESET_ALL}\n")
+    transfer_stats.reset()
+
 # The main function
-def main():  # sourcery skip: hoist-statement-from-loop
+def main(jobs=DEFAULT_JOBS, cache_dir=FictionLiveHTTP.CACHE_DIR, update_paths=None, stream=False, rate_limit=True, image_options=None,
+         metrics_dir=None, record_dir=None, replay_url=None):  # sourcery skip: hoist-statement-from-loop
     r"""
     Main function for creating EPUB files from story URLs.
 
@@ -925,7 +2138,15 @@ def main():  # sourcery skip: hoist-statement-from-loop
     Loops through the URLs and creates an EPUB file for each one.
 
     Args:
-        None
+        jobs (int, optional): The number of chapters to download at once. Defaults to DEFAULT_JOBS.
+        cache_dir (str, optional): The directory of the on-disk HTTP cache, or None to disable caching. Defaults to FictionLiveHTTP.CACHE_DIR.
+        update_paths (list, optional): Existing EPUB files to update in place instead of asking for URLs. Defaults to None.
+        stream (bool, optional): Whether to write each chapter to disk as soon as it is ready instead of building the whole book in memory. Defaults to False.
+        rate_limit (bool, optional): Whether to pace requests with FictionLiveHTTP's adaptive per-host rate limiter. Defaults to True.
+        image_options (dict, optional): Embed the cover and images in the books, with these FictionLiveImages.ImagePipeline options. Defaults to None, linking to the images online.
+        metrics_dir (str, optional): Write a JSON trace and Prometheus metrics of every book to this directory (see FictionLiveMetrics). Defaults to None.
+        record_dir (str, optional): Record every API response into this fixture directory (see FictionLiveHTTP.install_recorder). Defaults to None.
+        replay_url (str, optional): Send API requests to this FictionLiveReplay server instead of fiction.live. Defaults to None.
 
     Returns:
         None
@@ -945,6 +2166,25 @@ def main():  # sourcery skip: hoist-statement-from-loop
         The book title contains invalid characters. Invalid characters will be replaced with '-'
         Writing EPUB file...
         EPUB file written to C:\Users\username\Desktop\Folder\story-1.epub"""
+    transfer_stats = FictionLiveHTTP.install_transport(session)
+    if cache_dir is not None:
+        FictionLiveHTTP.install_cache(session, cache_dir)
+    if rate_limit:
+        FictionLiveHTTP.install_rate_limiter(session)
+    if record_dir is not None:
+        FictionLiveHTTP.install_recorder(session, record_dir)
+    if replay_url is not None:
+        FictionLiveHTTP.install_replay(session, replay_url)
+
+    if update_paths:
+        for count, epub_path in enumerate(update_paths):
+            print(f"Updating {count+1}/{len(update_paths)} {epub_path}")
+            with FictionLiveMetrics.book_trace(metrics_dir, transfer_stats), image_pipeline(image_options) as images:
+                if book := update_book(epub_path, jobs, stream, images):
+                    write_book(book, epub_path)
+            print_transfer_stats(transfer_stats)
+        return
+
     # Get the URL(s) of the Table of Contents or Chapter
     story_urls = input("Enter Story URL(s): ")
     if story_urls == "test1":
@@ -963,15 +2203,92 @@ def main():  # sourcery skip: hoist-statement-from-loop
 
     # Loop through the URLs and create an EPUB file for each one
     for count, book_urls in enumerate(valid_urls):
-        book_data = get_book_info(book_urls['meta'])
-        book = epub.EpubBook()
-        if book_data is None:
+        with FictionLiveMetrics.book_trace(metrics_dir, transfer_stats):
+            book_data = get_book_info(book_urls['meta'])
+            book = epub.EpubBook()
+            if book_data is None:
+                del book
+                continue
+            stream_path = os.path.join(dir_path, f"{book_data['_id']}.epub.part") if stream else None
+            with image_pipeline(image_options) as images:
+                book = create_book(book_data, count+1, len(valid_urls), jobs, stream_path=stream_path, images=images)
+            save_book(book, dir_path)
             del book
-            continue
-        book = create_book(book_data, count+1, len(valid_urls))
-        save_book(book, dir_path)
-        del book
+        print_transfer_stats(transfer_stats)
+
+def add_image_arguments(parser):
+    """
+    Adds the image embedding options to an argument parser; see image_options_from_arguments.
+
+    Args:
+        parser (argparse.ArgumentParser): The parser.
+    """
+    parser.add_argument('--embed-images', action='store_true',
+                        help="download the cover and every image into the EPUB, so it works offline")
+    parser.add_argument('--image-max-size', type=int, metavar='PX',
+                        help="shrink embedded images to fit within PX pixels (needs Pillow)")
+    parser.add_argument('--image-quality', type=int, metavar='Q',
+                        help="re-encode embedded images as JPEG at quality Q, 1-95, when that makes them smaller (needs Pillow)")
+    parser.add_argument('--image-cache-dir', metavar='DIR', default=FictionLiveImages.IMAGE_CACHE_DIR,
+                        help=f"directory of the persistent image cache (default: {FictionLiveImages.IMAGE_CACHE_DIR})")
+    parser.add_argument('--no-image-cache', dest='image_cache_dir', action='store_const', const=None,
+                        help="don't read or write the image cache")
+
+def image_options_from_arguments(args):
+    """
+    Returns the ImagePipeline options given on the command line.
+
+    Args:
+        args (argparse.Namespace): Options parsed by a parser with add_image_arguments.
+
+    Returns:
+        dict: The options, or None if images aren't to be embedded.
+    """
+    if not (args.embed_images or args.image_max_size or args.image_quality):
+        return None
+    return {'cache_dir': args.image_cache_dir, 'max_size': args.image_max_size, 'quality': args.image_quality}
+
+def parse_arguments(argv=None):
+    """
+    Parses the command line options.
+
+    Args:
+        argv (list, optional): The arguments to parse. Defaults to sys.argv[1:].
+
+    Returns:
+        argparse.Namespace: The parsed options.
+    """
+    parser = argparse.ArgumentParser(description="Create EPUB files from fiction.live stories.")
+    parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS,
+                        help=f"number of chapters to download at once (default: {DEFAULT_JOBS})")
+    parser.add_argument('--cache-dir', default=FictionLiveHTTP.CACHE_DIR,
+                        help=f"directory of the on-disk HTTP cache (default: {FictionLiveHTTP.CACHE_DIR})")
+    parser.add_argument('--no-cache', dest='cache_dir', action='store_const', const=None,
+                        help="don't read or write the on-disk HTTP cache")
+    parser.add_argument('--no-rate-limit', dest='rate_limit', action='store_false',
+                        help="send requests as fast as the jobs allow instead of adapting to how the servers respond")
+    parser.add_argument('--parser', choices=["lxml", "html5lib"], default=PARSER_BACKEND,
+                        help=f"HTML parser for chapter text; lxml falls back to html5lib for malformed chunks (default: {PARSER_BACKEND})")
+    parser.add_argument('--stream', action='store_true',
+                        help="write chapters to the EPUB file as they are ready, keeping memory use flat for very large stories")
+    add_image_arguments(parser)
+    parser.add_argument('--metrics-dir', metavar='DIR',
+                        help="write a JSON trace (<story id>.trace.json) and Prometheus metrics (<story id>.prom) of every book to DIR")
+    parser.add_argument('--record', metavar='DIR', dest='record_dir',
+                        help="save every API response in DIR, for FictionLiveReplay.py to serve")
+    parser.add_argument('--replay', metavar='URL', dest='replay_url',
+                        help="send API requests to a FictionLiveReplay.py server at URL instead of fiction.live (combine with --no-cache)")
+    parser.add_argument('-u', '--update', nargs='+', metavar='EPUB', dest='update_paths',
+                        help="update existing EPUB files in place, downloading only new or changed chapters")
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
 
 # Run the main function if the script is run directly
 if __name__ == "__main__":
-    main()
+    args = parse_arguments()
+    PARSER_BACKEND = args.parser
+    main(jobs=args.jobs, cache_dir=args.cache_dir, update_paths=args.update_paths, stream=args.stream, rate_limit=args.rate_limit,
+         image_options=image_options_from_arguments(args), metrics_dir=args.metrics_dir,
+         record_dir=args.record_dir, replay_url=args.replay_url)
@@ -0,0 +1,358 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from colorama import Fore, Style
+import FictionLiveAPI
+import FictionLiveHTTP
+import FictionLiveLibrary
+import FictionLiveMetrics
+
+DEFAULT_WORKERS = 4 # stories packaged at once, each in its own process
+EXISTS_POLICIES = ("skip", "overwrite", "rename") # what to do when a story's EPUB file already exists
+MANIFEST_NAME = "manifest.json"
+transfer_stats = None # the worker process's FictionLiveHTTP.TransferStats, set by init_worker
+library = None # the worker process's FictionLiveLibrary.Library, set by init_worker when the batch keeps a library
+
+def read_url_list(list_path):
+    """
+    Reads story URLs from a file, one per line. Blank lines and lines starting with '#' are ignored.
+
+    Args:
+        list_path (str): The path of the URL list.
+
+    Returns:
+        list: The URLs, in file order.
+    """
+    with open(list_path, encoding='utf-8-sig') as list_file:
+        return [line.strip() for line in list_file if line.strip() and not line.lstrip().startswith('#')]
+
+def reserve_epub_path(dir_path, title, on_exists):
+    """
+    Picks the file a story will be written to, without asking anyone.
+
+    The file is created empty straight away (except when overwriting), so two workers can never pick the
+    same name; write_book replaces it with the finished book.
+
+    Args:
+        dir_path (str): The output directory.
+        title (str): The book title, already passed through FictionLiveAPI.clean_title.
+        on_exists (str): One of EXISTS_POLICIES.
+
+    Returns:
+        str: The path to write the book to, or None if the story should be skipped.
+
+    Examples:
+        >>> reserve_epub_path("out", "Story_Title", "rename") # out/Story_Title.epub already exists
+        'out/Story_Title_2.epub'
+    """
+    stem = os.path.join(dir_path, title.replace(' ', '_'))
+    epub_path = f"{stem}.epub"
+    if on_exists == "overwrite":
+        return epub_path
+    number = 1
+    while True:
+        try:
+            with open(epub_path, 'x'):
+                return epub_path
+        except FileExistsError:
+            if on_exists == "skip":
+                return None
+        number += 1
+        epub_path = f"{stem}_{number}.epub"
+
+def init_worker(cache_dir, parser_backend, rate_limit=True, record_dir=None, replay_url=None, library_path=None):
+    """
+    Sets up a worker process: its own connection pools, transfer counts, HTTP cache, rate limiter and parser backend,
+    kept for every story it packages, the recorder or stand-in server if responses are recorded or replayed, and
+    its connection to the library if there is one.
+
+    Each worker adapts its own rate limits, so the workers together back off as soon as a server pushes back on any of them.
+    """
+    global transfer_stats, library
+    FictionLiveAPI.PARSER_BACKEND = parser_backend
+    transfer_stats = FictionLiveHTTP.install_transport(FictionLiveAPI.session)
+    if cache_dir is not None:
+        FictionLiveHTTP.install_cache(FictionLiveAPI.session, cache_dir)
+    if rate_limit:
+        FictionLiveHTTP.install_rate_limiter(FictionLiveAPI.session)
+    if record_dir is not None:
+        FictionLiveHTTP.install_recorder(FictionLiveAPI.session, record_dir)
+    if replay_url is not None:
+        FictionLiveHTTP.install_replay(FictionLiveAPI.session, replay_url)
+    if library_path is not None:
+        library = FictionLiveLibrary.Library(library_path)
+
+def plan_library_build(book_data, dir_path, title, on_exists):
+    """
+    Decides how to build a story in a batch that keeps a library, from its metadata alone (see FictionLiveLibrary.Library.check).
+
+    A story already in the library is rebuilt in place at its recorded path, whatever `on_exists` says, reusing
+    the chapters of the existing book that are finished unless its word count changed with no new chunks. A
+    story that isn't in the library goes through reserve_epub_path like in any batch, except that an existing
+    book of the same story that would be skipped is updated and recorded instead, so a library can be started
+    on an output directory filled by earlier runs.
+
+    Args:
+        book_data (dict): The story metadata.
+        dir_path (str): The output directory.
+        title (str): The book title, already passed through FictionLiveAPI.clean_title.
+        on_exists (str): One of EXISTS_POLICIES.
+
+    Returns:
+        tuple: (decision, path): FictionLiveLibrary.UNCHANGED and the book's path, UPDATE or REBUILD and the
+               path of the book to replace, NEW and the path reserved for the book, or NEW and None if the
+               story should be skipped.
+    """
+    decision, record = library.check(book_data)
+    if decision != FictionLiveLibrary.NEW:
+        return decision, record['output_path']
+    if (epub_path := reserve_epub_path(dir_path, title, on_exists)) is not None:
+        return decision, epub_path
+    epub_path = os.path.join(dir_path, f"{title.replace(' ', '_')}.epub")
+    with contextlib.suppress(Exception):
+        if (FictionLiveAPI.read_existing_book(epub_path) or {}).get('story_id') == book_data['_id']:
+            return FictionLiveLibrary.UPDATE, epub_path
+    return decision, None
+
+def package_story(url, dir_path, on_exists, jobs, stream, progress=None, image_options=None, metrics_dir=None, book_data=None):
+    """
+    Downloads one story and writes its EPUB file. Runs in a worker process.
+
+    Each worker packages one story at a time, so FictionLiveAPI's module state (the session and the
+    achievement index) is never shared between stories being downloaded at once.
+
+    Args:
+        url (str): The story URL.
+        dir_path (str): The output directory.
+        on_exists (str): One of EXISTS_POLICIES.
+        jobs (int): The number of chapters to download at once.
+        stream (bool): Whether to stream each chapter to disk as it is ready.
+        progress (callable, optional): Called with a dict of updated fields as the story progresses:
+            'status' when it starts, 'title' and 'total' (items to download) once the metadata is in,
+            then 'done' and 'bytes' after every chapter. It must be picklable. Defaults to None.
+        image_options (dict, optional): Embed the story's images, with these FictionLiveImages.ImagePipeline options. Defaults to None.
+        metrics_dir (str, optional): Write the story's JSON trace and Prometheus metrics to this directory (see FictionLiveMetrics). Defaults to None.
+        book_data (dict, optional): The story metadata, if it was just fetched (e.g. by FictionLiveWatch), to save fetching it again. Defaults to None.
+
+    Returns:
+        dict: The story's manifest entry, including what its requests cost per FictionLiveHTTP.request_class.
+
+    With a library (see init_worker), a story that hasn't changed since it was recorded is left alone ("unchanged")
+    right after its metadata comes in, and one that has is rebuilt in place ("updated"), reusing what it can
+    (see plan_library_build). Every book written is recorded in the library.
+    """
+    started = time.perf_counter()
+    entry = {'url': url, 'status': None, 'output_path': None, 'timings': {}}
+    epub_path = None
+    decision = FictionLiveLibrary.NEW
+    report = progress or (lambda update: None)
+    report({'status': "running"})
+    if transfer_stats is not None:
+        transfer_stats.reset()
+    # the per-chapter progress messages of several stories at once would be unreadable
+    with contextlib.redirect_stdout(io.StringIO()), FictionLiveMetrics.book_trace(metrics_dir, transfer_stats):
+        try:
+            url_match = re.match(FictionLiveAPI.STORY_URL_PATTERN, url)
+            if not url_match:
+                entry.update(status="invalid", error="Not a fiction.live story URL")
+                return entry
+            entry['story_id'] = url_match[2]
+            if book_data is None:
+                book_data = FictionLiveAPI.get_book_info(f"https://fiction.live/api/node/{url_match[2]}")
+            else:
+                FictionLiveMetrics.annotate(story=url_match[2])
+                FictionLiveAPI.use_book_info(book_data)
+                FictionLiveHTTP.note_story_update(FictionLiveAPI.session, url_match[2], book_data.get('cht'))
+            entry['timings']['metadata'] = time.perf_counter() - started
+            if book_data is None:
+                entry.update(status="failed", error="Story metadata could not be fetched")
+                return entry
+            title = FictionLiveAPI.clean_title(book_data['t'])
+            entry['title'] = book_data['t']
+            if library is not None:
+                decision, epub_path = plan_library_build(book_data, dir_path, title, on_exists)
+                if decision == FictionLiveLibrary.UNCHANGED: # nothing else to download or parse
+                    entry.update(status="unchanged", output_path=epub_path)
+                    return entry
+            else:
+                epub_path = reserve_epub_path(dir_path, title, on_exists)
+            chapters_list, appendices_list, routes_list = FictionLiveAPI.get_book_map(book_data)
+            entry.update(chapters=len(chapters_list), appendices=len(appendices_list), routes=len(routes_list))
+            report({'title': book_data['t'], 'total': len(chapters_list) + len(appendices_list) + len(routes_list)})
+
+            if epub_path is None:
+                entry.update(status="skipped", output_path=os.path.join(dir_path, f"{title.replace(' ', '_')}.epub"))
+                return entry
+            existing = None
+            if decision == FictionLiveLibrary.UPDATE:
+                existing = FictionLiveAPI.read_existing_book(epub_path)
+            reuse = FictionLiveAPI.find_reusable_chapters(existing, (chapters_list, appendices_list, routes_list)) if existing else None
+
+            build_started = time.perf_counter()
+            stream_path = os.path.join(dir_path, f"{book_data['_id']}.{os.getpid()}.epub.part") if stream else None
+            added = {'done': 0, 'bytes': 0}
+            def chapter_added(size):
+                added['done'] += 1
+                added['bytes'] += size
+                report(dict(added))
+            with FictionLiveAPI.image_pipeline(image_options) as images:
+                if images and existing:
+                    images.adopt(existing['book'])
+                book = FictionLiveAPI.create_book(book_data, 1, 1, jobs, reuse, stream_path, chapter_added, images)
+            if images:
+                entry['images'] = dict(images.stats)
+            book.set_title(title)
+            entry['timings']['build'] = time.perf_counter() - build_started
+            write_started = time.perf_counter()
+            FictionLiveAPI.write_book(book, epub_path)
+            entry['timings']['write'] = time.perf_counter() - write_started
+            entry.update(status="written" if decision == FictionLiveLibrary.NEW else "updated", output_path=epub_path)
+            if reuse is not None:
+                entry['reused'] = len(reuse)
+            if library is not None:
+                meta = FictionLiveAPI.book_meta(book)
+                changed = library.record(book_data, epub_path, json.loads(meta['fictionlive:sources']), json.loads(meta['fictionlive:hashes']))
+                entry['changed_chapters'] = len(changed)
+        except Exception as e:
+            entry.update(status="failed", error=f"{type(e).__name__}: {e}", traceback=traceback.format_exc())
+            if epub_path and decision == FictionLiveLibrary.NEW and on_exists != "overwrite" and os.path.isfile(epub_path) and os.path.getsize(epub_path) == 0:
+                os.remove(epub_path) # give back the reserved name
+        finally:
+            entry['timings']['total'] = time.perf_counter() - started
+            if transfer_stats is not None:
+                entry['transfer'] = transfer_stats.snapshot()
+    return entry
+
+def write_manifest(manifest_path, manifest):
+    """Writes the manifest, replacing the previous one only once the new one is complete."""
+    temp_path = f"{manifest_path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(temp_path, manifest_path)
+
+def run_batch(urls, dir_path, on_exists="skip", workers=DEFAULT_WORKERS, jobs=FictionLiveAPI.DEFAULT_JOBS,
+              cache_dir=FictionLiveHTTP.CACHE_DIR, parser_backend=FictionLiveAPI.PARSER_BACKEND, stream=False,
+              manifest_path=None, rate_limit=True, image_options=None, metrics_dir=None, record_dir=None, replay_url=None,
+              library_path=None):
+    """
+    Packages every story in the list on a pool of worker processes, one story per worker at a time.
+
+    The manifest is rewritten as each story finishes, so an interrupted run still records what it did.
+    Its stories are listed in the order of `urls`.
+
+    Args:
+        urls (list): The story URLs.
+        dir_path (str): The output directory.
+        on_exists (str, optional): One of EXISTS_POLICIES. Defaults to "skip".
+        workers (int, optional): The number of worker processes. Defaults to DEFAULT_WORKERS.
+        jobs (int, optional): The number of chapters each worker downloads at once. Defaults to FictionLiveAPI.DEFAULT_JOBS.
+        cache_dir (str, optional): The directory of the on-disk HTTP cache, shared by the workers, or None. Defaults to FictionLiveHTTP.CACHE_DIR.
+        parser_backend (str, optional): The make_soup backend. Defaults to FictionLiveAPI.PARSER_BACKEND.
+        stream (bool, optional): Whether to stream each chapter to disk as it is ready. Defaults to False.
+        manifest_path (str, optional): Where to write the manifest. Defaults to MANIFEST_NAME in the output directory.
+        rate_limit (bool, optional): Whether the workers pace their requests with the adaptive rate limiter. Defaults to True.
+        image_options (dict, optional): Embed the stories' images, with these FictionLiveImages.ImagePipeline options. Defaults to None.
+        metrics_dir (str, optional): Write a JSON trace and Prometheus metrics of every story to this directory. Defaults to None.
+        record_dir (str, optional): Record every API response into this fixture directory. Defaults to None.
+        replay_url (str, optional): Send API requests to this FictionLiveReplay server instead of fiction.live. Defaults to None.
+        library_path (str, optional): Keep a FictionLiveLibrary in this file, to leave stories that haven't changed
+                                      since the last run alone and update the others in place. Defaults to None.
+
+    Returns:
+        dict: The manifest.
+    """
+    manifest_path = manifest_path or os.path.join(dir_path, MANIFEST_NAME)
+    manifest = {'started': time.strftime("%Y-%m-%dT%H:%M:%S"), 'output_dir': dir_path, 'on_exists': on_exists, 'stories': [None] * len(urls)}
+    counts = dict.fromkeys(("written", "updated", "unchanged", "skipped", "failed", "invalid"), 0)
+    with ProcessPoolExecutor(max_workers=max(1, workers), initializer=init_worker, initargs=(cache_dir, parser_backend, rate_limit, record_dir, replay_url, library_path)) as executor:
+        futures = {executor.submit(package_story, url, dir_path, on_exists, jobs, stream, None, image_options, metrics_dir): count for count, url in enumerate(urls)}
+        for done, future in enumerate(as_completed(futures)):
+            entry = future.result()
+            manifest['stories'][futures[future]] = entry
+            counts[entry['status']] += 1
+            color = {"written": Fore.GREEN, "updated": Fore.GREEN, "unchanged": Fore.YELLOW, "skipped": Fore.YELLOW}.get(entry['status'], Fore.RED)
+            print(f"{done+1}/{len(urls)} {color}{entry['status']}{Style.RESET_ALL} {entry.get('title', entry['url'])}"
+                  f" ({entry['timings']['total']:.1f}s){': ' + entry['error'] if 'error' in entry else ''}")
+            write_manifest(manifest_path, manifest)
+    manifest['finished'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    manifest['counts'] = counts
+    write_manifest(manifest_path, manifest)
+    print(", ".join(f"{count} {status}" for status, count in counts.items()) + f". Manifest written to {manifest_path}")
+    return manifest
+
+def parse_arguments(argv=None):
+    """
+    Parses the command line options.
+
+    Args:
+        argv (list, optional): The arguments to parse. Defaults to sys.argv[1:].
+
+    Returns:
+        argparse.Namespace: The parsed options.
+    """
+    parser = argparse.ArgumentParser(description="Package many fiction.live stories into EPUB files without prompting.")
+    parser.add_argument('url_list', help="file with one story URL per line ('#' starts a comment)")
+    parser.add_argument('output_dir', help="directory to write the EPUB files and the manifest to")
+    parser.add_argument('--on-exists', choices=EXISTS_POLICIES, default="skip",
+                        help="what to do when a story's EPUB file already exists: skip it, overwrite it, or write to a numbered name (default: skip)")
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS,
+                        help=f"number of stories to package at once, each in its own process (default: {DEFAULT_WORKERS})")
+    parser.add_argument('-j', '--jobs', type=int, default=FictionLiveAPI.DEFAULT_JOBS,
+                        help=f"number of chapters each worker downloads at once (default: {FictionLiveAPI.DEFAULT_JOBS})")
+    parser.add_argument('--manifest', help=f"where to write the JSON manifest (default: OUTPUT_DIR/{MANIFEST_NAME})")
+    parser.add_argument('--library', nargs='?', const="", metavar='PATH',
+                        help=f"keep an SQLite index of the books built (default PATH: OUTPUT_DIR/{FictionLiveLibrary.LIBRARY_NAME}); "
+                             "stories that haven't changed since then are left alone, the others are updated in place")
+    parser.add_argument('--cache-dir', default=FictionLiveHTTP.CACHE_DIR,
+                        help=f"directory of the on-disk HTTP cache (default: {FictionLiveHTTP.CACHE_DIR})")
+    parser.add_argument('--no-cache', dest='cache_dir', action='store_const', const=None,
+                        help="don't read or write the on-disk HTTP cache")
+    parser.add_argument('--no-rate-limit', dest='rate_limit', action='store_false',
+                        help="send requests as fast as the jobs allow instead of adapting to how the servers respond")
+    parser.add_argument('--parser', choices=["lxml", "html5lib"], default=FictionLiveAPI.PARSER_BACKEND,
+                        help=f"HTML parser for chapter text (default: {FictionLiveAPI.PARSER_BACKEND})")
+    FictionLiveAPI.add_image_arguments(parser)
+    parser.add_argument('--metrics-dir', metavar='DIR',
+                        help="write a JSON trace (<story id>.trace.json) and Prometheus metrics (<story id>.prom) of every story to DIR")
+    parser.add_argument('--record', metavar='DIR', dest='record_dir',
+                        help="save every API response in DIR, for FictionLiveReplay.py to serve")
+    parser.add_argument('--replay', metavar='URL', dest='replay_url',
+                        help="send API requests to a FictionLiveReplay.py server at URL instead of fiction.live (combine with --no-cache)")
+    parser.add_argument('--stream', action='store_true',
+                        help="write chapters to the EPUB files as they are ready")
+    args = parser.parse_args(argv)
+    if args.workers < 1 or args.jobs < 1:
+        parser.error("--workers and --jobs must be at least 1")
+    if not os.path.isdir(args.output_dir):
+        parser.error(f"{args.output_dir} is not a directory")
+    if args.library == "":
+        args.library = os.path.join(args.output_dir, FictionLiveLibrary.LIBRARY_NAME)
+    return args
+
+def main(argv=None):
+    """
+    Runs a batch from the command line, exiting with status 1 if any story failed.
+
+    Examples:
+        python FictionLiveBatch.py stories.txt out --on-exists rename --workers 8
+        1/3 written Story One (12.4s)
+        2/3 skipped Story Two (0.8s)
+        3/3 failed https://fiction.live/stories//xxxxxxxxxxxxxxxxx (0.5s): Story metadata could not be fetched
+        1 written, 0 updated, 0 unchanged, 1 skipped, 1 failed, 0 invalid. Manifest written to out/manifest.json
+    """
+    args = parse_arguments(argv)
+    manifest = run_batch(read_url_list(args.url_list), args.output_dir, args.on_exists, args.workers, args.jobs,
+                         args.cache_dir, args.parser, args.stream, args.manifest, args.rate_limit,
+                         FictionLiveAPI.image_options_from_arguments(args), args.metrics_dir,
+                         args.record_dir, args.replay_url, args.library)
+    sys.exit(1 if manifest['counts']['failed'] else 0)
+
+if __name__ == "__main__":
+    main()
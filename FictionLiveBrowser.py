@@ -0,0 +1,193 @@
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 3 # Chrome instances loading pages at the same time
+DEFAULT_MAX_PAGES = 50 # pages a driver loads before it is replaced, since Chrome's memory only grows
+PROFILE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "fictionlive", "chrome") # profiles for lean drivers
+# Requests a lean driver never makes: the scraper only keeps the page's HTML, so images, fonts, media and
+# analytics would be downloaded only to be thrown away
+BLOCKED_URLS = [
+    "*.png*", "*.jpg*", "*.jpeg*", "*.gif*", "*.webp*", "*.svg*", "*.ico*", # images
+    "*.woff*", "*.ttf*", "*.otf*", "*.eot*", # fonts
+    "*.mp4*", "*.webm*", "*.mp3*", "*.ogg*", "*.wav*", # media
+    "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*", "*googlesyndication.com*", # analytics and ads
+]
+
+def chrome_options(lean=False, profile_dir=None):
+    """
+    Returns the options a pooled Chrome is started with.
+
+    Args:
+        lean (bool, optional): Run headless. Defaults to False.
+        profile_dir (str, optional): A persistent user data directory, whose disk cache keeps static
+            assets between runs. Defaults to a throwaway profile.
+
+    Returns:
+        webdriver.ChromeOptions: Chrome without DevTools messages in the console, logging network
+            events so transferred_bytes can add them up.
+    """
+    options = webdriver.ChromeOptions()
+    options.add_argument("--log-level=3")  # 3 corresponds to WARNING level
+    options.add_experimental_option('excludeSwitches', ['enable-logging'])
+    options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+    if lean:
+        options.add_argument("--headless=new")
+    if profile_dir:
+        options.add_argument(f"--user-data-dir={profile_dir}")
+        options.add_argument(f"--disk-cache-dir={os.path.join(profile_dir, 'cache')}")
+    return options
+
+def start_driver(slot, lean=False, profile_dir=PROFILE_DIR):
+    """
+    Starts a Chrome WebDriver for a DriverPool.
+
+    A lean driver runs headless with BLOCKED_URLS blocked through the DevTools protocol, and keeps its
+    profile in `profile_dir`. Each pool slot gets a profile of its own, since Chrome locks the one it runs in.
+
+    Args:
+        slot (int): The pool slot the driver fills, from 0 up to the pool size.
+        lean (bool, optional): Start a lean driver. Defaults to False, a normal minimized window.
+        profile_dir (str, optional): Where lean drivers keep their profiles. Defaults to PROFILE_DIR.
+
+    Returns:
+        webdriver.Chrome: The driver.
+    """
+    if not lean:
+        driver = webdriver.Chrome(options=chrome_options())
+        driver.minimize_window() # Minimize the browser window
+        return driver
+    driver = webdriver.Chrome(options=chrome_options(lean=True, profile_dir=os.path.join(profile_dir, f"slot-{slot}")))
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URLS})
+    return driver
+
+def transferred_bytes(driver):
+    """
+    Adds up the bytes received over the network since the last call, from the driver's performance log.
+
+    Args:
+        driver (webdriver.Chrome): A driver started with chrome_options().
+
+    Returns:
+        int: The encoded size of every response finished since the last call, headers included.
+            Responses served from the disk cache and blocked requests cost nothing.
+    """
+    total = 0
+    for entry in driver.get_log('performance'):
+        message = json.loads(entry['message'])['message']
+        if message['method'] == 'Network.loadingFinished':
+            total += int(message['params'].get('encodedDataLength', 0))
+        elif message['method'] == 'Network.webSocketFrameReceived':
+            total += len(message['params']['response'].get('payloadData', ""))
+    return total
+
+class DriverPool:
+    """
+    A pool of Chrome WebDrivers shared by everything the scraper loads, across all the stories of a run.
+
+    Drivers are started as they are first needed, up to `size` of them, and handed out one page load at a
+    time by driver(). Each fills one of `size` numbered slots, which is passed to the factory. A driver is quit and replaced after `max_pages` loads, and straight away if a load
+    fails with it, so a long batch neither grows Chrome's memory without bound nor keeps a broken session.
+
+    Args:
+        size (int, optional): The most drivers to run at once. Defaults to DEFAULT_POOL_SIZE.
+        max_pages (int, optional): Pages loaded by a driver before it is recycled. Defaults to DEFAULT_MAX_PAGES.
+        factory (callable, optional): Starts a new driver in the slot it is given. Defaults to start_driver.
+
+    Examples:
+        >>> with DriverPool(size=4) as pool:
+        ...     with pool.driver() as driver:
+        ...         driver.get(url)
+    """
+    def __init__(self, size=DEFAULT_POOL_SIZE, max_pages=DEFAULT_MAX_PAGES, factory=start_driver):
+        self.size = max(1, size)
+        self.max_pages = max_pages
+        self.factory = factory
+        self._idle = [] # used as a stack: the most recently used driver has the warmest cache
+        self._pages = {} # driver -> pages loaded with it, for every running driver
+        self._slots = {} # driver -> the slot it fills
+        self._free_slots = list(range(self.size))
+        self._available = threading.Condition()
+        self._closed = False
+
+    def _acquire(self):
+        with self._available:
+            while not self._idle:
+                if self._free_slots:
+                    slot = self._free_slots.pop(0)
+                    break
+                self._available.wait()
+            else:
+                return self._idle.pop()
+        try:
+            driver = self.factory(slot)
+        except BaseException:
+            with self._available:
+                self._free_slots.append(slot)
+                self._available.notify()
+            raise
+        with self._available:
+            self._pages[driver] = 0
+            self._slots[driver] = slot
+        return driver
+
+    def _retire(self, driver):
+        try:
+            driver.quit() # before its slot is reused, so the slot's profile is unlocked
+        except WebDriverException as e:
+            logger.warning(f"Could not quit WebDriver: {e}")
+        with self._available:
+            self._pages.pop(driver, None)
+            self._free_slots.append(self._slots.pop(driver))
+            self._available.notify() # its slot can be taken by a new driver
+
+    @contextmanager
+    def driver(self):
+        """
+        Lends out a driver for one page load, starting one if none are idle and the pool isn't full.
+
+        Yields:
+            webdriver.Chrome: The driver, for the caller's use until the with block ends.
+        """
+        if self._closed:
+            raise RuntimeError("The driver pool is closed")
+        driver = self._acquire()
+        try:
+            yield driver
+        except WebDriverException:
+            self._retire(driver) # the session may be dead, so don't hand it out again
+            raise
+        except BaseException:
+            self._release(driver)
+            raise
+        else:
+            self._release(driver)
+
+    def _release(self, driver):
+        with self._available:
+            self._pages[driver] += 1
+            if not self._closed and self._pages[driver] < self.max_pages:
+                self._idle.append(driver)
+                self._available.notify()
+                return
+        self._retire(driver)
+
+    def close(self):
+        """Quits every idle driver; drivers still lent out are quit when they are returned."""
+        with self._available:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for driver in idle:
+            self._retire(driver)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,89 @@
+import os
+import zipfile
+from ebooklib import epub
+
+class StreamingEpubWriter(epub.EpubWriter):
+    """
+    An EpubWriter that writes the EPUB file as the book is built instead of all at once.
+
+    The mimetype and container are written by start(), each item by write_item() as soon as it is added,
+    and the OPF, NCX and nav by finish(), from the metadata, TOC and (by then empty) items left in the book.
+
+    Args:
+        name (str): The path of the EPUB file to write.
+        book (epub.EpubBook): The book being written.
+        options (dict, optional): EpubWriter options. Defaults to None.
+    """
+    def start(self):
+        """Opens the zip file and writes the mimetype and container, which must come first."""
+        self.out = zipfile.ZipFile(self.file_name, 'w', zipfile.ZIP_DEFLATED)
+        self.out.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        self._write_container()
+
+    def write_item(self, item):
+        """
+        Writes an item into the zip file, then drops its content so only its manifest entry stays in memory.
+
+        Args:
+            item (epub.EpubItem): The item to write.
+        """
+        self.out.writestr(f"{self.book.FOLDER_NAME}/{item.file_name}", item.get_content())
+        item.content = b""
+
+    def finish(self):
+        """Writes the OPF, NCX and nav documents and closes the zip file."""
+        self._write_opf()
+        for item in self.book.get_items():
+            if isinstance(item, epub.EpubNcx):
+                self.out.writestr(f"{self.book.FOLDER_NAME}/{item.file_name}", self._get_ncx())
+            elif isinstance(item, epub.EpubNav):
+                self.out.writestr(f"{self.book.FOLDER_NAME}/{item.file_name}", self._get_nav(item))
+        self.out.close()
+
+    def abort(self):
+        """Closes and deletes the unfinished zip file."""
+        self.out.close()
+        os.remove(self.file_name)
+
+class StreamingEpubBook(epub.EpubBook):
+    """
+    An EpubBook that writes its chapters to disk as they are added, so memory doesn't grow with the size of the story.
+
+    It is used exactly like an EpubBook, except that it is written out with finish() instead of epub.write_epub.
+    Until then the book is kept in a temporary file next to its final location.
+
+    Args:
+        part_path (str): The path of the temporary file to write the book to.
+
+    Examples:
+        >>> book = StreamingEpubBook("Story_Title.epub.part")
+        >>> book.add_item(chapter) # written to Story_Title.epub.part straight away
+        >>> book.finish("Story_Title.epub")
+    """
+    def __init__(self, part_path):
+        super().__init__()
+        self.part_path = part_path
+        # the nav page-list would need every chapter read back; fiction.live chapters have no page markers anyway
+        self.writer = StreamingEpubWriter(part_path, self, {'epub3_pages': False})
+        self.writer.start()
+
+    def add_item(self, item):
+        item = super().add_item(item)
+        # the navigation documents describe the whole book, so they can only be written at the end
+        if item.manifest and not isinstance(item, (epub.EpubNav, epub.EpubNcx)):
+            self.writer.write_item(item)
+        return item
+
+    def finish(self, epub_path):
+        """
+        Writes the rest of the book and moves it to its final location.
+
+        Args:
+            epub_path (str): The path of the EPUB file.
+        """
+        self.writer.finish()
+        os.replace(self.part_path, epub_path)
+
+    def abort(self):
+        """Deletes the unfinished book."""
+        self.writer.abort()
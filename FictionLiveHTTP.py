@@ -0,0 +1,788 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import DEFAULT_ACCEPT_ENCODING, get_encoding_from_headers
+from urllib.parse import urlparse
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "fictionlive", "http")
+CACHE_MAX_BYTES = 512 * 1024 * 1024 # least recently used responses are evicted past this size
+# seconds a cached response is served without asking the server, per URL class. 0 = always revalidate.
+CACHE_TTLS = {
+    'node': 0,                       # story metadata, the source of 'cht' -- must always be current
+    'open_range': 0,                 # the last chapter range, which is still being written to
+    'closed_range': 30 * 24 * 3600,  # chapter ranges that end before the story's last update
+    'route': 24 * 3600,              # route chapters, which have no end timestamp to check
+}
+
+# Per-host request limits, adapted AIMD-style by HostLimiter: 'rate' requests per second with bursts of up to
+# 'burst', and 'concurrency' requests in flight, each allowed to grow to its 'max_' value while the host keeps up
+# and halved when it pushes back. The None entry covers every other host, such as the image CDNs.
+RATE_LIMITS = {
+    'fiction.live': {'rate': 8, 'max_rate': 50, 'burst': 8, 'concurrency': 4, 'max_concurrency': 32},
+    None:           {'rate': 4, 'max_rate': 20, 'burst': 4, 'concurrency': 2, 'max_concurrency': 8},
+}
+MIN_RATE = 0.5 # never back off further than this many requests per second
+THROTTLE_STATUSES = {429, 502, 503, 504} # retried after backing off; any other 5xx only slows the host down
+MAX_RETRIES = 5
+LATENCY_FACTOR = 3 # latency this many times the host's usual latency is taken as a sign of overload
+DECREASE_COOLDOWN = 1.0 # seconds between decreases, so one overload isn't punished once per request in flight
+BASELINE_WEIGHT = 0.02 # weight of each response in the slow moving average the latency is compared against, after a plain mean of the first 50
+
+# Connections kept open per host, which should cover the most requests the rate limiter lets through to it
+# at once; the None entry covers every other host. Connections are reused across all the stories of a run.
+POOL_SIZES = {
+    'fiction.live': 32,
+    None: 10,
+}
+COMPRESSED_ENCODINGS = {'gzip', 'br', 'deflate', 'zstd'}
+COMPRESSIBLE_BYTES = 1024 # bodies bigger than this arriving without a Content-Encoding are reported
+IMAGE_URL_PATTERN = re.compile(r"^https?://(cdn\d*\.fiction\.live/|[^?#]*\.(png|jpe?g|gif|webp|svg)([?#]|$))", re.IGNORECASE)
+
+NODE_URL_PATTERN = re.compile(r"^https://fiction\.live/api/node/([A-Za-z0-9]+)")
+RANGE_URL_PATTERN = re.compile(r"^https://fiction\.live/api/anonkun/chapters/([A-Za-z0-9]+)/(\d+)/(\d+)/?")
+ROUTE_URL_PATTERN = re.compile(r"^https://fiction\.live/api/anonkun/route/([A-Za-z0-9]+)/chapters")
+RECORD_URL_PATTERN = re.compile(r"^https://fiction\.live/(api/(node|anonkun)/[^?#]*)$") # what install_recorder captures
+FIXTURE_SEGMENT_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+class ResponseCache:
+    """
+    A disk-backed cache of GET responses, keyed by URL.
+
+    Each response is stored in its own file as a line of JSON metadata followed by the raw body.
+    Files are touched on every hit, so eviction removes the least recently used responses first once
+    the cache grows past `max_bytes`.
+
+    Chapter ranges are only safe to keep while they end before the story's most recent chunk, so the
+    cache remembers the 'cht' of every story metadata document it sees (see note_story_update) and
+    treats any range reaching past it as open-ended.
+
+    Args:
+        cache_dir (str, optional): The directory to store responses in. Defaults to CACHE_DIR.
+        max_bytes (int, optional): The size the cache is trimmed back to. Defaults to CACHE_MAX_BYTES.
+        ttls (dict, optional): Overrides for the per-URL-class lifetimes in CACHE_TTLS.
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, ttls=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttls = {**CACHE_TTLS, **(ttls or {})}
+        self.story_horizons = {} # story id -> 'cht' from its latest metadata
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(stat.st_size for _, stat in self._entries())
+
+    def _path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + ".cache")
+
+    def _entries(self):
+        """Returns the path and os.stat_result of every cached response, stat'ed once each."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".cache"):
+                try:
+                    entries.append((entry.path, entry.stat()))
+                except FileNotFoundError: # evicted by another batch worker sharing the cache
+                    continue
+        return entries
+
+    def _discard(self, path):
+        """Removes a cache entry that can't be read back."""
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            self._size -= size
+
+    def url_class(self, url):
+        """
+        Sorts a URL into one of the CACHE_TTLS classes.
+
+        Args:
+            url (str): The URL to classify.
+
+        Returns:
+            str: The class name, or None if responses from this URL shouldn't be cached.
+        """
+        if NODE_URL_PATTERN.match(url):
+            return 'node'
+        if ROUTE_URL_PATTERN.match(url):
+            return 'route'
+        if range_match := RANGE_URL_PATTERN.match(url):
+            story_id, end = range_match[1], int(range_match[3])
+            horizon = self.story_horizons.get(story_id)
+            # without the story's metadata there's no telling whether the range is finished
+            return 'closed_range' if horizon is not None and end < horizon else 'open_range'
+        return None
+
+    def ttl_for(self, url):
+        """
+        Returns how many seconds a cached response from the URL may be used without revalidating it.
+
+        Args:
+            url (str): The URL of the response.
+
+        Returns:
+            float: The lifetime in seconds; 0 means the response must be revalidated with the server.
+        """
+        url_class = self.url_class(url)
+        return self.ttls.get(url_class, 0) if url_class else 0
+
+    def note_story_update(self, story_id, cht):
+        """
+        Records the most recent chunk time of a story, which decides which of its chapter ranges are closed.
+
+        Args:
+            story_id (str): The story id.
+            cht (int): The 'cht' timestamp from the story metadata.
+        """
+        with self._lock:
+            self.story_horizons[story_id] = cht
+
+    def get(self, url):
+        """
+        Looks up the cached response for a URL.
+
+        Args:
+            url (str): The URL of the response.
+
+        Returns:
+            dict: The cache entry with 'status', 'headers', 'stored' and 'body' keys, or None on a miss.
+        """
+        path = self._path(url)
+        try:
+            with open(path, 'rb') as cache_file:
+                meta, body = cache_file.read().split(b"\n", 1)
+            entry = json.loads(meta)
+            if not isinstance(entry, dict):
+                raise ValueError("cache entry metadata is not an object")
+            os.utime(path) # mark as recently used
+        except OSError:
+            return None
+        except ValueError: # truncated or corrupt, so it would never be read back either
+            logger.warning(f"Discarding corrupt cache entry for {url}")
+            self._discard(path)
+            return None
+        if entry.get('url') != url:
+            return None
+        entry['body'] = body
+        return entry
+
+    def set(self, url, status, headers, body, stored=None):
+        """
+        Stores a response, evicting old responses if the cache is over its size limit.
+
+        Args:
+            url (str): The URL of the response.
+            status (int): The HTTP status code.
+            headers (dict): The response headers.
+            body (bytes): The response body.
+            stored (float, optional): When the response was last confirmed fresh. Defaults to now.
+        """
+        meta = json.dumps({'url': url, 'status': status, 'headers': dict(headers), 'stored': stored or time.time()})
+        data = meta.encode('utf-8') + b"\n" + body
+        path = self._path(url)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp" # unique across threads and processes
+        try:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            with open(temp_path, 'wb') as cache_file:
+                cache_file.write(data)
+            os.replace(temp_path, path) # atomic, so readers never see half a file
+        except OSError as e:
+            logger.warning(f"Could not write cache entry for {url}: {e}")
+            return
+        with self._lock:
+            self._size += len(data) - old_size
+            over_limit = self._size > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used responses until the cache is back under its size limit.
+        """
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime)
+            self._size = sum(stat.st_size for _, stat in entries)
+            for path, stat in entries:
+                if self._size <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError: # another worker got to it first
+                    self._size -= stat.st_size
+                    continue
+                except OSError:
+                    continue
+                self._size -= stat.st_size
+
+class HostLimiter:
+    """
+    A token bucket and a concurrency window for one host, both adapted additive-increase/multiplicative-decrease.
+
+    Like TCP, the host starts in slow start, where every successful response adds a request per second to the
+    rate and a request to the window, doubling both about every second, until the host first pushes back.
+    From then on every success grows the rate by about `rate_increase` per second and the window by about one
+    request per round trip. A throttled response (429 or 5xx), or a latency moving average LATENCY_FACTOR times
+    the baseline, halves both. Latency is tracked per request_class, as a chapter-range request for many chapters
+    takes much longer to answer than a node request even when the host isn't loaded. The baseline is a much
+    slower moving average (see BASELINE_WEIGHT) rather than the best latency seen, as the odd quick response in a
+    class (a range of a single chapter, say) would hold a best latency down for good; a sudden slowdown still
+    outpaces it. A Retry-After header also pauses the host for as long as it asks.
+
+    Args:
+        rate (float): Initial requests per second.
+        max_rate (float): The most requests per second the rate may grow to.
+        burst (int): The most requests that may be sent at once after an idle spell.
+        concurrency (int): Initial requests in flight.
+        max_concurrency (int): The most requests in flight the window may grow to.
+        rate_increase (float, optional): Requests per second added per second of successes. Defaults to 1.
+    """
+    def __init__(self, rate, max_rate, burst, concurrency, max_concurrency, rate_increase=1.0):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.concurrency = float(concurrency)
+        self.max_concurrency = max_concurrency
+        self.rate_increase = rate_increase
+        self.tokens = float(burst)
+        self.in_flight = 0
+        self.latency = {} # request_class -> moving average of seconds to response headers
+        self.baseline_latency = {} # request_class -> slow moving average of the same (see BASELINE_WEIGHT)
+        self.responses = {} # request_class -> responses seen, for the baseline's warm-up
+        self.throttled = 0 # responses that made the limiter back off
+        self.slow_start = True
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._changed = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Waits for a token and a free slot in the window, then takes them."""
+        with self._changed:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self.in_flight >= int(self.concurrency):
+                    wait = None # until a request finishes
+                elif self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                self._changed.wait(wait)
+
+    def release(self, latency, status_code=None, retry_after=None, kind='other'):
+        """
+        Frees the request's slot and adapts the limits to how it went.
+
+        Args:
+            latency (float): Seconds until the response headers arrived.
+            status_code (int, optional): The response status, or None if the request failed outright.
+            retry_after (float, optional): Seconds the server asked to wait before the next request.
+            kind (str, optional): The request_class of the request's URL. Defaults to 'other'.
+        """
+        with self._changed:
+            self.in_flight -= 1
+            now = time.monotonic()
+            average = self.latency[kind] = latency if kind not in self.latency else 0.8 * self.latency[kind] + 0.2 * latency
+            self.responses[kind] = self.responses.get(kind, 0) + 1
+            weight = max(BASELINE_WEIGHT, 1 / self.responses[kind]) # so the first responses count as much as the rest
+            baseline = self.baseline_latency[kind] = (1 - weight) * self.baseline_latency.get(kind, latency) + weight * latency
+            overloaded = (status_code is not None and (status_code == 429 or status_code >= 500)) or \
+                average > LATENCY_FACTOR * baseline
+            if overloaded:
+                self.throttled += 1
+                if now - self._last_decrease > DECREASE_COOLDOWN:
+                    self._refill(now)
+                    self.rate = max(MIN_RATE, self.rate / 2)
+                    self.concurrency = max(1.0, self.concurrency / 2)
+                    self.slow_start = False
+                    self._last_decrease = now
+                    # the latency that tripped the decrease shouldn't trip the next one too
+                    self.latency[kind] = min(average, 2 * baseline)
+            elif status_code is not None:
+                self._refill(now)
+                if self.slow_start:
+                    self.rate = min(self.max_rate, self.rate + 1)
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                else:
+                    self.rate = min(self.max_rate, self.rate + self.rate_increase / self.rate)
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            self._changed.notify_all()
+
+class RateLimiter:
+    """
+    The HostLimiter of every host a session talks to, created from RATE_LIMITS as hosts are first seen.
+
+    Args:
+        limits (dict, optional): Overrides for RATE_LIMITS, keyed by host (None for the default).
+    """
+    def __init__(self, limits=None):
+        self.limits = {**RATE_LIMITS, **(limits or {})}
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def for_host(self, host):
+        """Returns the HostLimiter of a host, creating it if needed."""
+        with self._lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostLimiter(**self.limits.get(host, self.limits[None]))
+            return self.hosts[host]
+
+def retry_after_seconds(response):
+    """Returns the Retry-After of a response in seconds, or None if it has none in seconds."""
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+def request_class(url):
+    """
+    Sorts a URL into the classes TransferStats counts separately.
+
+    Args:
+        url (str): The URL.
+
+    Returns:
+        str: 'node' (story metadata), 'chapters' (chapter ranges), 'route', 'image' or 'other'.
+    """
+    if NODE_URL_PATTERN.match(url):
+        return 'node'
+    if RANGE_URL_PATTERN.match(url):
+        return 'chapters'
+    if ROUTE_URL_PATTERN.match(url):
+        return 'route'
+    if IMAGE_URL_PATTERN.match(url):
+        return 'image'
+    return 'other'
+
+class TransferStats:
+    """
+    Counts what a session's requests cost, per request_class: round trips, responses answered from the cache,
+    bytes on the wire and after decoding, how many responses were compressed, time to first byte, and retries.
+
+    Examples:
+        >>> stats = install_transport(session)
+        >>> ... # download a book
+        >>> print(stats.report())
+        >>> stats.reset()
+    """
+    FIELDS = ('requests', 'cache_hits', 'wire_bytes', 'body_bytes', 'compressed', 'uncompressed', 'ttfb', 'retries')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.classes = {}
+
+    def reset(self):
+        """Clears the counts, e.g. between books."""
+        with self._lock:
+            self.classes = {}
+
+    def _counts(self, url):
+        return self.classes.setdefault(request_class(url), dict.fromkeys(self.FIELDS, 0))
+
+    def record(self, url, response, ttfb):
+        """
+        Counts a response that came over the network. Its body must have been read already.
+
+        Args:
+            url (str): The URL requested.
+            response (requests.Response): The response.
+            ttfb (float): Seconds until the response headers arrived.
+        """
+        body_bytes = len(response.content)
+        wire_bytes = response.raw.tell() if hasattr(response.raw, 'tell') else body_bytes
+        encoding = response.headers.get('Content-Encoding', '').lower()
+        with self._lock:
+            counts = self._counts(url)
+            counts['requests'] += 1
+            counts['wire_bytes'] += wire_bytes
+            counts['body_bytes'] += body_bytes
+            counts['ttfb'] += ttfb
+            if encoding in COMPRESSED_ENCODINGS:
+                counts['compressed'] += 1
+            elif body_bytes > COMPRESSIBLE_BYTES:
+                counts['uncompressed'] += 1
+
+    def record_cache_hit(self, url):
+        """Counts a response answered from the cache, after a 304 or without asking the server at all."""
+        with self._lock:
+            self._counts(url)['cache_hits'] += 1
+
+    def record_retry(self, url):
+        """Counts a throttled response that is about to be retried."""
+        with self._lock:
+            self._counts(url)['retries'] += 1
+
+    def snapshot(self):
+        """
+        Returns the counts so far, with the time to first byte averaged over each class's requests.
+
+        Returns:
+            dict: {request class: {'requests', 'cache_hits', 'wire_bytes', 'body_bytes', 'compressed', 'uncompressed', 'ttfb', 'retries'}}
+        """
+        with self._lock:
+            snapshot = {name: dict(counts) for name, counts in self.classes.items()}
+        for counts in snapshot.values():
+            counts['ttfb'] = round(counts['ttfb'] / counts['requests'], 4) if counts['requests'] else None
+        return snapshot
+
+    def report(self):
+        """
+        Formats the counts as a table, followed by a warning for each class with sizeable uncompressed responses.
+
+        Returns:
+            str: The report.
+        """
+        lines = [f"{'class':<9} {'requests':>8} {'cached':>7} {'wire KB':>9} {'body KB':>9} {'ratio':>6} {'gzip/br':>8} {'TTFB ms':>8}"]
+        warnings = []
+        for name, counts in sorted(self.snapshot().items()):
+            ratio = f"{counts['body_bytes'] / counts['wire_bytes']:.1f}x" if counts['wire_bytes'] else "-"
+            ttfb = f"{counts['ttfb'] * 1000:.0f}" if counts['ttfb'] is not None else "-"
+            lines.append(f"{name:<9} {counts['requests']:>8} {counts['cache_hits']:>7} {counts['wire_bytes'] / 1024:>9.1f} "
+                         f"{counts['body_bytes'] / 1024:>9.1f} {ratio:>6} {counts['compressed']:>8} {ttfb:>8}")
+            if counts['uncompressed']:
+                warnings.append(f"{counts['uncompressed']} {name} responses over {COMPRESSIBLE_BYTES} bytes arrived uncompressed")
+        return "\n".join(lines + warnings)
+
+def fixture_path(fixture_dir, url):
+    """
+    Returns the file a recorded response is kept in: its URL path under the fixture directory, plus ".json".
+
+    Args:
+        fixture_dir (str): The fixture directory.
+        url (str): The URL, e.g. "https://fiction.live/api/anonkun/chapters/abcdefghijklmnopq/1000/1099/".
+
+    Returns:
+        str: The path, e.g. "<fixture_dir>/api/anonkun/chapters/abcdefghijklmnopq/1000/1099.json",
+             or None if the URL isn't one that is recorded.
+    """
+    if not (url_match := RECORD_URL_PATTERN.match(url)):
+        return None
+    segments = url_match[1].strip('/').split('/')
+    if not all(FIXTURE_SEGMENT_PATTERN.match(segment) for segment in segments): # nothing like ".." gets through
+        return None
+    return os.path.join(fixture_dir, *segments) + ".json"
+
+class ResponseRecorder:
+    """
+    Saves the fiction.live API responses a session receives (RECORD_URL_PATTERN) as fixtures, for
+    FictionLiveReplay's stand-in server to serve again.
+
+    Each response is a JSON file at fixture_path, holding the URL, status, Content-Type, body and the time the
+    server took to answer. Responses answered from the cache are recorded without a time.
+
+    Args:
+        fixture_dir (str): The directory to record to.
+    """
+    def __init__(self, fixture_dir):
+        self.fixture_dir = fixture_dir
+        self.recorded = 0
+
+    def record(self, url, response):
+        """
+        Records a response, replacing any earlier recording of the same URL.
+
+        Args:
+            url (str): The URL requested.
+            response (requests.Response): The response, with its body read.
+        """
+        if (path := fixture_path(self.fixture_dir, url)) is None or response.status_code != 200:
+            return
+        fixture = {
+            'url': url,
+            'status': response.status_code,
+            'content_type': response.headers.get('Content-Type'),
+            'elapsed': round(response.ttfb, 4) if hasattr(response, 'ttfb') else None, # None for cache hits
+            'body': response.text,
+        }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as fixture_file:
+            json.dump(fixture, fixture_file, ensure_ascii=False)
+        os.replace(temp_path, path)
+        self.recorded += 1
+
+def build_response(request, entry, adapter):
+    """
+    Builds a requests.Response from a cache entry, as though it had just been received.
+
+    Args:
+        request (requests.PreparedRequest): The request being answered.
+        entry (dict): The cache entry, as returned by ResponseCache.get.
+        adapter (HTTPAdapter): The adapter answering the request.
+
+    Returns:
+        requests.Response: The response.
+    """
+    response = requests.Response()
+    response.status_code = entry['status']
+    response.headers = CaseInsensitiveDict(entry['headers'])
+    response.encoding = get_encoding_from_headers(response.headers)
+    response._content = entry['body']
+    response.url = request.url
+    response.request = request
+    response.reason = "OK"
+    response.connection = adapter
+    response.from_cache = True
+    return response
+
+class FictionLiveAdapter(HTTPAdapter):
+    """
+    The transport adapter mounted on FictionLiveAPI.session (see install_cache and install_rate_limiter).
+
+    With a cache, GET responses are served from disk while they are within the TTL of their URL class.
+    Expired entries are revalidated with If-None-Match/If-Modified-Since, so an unchanged response costs
+    a 304 instead of the whole body.
+
+    With a rate limiter, every request that does go to the network waits for its host's HostLimiter first,
+    and throttled responses (THROTTLE_STATUSES) are retried after backing off, up to MAX_RETRIES times.
+
+    With transfer stats, every round trip and cache hit is counted (see install_transport).
+
+    With a recorder, every API response is saved as a fixture (see install_recorder), and with an origin,
+    requests go to that server instead, e.g. FictionLiveReplay's stand-in (see install_replay). Everything
+    else, from the cache keys to the rate limits, still goes by the original URL.
+
+    Args:
+        cache (ResponseCache, optional): The response cache. Defaults to no caching.
+        limiter (RateLimiter, optional): The rate limiter. Defaults to no limits.
+        stats (TransferStats, optional): Where to count transfers. Defaults to not counting them.
+        recorder (ResponseRecorder, optional): Where to record responses. Defaults to not recording them.
+        origin (str, optional): The URL that replaces "https://fiction.live/" when requests are sent. Defaults to None.
+        **kwargs: Passed on to HTTPAdapter, e.g. pool_maxsize.
+    """
+    def __init__(self, cache=None, limiter=None, stats=None, recorder=None, origin=None, **kwargs):
+        self.cache = cache
+        self.limiter = limiter
+        self.stats = stats
+        self.recorder = recorder
+        self.origin = origin
+        super().__init__(**kwargs)
+
+    def _send(self, request, **kwargs):
+        """Sends a request over the network, within its host's limits."""
+        host_limiter = self.limiter.for_host(urlparse(request.url).hostname) if self.limiter else None
+        kind = request_class(request.url)
+        sent = request
+        if self.origin and request.url.startswith("https://fiction.live/"):
+            sent = request.copy()
+            sent.url = self.origin + request.url[len("https://fiction.live/"):]
+        for attempt in range(MAX_RETRIES + 1):
+            if host_limiter:
+                host_limiter.acquire()
+            started = time.monotonic()
+            try:
+                response = super().send(sent, **kwargs)
+            except requests.RequestException:
+                if host_limiter:
+                    host_limiter.release(time.monotonic() - started, kind=kind)
+                raise
+            ttfb = time.monotonic() - started
+            response.url = request.url
+            response.ttfb = ttfb
+            if self.stats is not None and not kwargs.get('stream'):
+                self.stats.record(request.url, response, ttfb) # reads the body, as Session.send would next
+            if host_limiter is None:
+                return response
+            retry_after = retry_after_seconds(response)
+            host_limiter.release(ttfb, response.status_code, retry_after, kind)
+            if response.status_code not in THROTTLE_STATUSES or attempt == MAX_RETRIES:
+                return response
+            logger.info(f"{response.status_code} from {request.url}, retrying")
+            if self.stats is not None:
+                self.stats.record_retry(request.url)
+            response.close()
+            if not retry_after: # otherwise acquire() waits for it
+                time.sleep(min(30, 0.5 * 2 ** attempt))
+        return response
+
+    def send(self, request, **kwargs):
+        response = self._send_cached(request, **kwargs)
+        if self.recorder is not None and not kwargs.get('stream'):
+            self.recorder.record(request.url, response)
+        return response
+
+    def _send_cached(self, request, **kwargs):
+        if self.cache is None or request.method != 'GET' or self.cache.url_class(request.url) is None:
+            return self._send(request, **kwargs)
+
+        entry = self.cache.get(request.url)
+        if entry is not None:
+            if time.time() - entry['stored'] < self.cache.ttl_for(request.url):
+                if self.stats is not None:
+                    self.stats.record_cache_hit(request.url)
+                return self._remember(request, build_response(request, entry, self))
+            headers = CaseInsensitiveDict(entry['headers'])
+            if etag := headers.get('ETag'):
+                request.headers['If-None-Match'] = etag
+            if last_modified := headers.get('Last-Modified'):
+                request.headers['If-Modified-Since'] = last_modified
+
+        response = self._send(request, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            # still current, so restart its clock and answer with the stored body
+            self.cache.set(request.url, entry['status'], entry['headers'], entry['body'])
+            if self.stats is not None:
+                self.stats.record_cache_hit(request.url)
+            return self._remember(request, build_response(request, entry, self))
+        if response.status_code == 200:
+            self.cache.set(request.url, response.status_code, response.headers, response.content)
+        response.from_cache = False
+        return self._remember(request, response)
+
+    def _remember(self, request, response):
+        """Records the 'cht' of story metadata passing through, so the cache can tell closed chapter ranges apart."""
+        if response.status_code == 200 and (node_match := NODE_URL_PATTERN.match(request.url)):
+            try:
+                story_metadata = json.loads(response.content)
+            except ValueError:
+                return response
+            if isinstance(story_metadata, dict) and 'cht' in story_metadata:
+                self.cache.note_story_update(node_match[1], story_metadata['cht'])
+        return response
+
+def mounted_adapter(session, prefix):
+    """
+    Returns the FictionLiveAdapter mounted on the session for a URL prefix, mounting a new one if needed.
+
+    A new adapter takes the rate limiter and transfer stats of the adapter that served the prefix until then,
+    since those apply to the whole session; the cache only ever applies to "https://fiction.live/".
+
+    Args:
+        session (requests.Session): The session.
+        prefix (str): The URL prefix, e.g. "https://fiction.live/".
+
+    Returns:
+        FictionLiveAdapter: The adapter.
+    """
+    adapter = session.adapters.get(prefix)
+    if not isinstance(adapter, FictionLiveAdapter):
+        serving = session.get_adapter(prefix)
+        adapter = FictionLiveAdapter()
+        if isinstance(serving, FictionLiveAdapter):
+            adapter.limiter, adapter.stats = serving.limiter, serving.stats
+        session.mount(prefix, adapter)
+    return adapter
+
+def session_adapters(session):
+    """Returns every FictionLiveAdapter mounted on the session."""
+    return [adapter for adapter in session.adapters.values() if isinstance(adapter, FictionLiveAdapter)]
+
+def install_cache(session, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, ttls=None):
+    """
+    Mounts a caching FictionLiveAdapter on the session for all fiction.live URLs.
+
+    Args:
+        session (requests.Session): The session to configure.
+        cache_dir (str, optional): The directory to store responses in. Defaults to CACHE_DIR.
+        max_bytes (int, optional): The maximum size of the cache. Defaults to CACHE_MAX_BYTES.
+        ttls (dict, optional): Overrides for the per-URL-class lifetimes in CACHE_TTLS.
+
+    Returns:
+        ResponseCache: The cache now used by the session.
+    """
+    cache = ResponseCache(cache_dir, max_bytes, ttls)
+    mounted_adapter(session, "https://fiction.live/").cache = cache
+    return cache
+
+def note_story_update(session, story_id, cht):
+    """
+    Tells the session's cache the 'cht' of a story whose metadata was fetched some other way (e.g. by another
+    process), so its closed chapter ranges are still served from the cache. Does nothing without a cache or a 'cht'.
+
+    Args:
+        session (requests.Session): The session.
+        story_id (str): The story id.
+        cht (int): The 'cht' timestamp from the story metadata.
+    """
+    adapter = session.get_adapter("https://fiction.live/")
+    if isinstance(adapter, FictionLiveAdapter) and adapter.cache is not None and cht is not None:
+        adapter.cache.note_story_update(story_id, cht)
+
+def install_rate_limiter(session, limits=None):
+    """
+    Puts every request the session sends, to any host, through a shared adaptive RateLimiter.
+
+    Args:
+        session (requests.Session): The session to configure.
+        limits (dict, optional): Overrides for RATE_LIMITS.
+
+    Returns:
+        RateLimiter: The limiter now used by the session.
+    """
+    limiter = RateLimiter(limits)
+    for prefix in ("https://fiction.live/", "https://", "http://"):
+        mounted_adapter(session, prefix)
+    for adapter in session_adapters(session):
+        adapter.limiter = limiter
+    return limiter
+
+def install_recorder(session, fixture_dir):
+    """
+    Records every fiction.live API response the session receives into a fixture directory (see ResponseRecorder).
+
+    Args:
+        session (requests.Session): The session to configure.
+        fixture_dir (str): The directory to record to.
+
+    Returns:
+        ResponseRecorder: The recorder now used by the session.
+    """
+    recorder = ResponseRecorder(fixture_dir)
+    mounted_adapter(session, "https://fiction.live/").recorder = recorder
+    return recorder
+
+def install_replay(session, server_url):
+    """
+    Sends the session's fiction.live requests to another server, such as FictionLiveReplay's stand-in.
+
+    Args:
+        session (requests.Session): The session to configure.
+        server_url (str): The server's base URL, e.g. "http://127.0.0.1:8765".
+    """
+    mounted_adapter(session, "https://fiction.live/").origin = server_url.rstrip('/') + '/'
+
+def install_transport(session, pool_sizes=None):
+    """
+    Sizes the session's connection pools per host and starts counting what its requests cost.
+
+    Compression is requested with requests' default Accept-Encoding (gzip and deflate, plus br when the
+    brotli package is installed); the returned TransferStats shows whether servers actually use it.
+
+    Args:
+        session (requests.Session): The session to configure.
+        pool_sizes (dict, optional): Overrides for POOL_SIZES, keyed by host (None for every other host).
+
+    Returns:
+        TransferStats: The counts of the session's transfers.
+    """
+    session.headers['Accept-Encoding'] = DEFAULT_ACCEPT_ENCODING
+    for host, size in {**POOL_SIZES, **(pool_sizes or {})}.items():
+        for prefix in (("https://", "http://") if host is None else (f"https://{host}/",)):
+            adapter = mounted_adapter(session, prefix)
+            if adapter._pool_maxsize != size:
+                adapter.init_poolmanager(adapter._pool_connections, size, block=adapter._pool_block)
+    stats = TransferStats()
+    for adapter in session_adapters(session):
+        adapter.stats = stats
+    return stats
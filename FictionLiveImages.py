@@ -0,0 +1,254 @@
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import ebooklib
+from ebooklib import epub
+import FictionLiveHTTP
+try:
+    from PIL import Image # only needed to resize or recompress images
+except ImportError:
+    Image = None
+logger = logging.getLogger(__name__)
+
+IMAGE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "fictionlive", "images")
+IMAGE_CACHE_MAX_BYTES = 1024 * 1024 * 1024 # images are kept apart from the API cache so they can't crowd it out
+DEFAULT_IMAGE_JOBS = 8 # images downloaded at once, on top of the chapter downloads
+DEFAULT_QUALITY = 85 # JPEG quality used when images are resized without a quality of their own
+IMAGE_FOLDER = "images" # where embedded images go inside the EPUB, next to the chapter files
+MEDIA_TYPE_EXTENSIONS = {'image/jpeg': "jpg", 'image/png': "png", 'image/gif': "gif", 'image/webp': "webp", 'image/svg+xml': "svg"}
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", 'image/jpeg'),
+    (b"\x89PNG\r\n\x1a\n", 'image/png'),
+    (b"GIF8", 'image/gif'),
+    (b"RIFF", 'image/webp'), # followed by WEBP at offset 8, checked below
+]
+EMBEDDED_IMAGE_PATTERN = re.compile(rb'src="(' + IMAGE_FOLDER.encode() + rb'/[0-9a-f]+\.[a-z]+)"')
+
+def sniff_media_type(data, content_type=None):
+    """
+    Works out the media type of an image from its first bytes, falling back on the Content-Type header.
+
+    Args:
+        data (bytes): The image.
+        content_type (str, optional): The Content-Type it was served with. Defaults to None.
+
+    Returns:
+        str: The media type, or None if it isn't an image an EPUB can hold.
+    """
+    for signature, media_type in IMAGE_SIGNATURES:
+        if data.startswith(signature) and (media_type != 'image/webp' or data[8:12] == b"WEBP"):
+            return media_type
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    return content_type if content_type in MEDIA_TYPE_EXTENSIONS else None
+
+def recompress(data, media_type, max_size=None, quality=None):
+    """
+    Shrinks an image to fit within max_size pixels and re-encodes it, keeping whichever version is smaller.
+
+    Images with transparency stay PNG; everything else becomes JPEG at `quality`. GIFs (which may be animated)
+    and SVGs are left alone.
+
+    Args:
+        data (bytes): The image.
+        media_type (str): Its media type.
+        max_size (int, optional): The most pixels along either side. Defaults to keeping the size.
+        quality (int, optional): The JPEG quality, 1-95. Defaults to DEFAULT_QUALITY.
+
+    Returns:
+        tuple: The image data and its media type.
+    """
+    if media_type not in ('image/jpeg', 'image/png', 'image/webp'):
+        return data, media_type
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if max_size:
+                image.thumbnail((max_size, max_size)) # only ever shrinks
+            output = io.BytesIO()
+            if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+                image.save(output, 'PNG', optimize=True)
+                new_type = 'image/png'
+            else:
+                image.convert('RGB').save(output, 'JPEG', quality=quality or DEFAULT_QUALITY, optimize=True)
+                new_type = 'image/jpeg'
+    except (OSError, ValueError) as e: # not an image Pillow can read after all
+        logger.info(f"Could not recompress image: {e}")
+        return data, media_type
+    return (output.getvalue(), new_type) if output.tell() < len(data) else (data, media_type)
+
+class ImagePipeline:
+    """
+    Downloads the images of one book and embeds each of them in the EPUB, once.
+
+    Images are fetched on their own thread pool as soon as a chapter's text is in (see prefetch), so they
+    download while earlier chapters are still being added. embed() then waits for the chapter's images, adds
+    each one to the book the first time it is seen, and points the img tags at the embedded copy. Images are
+    named after the hash of their content, so the same map or portrait linked from a hundred chunks, or from
+    different URLs, is stored once. Downloads are kept in a persistent cache, so rebuilding a book costs no
+    image downloads at all.
+
+    Args:
+        session (requests.Session): The session to download images with.
+        cache_dir (str, optional): The directory of the image cache, or None for no cache. Defaults to IMAGE_CACHE_DIR.
+        max_size (int, optional): Shrink images to fit within this many pixels. Needs Pillow. Defaults to None.
+        quality (int, optional): Re-encode images as JPEG at this quality. Needs Pillow. Defaults to None.
+        jobs (int, optional): The number of images to download at once. Defaults to DEFAULT_IMAGE_JOBS.
+
+    Raises:
+        RuntimeError: If resizing or recompressing is asked for without Pillow installed.
+
+    Examples:
+        >>> with ImagePipeline(session, max_size=1200, quality=80) as images:
+        ...     book = create_book(book_data, 1, 1, images=images)
+        >>> print(images.summary())
+        Images: 412 references, 9 unique (2 downloaded, 7 from cache, 0 failed), 3.1 MB -> 1.2 MB
+    """
+    def __init__(self, session, cache_dir=IMAGE_CACHE_DIR, max_size=None, quality=None, jobs=DEFAULT_IMAGE_JOBS):
+        if (max_size or quality) and Image is None:
+            raise RuntimeError("Resizing or recompressing images needs Pillow (pip install Pillow)")
+        self.session = session
+        self.cache = FictionLiveHTTP.ResponseCache(cache_dir, IMAGE_CACHE_MAX_BYTES) if cache_dir else None
+        self.max_size = max_size
+        self.quality = quality
+        self._executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+        self._downloads = {} # url -> future of (file name, data, media type, original size), or of None if it failed
+        self._embedded = {} # file name -> the item in the book
+        self._adopted = {} # file name -> image item of the book being updated
+        self.stats = dict.fromkeys(('references', 'downloaded', 'cached', 'failed', 'unique', 'bytes_in', 'bytes_out'), 0)
+        self._stats_lock = threading.Lock()
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    def _fetch(self, url):
+        """Downloads (or loads from the cache) and processes one image. Runs on the pipeline's threads."""
+        try:
+            if self.cache is not None and (entry := self.cache.get(url)) is not None:
+                data, content_type = entry['body'], entry['headers'].get('Content-Type')
+                self._count('cached')
+            else:
+                response = self.session.get(url, timeout=60)
+                response.raise_for_status()
+                data, content_type = response.content, response.headers.get('Content-Type')
+                self._count('downloaded')
+                if self.cache is not None:
+                    self.cache.set(url, 200, {'Content-Type': content_type or ""}, data)
+        except Exception as e:
+            logger.warning(f"Could not download image {url}: {e}")
+            self._count('failed')
+            return None
+        if (media_type := sniff_media_type(data, content_type)) is None:
+            logger.warning(f"Not an image: {url}")
+            self._count('failed')
+            return None
+        # named after the original content, so every URL of the same image maps to one file whatever the settings
+        file_name = f"{IMAGE_FOLDER}/{hashlib.sha256(data).hexdigest()[:20]}"
+        size_in = len(data)
+        if self.max_size or self.quality:
+            data, media_type = recompress(data, media_type, self.max_size, self.quality)
+        return f"{file_name}.{MEDIA_TYPE_EXTENSIONS[media_type]}", data, media_type, size_in
+
+    def prefetch(self, urls):
+        """
+        Starts downloading images that haven't been asked for yet, without waiting for them.
+
+        Args:
+            urls (iterable): Image URLs; anything but http(s) URLs is ignored.
+        """
+        for url in urls:
+            if url.startswith(("https://", "http://")) and url not in self._downloads:
+                self._downloads[url] = self._executor.submit(self._fetch, url)
+
+    def _add(self, book, result, cover=False):
+        file_name, data, media_type, size_in = result
+        if file_name not in self._embedded:
+            if cover:
+                book.set_cover(file_name, data)
+                item = book.get_item_with_id('cover-img')
+            else:
+                item = epub.EpubImage(uid=f"image_{os.path.basename(file_name).replace('.', '_')}", file_name=file_name,
+                                      media_type=media_type, content=data)
+                book.add_item(item)
+            self._embedded[file_name] = item
+            self._count('unique')
+            self._count('bytes_in', size_in)
+            self._count('bytes_out', len(data))
+        return file_name
+
+    def embed(self, book, img_elements):
+        """
+        Embeds the images of a chapter in the book and points their img tags at the embedded copies.
+
+        Images that can't be downloaded keep their original URL.
+
+        Args:
+            book (epub.EpubBook): The book.
+            img_elements (list): The chapter's img tags, with their src already passed through img_url_trans.
+        """
+        for img in img_elements:
+            if not (url := img.get('src')):
+                continue
+            self.prefetch([url])
+            if (future := self._downloads.get(url)) is None or (result := future.result()) is None:
+                continue
+            self._count('references')
+            img['src'] = self._add(book, result)
+
+    def add_cover(self, book, url):
+        """
+        Embeds the story's cover image and gives the book a cover page.
+
+        Args:
+            book (epub.EpubBook): The book, before any other item has been added.
+            url (str): The cover image URL.
+        """
+        self.prefetch([url])
+        if (future := self._downloads.get(url)) is not None and (result := future.result()) is not None:
+            self._add(book, result, cover=True)
+
+    def adopt(self, existing_book):
+        """
+        Makes the images of an existing book available to embed_reused, when update_book reuses its chapters.
+
+        Args:
+            existing_book (epub.EpubBook): The book being updated.
+        """
+        for item in existing_book.get_items():
+            if item.get_type() in (ebooklib.ITEM_IMAGE, ebooklib.ITEM_COVER) and item.file_name.startswith(f"{IMAGE_FOLDER}/"):
+                self._adopted[item.file_name] = item
+
+    def embed_reused(self, book, content):
+        """
+        Embeds the images a chapter copied from an existing book refers to.
+
+        Args:
+            book (epub.EpubBook): The book.
+            content (bytes): The chapter body, as copied.
+        """
+        for file_name in EMBEDDED_IMAGE_PATTERN.findall(content):
+            file_name = file_name.decode()
+            self._count('references')
+            if file_name not in self._embedded and (item := self._adopted.get(file_name)):
+                content_bytes = item.get_content()
+                self._add(book, (file_name, content_bytes, item.media_type, len(content_bytes)))
+
+    def summary(self):
+        """Returns a line describing what the pipeline embedded."""
+        stats = self.stats
+        return (f"Images: {stats['references']} references, {stats['unique']} unique ({stats['downloaded']} downloaded, "
+                f"{stats['cached']} from cache, {stats['failed']} failed), "
+                f"{stats['bytes_in'] / 2**20:.1f} MB -> {stats['bytes_out'] / 2**20:.1f} MB")
+
+    def close(self):
+        """Stops the downloads that haven't started."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,165 @@
+import json
+import os
+import sqlite3
+import time
+
+LIBRARY_NAME = "library.sqlite" # default library file, in the batch output directory
+BUSY_TIMEOUT = 30 # seconds a batch worker waits for another worker's write to the library to finish
+NEW, UNCHANGED, UPDATE, REBUILD = "new", "unchanged", "update", "rebuild" # what Library.check says to do with a story
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stories (
+    story_id TEXT PRIMARY KEY,
+    title TEXT,
+    cht INTEGER,       -- time of the story's most recent chunk when it was built
+    words INTEGER,     -- the story's 'w' word count
+    bookmarks TEXT,    -- the story's 'bm' chapter list, as JSON (see bookmarks_key)
+    output_path TEXT,
+    built_at REAL      -- seconds since the epoch
+);
+CREATE TABLE IF NOT EXISTS chapters (
+    story_id TEXT NOT NULL REFERENCES stories(story_id) ON DELETE CASCADE,
+    file_name TEXT NOT NULL,
+    url TEXT NOT NULL,
+    hash TEXT,         -- SHA-1 of the chapter's XHTML body, as download_and_add_to_book added it
+    PRIMARY KEY (story_id, file_name)
+);
+CREATE TABLE IF NOT EXISTS updates (
+    story_id TEXT NOT NULL,
+    cht INTEGER NOT NULL,   -- a 'cht' the story's metadata was seen with
+    seen_at REAL,           -- when it was first seen, in seconds since the epoch
+    PRIMARY KEY (story_id, cht)
+);
+"""
+
+def bookmarks_key(book_data):
+    """Returns the story's bookmark list as the compact JSON the library stores, for comparing it with the stored one."""
+    return json.dumps(book_data.get('bm') or [], sort_keys=True, separators=(',', ':'))
+
+class Library:
+    """
+    An SQLite index of the stories a batch has built, so a run over the same list can tell which books are
+    already current from the story metadata alone.
+
+    For each story it keeps the 'cht', word count and bookmark list the book was built from, where the book
+    was written and when, the URL and content hash of every chapter file, and every 'cht' the story has been
+    seen with (see note_update), which FictionLiveWatch schedules its checks by. Several batch workers may use
+    the same library file at once, each with its own Library.
+
+    Args:
+        path (str): The library file, created if needed.
+
+    Examples:
+        >>> library = Library("output/library.sqlite")
+        >>> decision, record = library.check(book_data)
+        >>> decision
+        'unchanged'
+    """
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL") # readers don't wait for a worker that is writing
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, story_id):
+        """
+        Looks up a story.
+
+        Args:
+            story_id (str): The story id.
+
+        Returns:
+            dict: The story's row, with its 'chapters' (file name -> {'url', 'hash'}), or None if it isn't in the library.
+        """
+        row = self.connection.execute("SELECT * FROM stories WHERE story_id = ?", (story_id,)).fetchone()
+        if row is None:
+            return None
+        record = dict(row)
+        record['chapters'] = {chapter['file_name']: {'url': chapter['url'], 'hash': chapter['hash']} for chapter in
+                              self.connection.execute("SELECT file_name, url, hash FROM chapters WHERE story_id = ?", (story_id,))}
+        return record
+
+    def check(self, book_data):
+        """
+        Decides what to do with a story from its metadata alone, without downloading or parsing anything else.
+
+        Args:
+            book_data (dict): The story metadata, as get_book_info returns it.
+
+        Returns:
+            tuple: (decision, record), where record is the story's row (see get) or None, and decision is
+                   NEW if the story isn't in the library or its book is gone, UNCHANGED if its 'cht', word
+                   count and bookmark list are the same as when it was built, REBUILD if only its word count
+                   changed (an old chunk was edited, and there's no telling which), and UPDATE otherwise (new
+                   chunks or changed chapters, so the finished chapters of the book can be reused).
+        """
+        row = self.connection.execute("SELECT * FROM stories WHERE story_id = ?", (book_data['_id'],)).fetchone()
+        if row is None or not row['output_path'] or not os.path.isfile(row['output_path']):
+            return NEW, None
+        record = dict(row)
+        same_chapters = record['cht'] == book_data.get('cht') and record['bookmarks'] == bookmarks_key(book_data)
+        if same_chapters and record['words'] == book_data.get('w'):
+            return UNCHANGED, record
+        return (REBUILD if same_chapters else UPDATE), record
+
+    def record(self, book_data, output_path, sources, hashes=None):
+        """
+        Records a book that has just been written, replacing the story's earlier record, and adds its 'cht' to the story's update history.
+
+        Args:
+            book_data (dict): The story metadata the book was built from.
+            output_path (str): Where the book was written.
+            sources (dict): The URL of each chapter file, as create_book stores it in the book.
+            hashes (dict, optional): The content hash of each chapter file, likewise. Defaults to None.
+
+        Returns:
+            list: The chapter files that are new or whose content changed since the story's earlier record, in file name order.
+        """
+        hashes = hashes or {}
+        story_id = book_data['_id']
+        previous = {row['file_name']: row['hash'] for row in
+                    self.connection.execute("SELECT file_name, hash FROM chapters WHERE story_id = ?", (story_id,))}
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO stories VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (story_id, book_data.get('t'), book_data.get('cht'), book_data.get('w'),
+                                     bookmarks_key(book_data), os.path.abspath(output_path), time.time()))
+            self.connection.execute("DELETE FROM chapters WHERE story_id = ?", (story_id,)) # INSERT OR REPLACE may not cascade
+            self.connection.executemany("INSERT INTO chapters VALUES (?, ?, ?, ?)",
+                                        [(story_id, file_name, url, hashes.get(file_name)) for file_name, url in sources.items()])
+            if book_data.get('cht') is not None:
+                self.connection.execute("INSERT OR IGNORE INTO updates VALUES (?, ?, ?)", (story_id, book_data['cht'], time.time()))
+        return sorted(file_name for file_name in sources if hashes.get(file_name) is None or previous.get(file_name) != hashes[file_name])
+
+    def note_update(self, story_id, cht):
+        """
+        Adds a 'cht' a story's metadata was just seen with to its update history, if it is new.
+
+        Args:
+            story_id (str): The story id.
+            cht (int): The 'cht' timestamp from the story metadata.
+        """
+        if cht is None:
+            return
+        with self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO updates VALUES (?, ?, ?)", (story_id, cht, time.time()))
+
+    def update_history(self, story_id, limit):
+        """
+        Returns the latest 'cht' values a story has been seen with.
+
+        Args:
+            story_id (str): The story id.
+            limit (int): The most values to return.
+
+        Returns:
+            list: Up to `limit` 'cht' timestamps, oldest first.
+        """
+        rows = self.connection.execute("SELECT cht FROM updates WHERE story_id = ? ORDER BY cht DESC LIMIT ?", (story_id, limit))
+        return [row['cht'] for row in rows][::-1]
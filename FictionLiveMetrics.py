@@ -0,0 +1,252 @@
+import contextlib
+import functools
+import json
+import os
+import re
+import threading
+import time
+
+tracer = None # the Tracer of the book being built, set by book_trace; None when nothing is being traced
+METRIC_PREFIX = "fictionlive"
+NULL_SPAN = contextlib.nullcontext() # reused by span() when nothing is traced, so untraced runs pay next to nothing
+COUNTER_HELP = {
+    'chunks': "Chunks formatted, by node type.",
+    'chapter_bytes': "Bytes of chapter XHTML added to the book.",
+    'routes_found': "Routes found by following choice links in the main text and other routes, beyond those in the story's route metadata.",
+    'route_chunks_skipped': "Route chunks left out because an earlier route already has them.",
+    'http_requests': "Requests that went over the network, by request class.",
+    'http_cache_hits': "Requests answered from the HTTP cache, by request class.",
+    'http_wire_bytes': "Response bytes received on the wire, by request class.",
+    'http_body_bytes': "Response bytes after decompression, by request class.",
+    'http_retries': "Throttled requests that were retried, by request class.",
+}
+TRANSFER_COUNTERS = {'requests': 'http_requests', 'cache_hits': 'http_cache_hits', 'wire_bytes': 'http_wire_bytes',
+                     'body_bytes': 'http_body_bytes', 'retries': 'http_retries'}
+
+class Tracer:
+    """
+    Records timing spans and counters for one book.
+
+    Spans may be opened on any thread; each thread's spans nest on their own. The trace is written in the
+    Chrome trace event format, so it opens in chrome://tracing or https://ui.perfetto.dev as one lane per
+    download thread, and the totals are written as Prometheus text for the node exporter's textfile collector.
+
+    Examples:
+        >>> trace = Tracer()
+        >>> with trace.span("getChapterText", url=url):
+        ...     trace.count('chunks', nt="choice")
+        >>> trace.write("metrics")
+        ('metrics/abcdefghijklmnopq.trace.json', 'metrics/abcdefghijklmnopq.prom')
+    """
+    def __init__(self):
+        self.started = time.time()
+        self._origin = time.perf_counter()
+        self.attributes = {} # story id, title, ... (see annotate)
+        self.spans = [] # (name, start, duration, thread id, attributes), times in seconds since _origin
+        self.counters = {} # (name, sorted label items) -> amount
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """Times the body of a with statement as a span called `name`, even if it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.spans.append((name, start - self._origin, end - start, threading.get_ident(), attributes)) # append is atomic
+
+    def count(self, name, amount=1, **labels):
+        """Adds `amount` to the counter `name` with the given labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add_transfer_stats(self, snapshot):
+        """
+        Adds the counts of a FictionLiveHTTP.TransferStats snapshot as http_* counters.
+
+        Args:
+            snapshot (dict): TransferStats.snapshot() of the requests made for this book.
+        """
+        for request_class, counts in snapshot.items():
+            for field, counter in TRANSFER_COUNTERS.items():
+                if counts.get(field):
+                    self.count(counter, counts[field], **{'class': request_class})
+
+    def span_totals(self):
+        """
+        Returns the number of calls and the total seconds of each span name.
+
+        Returns:
+            dict: {span name: {'calls': int, 'seconds': float}}, slowest first.
+        """
+        totals = {}
+        for name, _, duration, _, _ in list(self.spans):
+            entry = totals.setdefault(name, {'calls': 0, 'seconds': 0.0})
+            entry['calls'] += 1
+            entry['seconds'] += duration
+        return dict(sorted(totals.items(), key=lambda item: item[1]['seconds'], reverse=True))
+
+    def to_trace(self):
+        """
+        Returns the trace in the Chrome trace event format, with the counters and span totals under 'otherData'.
+
+        Returns:
+            dict: The trace, ready for json.dump.
+        """
+        pid = os.getpid()
+        thread_ids = {} # small, stable lane numbers instead of thread idents
+        events = []
+        for name, start, duration, thread, attributes in list(self.spans):
+            tid = thread_ids.setdefault(thread, len(thread_ids))
+            event = {'name': name, 'cat': name.split(".")[0], 'ph': "X", 'ts': round(start * 1e6, 1),
+                     'dur': round(duration * 1e6, 1), 'pid': pid, 'tid': tid}
+            if attributes:
+                event['args'] = attributes
+            events.append(event)
+        events.sort(key=lambda event: event['ts'])
+        counters = {}
+        for (name, labels), amount in sorted(self.counters.items()):
+            counters.setdefault(name, []).append({'labels': dict(labels), 'value': amount})
+        return {
+            'traceEvents': events,
+            'displayTimeUnit': "ms",
+            'otherData': {**self.attributes, 'started': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                          'counters': counters, 'spans': self.span_totals()},
+        }
+
+    def to_prometheus(self):
+        """
+        Returns the span totals and counters in the Prometheus text exposition format, labelled with the story id.
+
+        Returns:
+            str: The metrics.
+        """
+        story_labels = {'story': self.attributes.get('story', "unknown")}
+        lines = []
+
+        def metric(name, help_text, samples, kind="counter"):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{METRIC_PREFIX}_{name}{format_labels({**story_labels, **labels})} {round(value, 6)}")
+
+        totals = self.span_totals()
+        metric("span_seconds_total", "Seconds spent in each traced stage, summed over threads.",
+               [({'span': name}, entry['seconds']) for name, entry in totals.items()])
+        metric("span_calls_total", "Times each traced stage ran.", [({'span': name}, entry['calls']) for name, entry in totals.items()])
+        by_name = {}
+        for (name, labels), amount in sorted(self.counters.items()):
+            by_name.setdefault(name, []).append((dict(labels), amount))
+        for name, samples in by_name.items():
+            metric(f"{name}_total", COUNTER_HELP.get(name, name.replace("_", " ").capitalize() + "."), samples)
+        metric("last_build_timestamp_seconds", "When the book was last built.", [({}, self.started)], "gauge")
+        return "\n".join(lines) + "\n"
+
+    def write(self, dir_path):
+        """
+        Writes <story id>.trace.json and <story id>.prom to a directory, replacing those of an earlier build.
+
+        Args:
+            dir_path (str): The directory, created if needed.
+
+        Returns:
+            tuple: The paths of the trace and of the Prometheus file.
+        """
+        os.makedirs(dir_path, exist_ok=True)
+        base_name = self.attributes.get('story', "unknown")
+        trace_path = os.path.join(dir_path, f"{base_name}.trace.json")
+        metrics_path = os.path.join(dir_path, f"{base_name}.prom")
+        write_atomically(trace_path, json.dumps(self.to_trace(), default=str))
+        write_atomically(metrics_path, self.to_prometheus()) # the textfile collector must never see half a file
+        return trace_path, metrics_path
+
+def format_labels(labels):
+    """Formats Prometheus labels, escaping backslashes, quotes and newlines in their values."""
+    if not labels:
+        return ""
+    escaped = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{re.sub(r"[^a-zA-Z0-9_]", "_", key)}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+def write_atomically(path, text):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as output_file:
+        output_file.write(text)
+    os.replace(temp_path, path)
+
+def span(name, **attributes):
+    """
+    Times the body of a with statement on the current book's tracer, if there is one.
+
+    Args:
+        name (str): The span name, e.g. "getChapterText" or "chunk.choice".
+        **attributes: Details recorded with the span, e.g. the URL.
+
+    Returns:
+        contextlib.AbstractContextManager: The span.
+    """
+    return NULL_SPAN if tracer is None else tracer.span(name, **attributes)
+
+def count(name, amount=1, **labels):
+    """Adds to a counter of the current book's tracer, if there is one."""
+    if tracer is not None:
+        tracer.count(name, amount, **labels)
+
+def annotate(**attributes):
+    """Records details of the current book, e.g. its story id, on its tracer if there is one."""
+    if tracer is not None:
+        tracer.attributes.update(attributes)
+
+def traced(name):
+    """
+    Decorates a function so every call is a span called `name` on the current book's tracer.
+
+    Args:
+        name (str): The span name.
+
+    Returns:
+        callable: The decorator.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return function(*args, **kwargs)
+            with tracer.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@contextlib.contextmanager
+def book_trace(metrics_dir, transfer_stats=None):
+    """
+    Traces everything in a with statement as one book, then writes its trace and metrics (see Tracer.write).
+
+    Nothing is written if no story was looked up (see get_book_info), e.g. for an invalid URL.
+
+    Args:
+        metrics_dir (str): The directory to write to, or None to trace nothing.
+        transfer_stats (FictionLiveHTTP.TransferStats, optional): The session's transfer counts, which must have
+            been reset before the book; they are added as http_* counters. Defaults to None.
+
+    Yields:
+        Tracer: The book's tracer, or None when not tracing.
+    """
+    global tracer
+    if metrics_dir is None:
+        yield None
+        return
+    tracer = book_tracer = Tracer()
+    try:
+        with book_tracer.span("book"):
+            yield book_tracer
+    finally:
+        tracer = None
+        if transfer_stats is not None:
+            book_tracer.add_transfer_stats(transfer_stats.snapshot())
+        if book_tracer.attributes.get('story'):
+            book_tracer.write(metrics_dir)
@@ -0,0 +1,149 @@
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import FictionLiveHTTP
+
+DEFAULT_PORT = 8765
+DEFAULT_LATENCY = 0.25 # seconds to first byte for responses recorded without a time (e.g. answered from the cache)
+DEFAULT_BANDWIDTH = 4 * 1024 * 1024 # bytes per second sent to each client
+LATENCY_JITTER = 0.2 # latencies vary by up to this fraction either way
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    A local stand-in for fiction.live, serving responses recorded with FictionLiveHTTP.install_recorder.
+
+    Each response is held back for its recorded time to first byte (or `latency`), give or take
+    LATENCY_JITTER, then sent at `bandwidth` bytes per second, gzipped when the client accepts it, with an
+    ETag so cache revalidation gets 304s like it does from the real site. URLs that weren't recorded get the
+    404 "Cannot GET" page fiction.live sends. The bodies are always the recorded ones, so a book built
+    against the server is the same every time; only the timing varies.
+
+    Args:
+        fixture_dir (str): The directory the responses were recorded to.
+        address (tuple, optional): The (host, port) to listen on. Defaults to localhost on DEFAULT_PORT; port 0 picks a free one.
+        latency (float, optional): Seconds to first byte for every response, instead of the recorded times. Defaults to None.
+        latency_scale (float, optional): Multiplies every latency, e.g. 0 to serve as fast as possible. Defaults to 1.
+        bandwidth (float, optional): Bytes per second, or None for no limit. Defaults to DEFAULT_BANDWIDTH.
+        seed (int, optional): Seeds the jitter, for repeatable timings. Defaults to None.
+
+    Examples:
+        >>> with ReplayServer("fixtures/story", ('127.0.0.1', 0)) as server:
+        ...     server.start()
+        ...     FictionLiveHTTP.install_replay(FictionLiveAPI.session, server.url)
+        ...     book = FictionLiveAPI.create_book(...)
+    """
+    daemon_threads = True
+
+    def __init__(self, fixture_dir, address=('127.0.0.1', DEFAULT_PORT), latency=None, latency_scale=1.0,
+                 bandwidth=DEFAULT_BANDWIDTH, seed=None):
+        self.fixture_dir = fixture_dir
+        self.latency = latency
+        self.latency_scale = latency_scale
+        self.bandwidth = bandwidth
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.served = 0
+        self.missing = 0
+        super().__init__(address, ReplayHandler)
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_port}"
+
+    def delay_for(self, fixture):
+        """Returns how long to hold back a response before sending it."""
+        latency = self.latency if self.latency is not None else fixture.get('elapsed')
+        if latency is None:
+            latency = DEFAULT_LATENCY
+        with self.random_lock:
+            jitter = self.random.uniform(1 - LATENCY_JITTER, 1 + LATENCY_JITTER)
+        return latency * jitter * self.latency_scale
+
+    def start(self):
+        """Serves requests on a background thread until shutdown()."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, like the real site, so connection pooling behaves the same
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        path = FictionLiveHTTP.fixture_path(server.fixture_dir, "https://fiction.live" + self.path)
+        try:
+            with open(path, encoding='utf-8') as fixture_file:
+                fixture = json.load(fixture_file)
+        except (TypeError, OSError, ValueError): # no fixture_path, or nothing recorded there
+            server.missing += 1
+            self.send_body(404, f"Cannot GET {self.path}".encode('utf-8'), "text/html; charset=utf-8", {})
+            return
+        server.served += 1
+        time.sleep(server.delay_for(fixture))
+        body = fixture['body'].encode('utf-8')
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_body(304, b"", None, {'ETag': etag})
+            return
+        self.send_body(fixture['status'], body, fixture.get('content_type') or "application/json; charset=utf-8", {'ETag': etag})
+
+    def send_body(self, status, body, content_type, headers):
+        if body and 'gzip' in self.headers.get('Accept-Encoding', "") and len(body) > FictionLiveHTTP.COMPRESSIBLE_BYTES:
+            body = gzip.compress(body, compresslevel=6)
+            headers['Content-Encoding'] = "gzip"
+        self.send_response(status)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.server.bandwidth:
+            chunk_size = 16 * 1024
+            for start in range(0, len(body), chunk_size):
+                chunk = body[start:start + chunk_size]
+                self.wfile.write(chunk)
+                time.sleep(len(chunk) / self.server.bandwidth)
+        else:
+            self.wfile.write(body)
+
+def parse_arguments(argv=None):
+    """
+    Parses the command line options.
+
+    Args:
+        argv (list, optional): The arguments to parse. Defaults to sys.argv[1:].
+
+    Returns:
+        argparse.Namespace: The parsed options.
+    """
+    parser = argparse.ArgumentParser(description="Serve recorded fiction.live API responses (see --record in FictionLiveAPI.py) "
+                                                 "so stories can be built offline, with --replay.")
+    parser.add_argument('fixture_dir', help="directory the responses were recorded to")
+    parser.add_argument('--host', default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"port to listen on (default: {DEFAULT_PORT})")
+    parser.add_argument('--latency', type=float, metavar='SECONDS',
+                        help=f"time to first byte of every response, instead of the recorded times ({DEFAULT_LATENCY}s where none was recorded)")
+    parser.add_argument('--latency-scale', type=float, default=1.0, metavar='FACTOR',
+                        help="multiply every latency, e.g. 0 to answer at once (default: 1)")
+    parser.add_argument('--bandwidth', type=float, default=DEFAULT_BANDWIDTH, metavar='BYTES',
+                        help=f"bytes per second sent to each client, 0 for no limit (default: {DEFAULT_BANDWIDTH})")
+    parser.add_argument('--seed', type=int, help="seed the latency jitter, for repeatable timings")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    server = ReplayServer(args.fixture_dir, (args.host, args.port), args.latency, args.latency_scale, args.bandwidth or None, args.seed)
+    print(f"Serving {args.fixture_dir} at {server.url} (build stories against it with --replay {server.url})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"{server.served} responses served, {server.missing} not recorded")
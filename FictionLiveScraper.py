@@ -6,7 +6,6 @@ from ebooklib import epub
 import sys
 import re
 import datetime
-from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
@@ -15,6 +14,9 @@ from colorama import Fore, Style
 import time
 from bs4 import Tag
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from FictionLiveBrowser import DriverPool, start_driver, transferred_bytes, DEFAULT_POOL_SIZE, DEFAULT_MAX_PAGES
 
 # Set Selenium's logging level to WARNING
 logging.getLogger('selenium').setLevel(logging.WARNING)
@@ -53,31 +55,27 @@ def validate_urls(urls):
     return valid_urls
 
 # Function to get the Table of Contents
-def get_book_info(url):
-    # Set up the Chrome WebDriver without displaying DevTools messages
-    chrome_options = webdriver.ChromeOptions()
-    chrome_options.add_argument("--log-level=3")  # 3 corresponds to WARNING level
-    chrome_options.add_experimental_option('excludeSwitches', ['enable-logging'])
-    driver = webdriver.Chrome(options=chrome_options)
-    wait = WebDriverWait(driver, 30)
-
-    driver.get(url)
-    driver.minimize_window() # Minimize the browser window
-
-    # Wait for the Table of Contents to load
-    element_locator = (By.CLASS_NAME, "contentsInner")
-    try:
-        element = wait.until(EC.presence_of_element_located(element_locator)) # Wait for the element to load
-    except TimeoutException:
-        print(f"{Fore.RED}Error: The required element did not load within the specified time.\n\tStory at {url} could not be found.{Style.RESET_ALL}")
-        return None, None, None
-
-    # Get the Table of Contents
-    toc_element = driver.find_element(By.CLASS_NAME, "contentsInner")
-    toc_soup = BeautifulSoup(toc_element.get_attribute("innerHTML"), "html.parser")
-
-    # Get the book title, properties, and author
-    page_soup = BeautifulSoup(driver.page_source, "html.parser")
+def get_book_info(url, pool):
+    with pool.driver() as driver:
+        wait = WebDriverWait(driver, 30)
+
+        driver.get(url)
+
+        # Wait for the Table of Contents to load
+        element_locator = (By.CLASS_NAME, "contentsInner")
+        try:
+            element = wait.until(EC.presence_of_element_located(element_locator)) # Wait for the element to load
+        except TimeoutException:
+            print(f"{Fore.RED}Error: The required element did not load within the specified time.\n\tStory at {url} could not be found.{Style.RESET_ALL}")
+            return None, None, None
+
+        # Get the Table of Contents
+        toc_element = driver.find_element(By.CLASS_NAME, "contentsInner")
+        toc_soup = BeautifulSoup(toc_element.get_attribute("innerHTML"), "html.parser")
+
+        # Get the book title, properties, and author
+        page_soup = BeautifulSoup(driver.page_source, "html.parser")
+    # The rest only needs the parsed page, so the driver is already back in the pool
     content_rating_tags = page_soup.find_all('span', class_="rating")
     if date_string := page_soup.find('span', class_='ut'):
         date_string = date_string.text.strip().split("New")[0]
@@ -108,12 +106,10 @@ def get_book_info(url):
     else:
         appendix_elements = []
 
-    driver.quit()
-
     return book_properties, chapter_elements, appendix_elements
 
 # Function to create the EPUB file
-def create_book(book_properties, chapter_elements, appendix_elements, book_number, total_books):
+def create_book(book_properties, chapter_elements, appendix_elements, book_number, total_books, pool):
     print(f"Creating book... {book_number}/{total_books}")
     book = epub.EpubBook() # Create the book
 
@@ -152,7 +148,7 @@ def create_book(book_properties, chapter_elements, appendix_elements, book_numbe
     book.add_item(epub.EpubNav()) # Add the navigation
     book.toc += (epub.Link("title.xhtml", 'Title Page', "Title Page"),)  # Add the chapter to the table of contents
 
-    chapters_dict, appendix_dict = download_chapters(chapter_elements, appendix_elements) # Download the chapters
+    chapters_dict, appendix_dict = download_chapters(chapter_elements, appendix_elements, pool) # Download the chapters
 
     book = format_chapters(book, chapters_dict, appendix_dict) # Format the chapters
     
@@ -166,111 +162,172 @@ def print_loading(message):
     sys.stdout.write('\r' + message)
     sys.stdout.flush()
 
-# Function to download the chapters
-def download_chapters(chapter_links, appendix_links):
-    print("Downloading chapters...")
-    chapters_dict = {}
-    # Set up the Chrome WebDriver without displaying DevTools messages
-    chrome_options = webdriver.ChromeOptions()
-    chrome_options.add_argument("--log-level=3")  # 3 corresponds to WARNING level
-    chrome_options.add_experimental_option('excludeSwitches', ['enable-logging'])
-    driver = webdriver.Chrome(options=chrome_options)
-
-    for count, chapter in enumerate(chapter_links):
-        driver.get(f"https://fiction.live/{chapter.get('href')}") # Get the chapter page
-        driver.minimize_window() # Minimize the browser window
-        element_locator = (By.XPATH, "//span[text()='New Comment']") # Set the element locator
+# How download_chapters decides a page has finished loading: "adaptive" waits on the number of loaded
+# posts, "fixed" is the old sleep-and-compare loop, kept so the two can be timed against each other
+SCROLL_STRATEGY = "adaptive"
+SCROLL_TIMEOUT = 1.5 # Seconds to wait for new posts before any have been seen loading
+MIN_SCROLL_TIMEOUT = 1 # Bounds on the adaptive wait for new posts after a scroll; never shorter than the
+MAX_SCROLL_TIMEOUT = 5 #   fixed loop's one-second sleep, so a slow last batch of posts isn't cut off
+# Counts the elements loaded into the story posts so far; -1 if the posts haven't been rendered yet
+POST_COUNT_SCRIPT = """
+var posts = document.querySelector('#storyPosts div.jadeRepeat.ng-scope');
+return posts ? posts.getElementsByTagName('*').length : -1;
+"""
+
+def scroll_timeout(load_times):
+    """
+    Returns how long to wait for new posts after scrolling, as a few times the recent load times.
+
+    Args:
+        load_times (list): Seconds it took new posts to appear after earlier scrolls.
+
+    Returns:
+        float: The timeout in seconds.
+    """
+    if not load_times:
+        return SCROLL_TIMEOUT
+    recent = load_times[-10:]
+    return min(max(3 * sum(recent) / len(recent), MIN_SCROLL_TIMEOUT), MAX_SCROLL_TIMEOUT)
+
+def scroll_until_loaded(driver, load_times):
+    """
+    Scrolls to the bottom of the page until a scroll stops loading new posts.
+
+    Rather than sleeping and comparing the whole page, the post count is polled in the browser, so the
+    next scroll starts as soon as new posts appear, and the wait for more adapts to how fast they've loaded.
+
+    Args:
+        driver (webdriver.Chrome): The driver showing the chapter.
+        load_times (list): Seconds it took new posts to appear, shared between pages and added to here.
+    """
+    post_count = driver.execute_script(POST_COUNT_SCRIPT)
+    while True:
+        driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+        scrolled = time.perf_counter()
+        try:
+            WebDriverWait(driver, scroll_timeout(load_times), poll_frequency=0.05).until(
+                lambda d: d.execute_script(POST_COUNT_SCRIPT) != post_count
+            )
+        except TimeoutException: # If no new elements loaded, stop scrolling
+            break
+        load_times.append(time.perf_counter() - scrolled)
+        post_count = driver.execute_script(POST_COUNT_SCRIPT)
+
+def scroll_until_loaded_fixed(driver, load_times):
+    """The old loop: scroll, sleep for a second and parse the whole page until it stops changing."""
+    while True:
+        old_content = BeautifulSoup(driver.page_source, 'html.parser').find('div', id="storyPosts").find('div', class_="jadeRepeat ng-scope")
+        driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+        time.sleep(1) # Wait for any new elements to load
+        new_content = BeautifulSoup(driver.page_source, 'html.parser').find('div', id="storyPosts").find('div', class_="jadeRepeat ng-scope")
+        if old_content == new_content: # If no new elements loaded, break the loop
+            break
+
+def get_story_posts(driver, title, load_times):
+    """
+    Scrolls until every post has loaded, then parses only the story posts, once.
+
+    Args:
+        driver (webdriver.Chrome): The driver showing the chapter.
+        title (str): The title to put at the top of the content.
+        load_times (list): Seconds it took new posts to appear on earlier pages, added to here.
+
+    Returns:
+        bs4.element.Tag: The posts, headed by the title.
+    """
+    scroll = scroll_until_loaded_fixed if SCROLL_STRATEGY == "fixed" else scroll_until_loaded
+    scroll(driver, load_times)
+    posts_html = driver.execute_script("return document.getElementById('storyPosts').innerHTML;")
+    posts_soup = BeautifulSoup(posts_html, 'html.parser') # Create a BeautifulSoup object
+    content = posts_soup.find('div', class_="jadeRepeat ng-scope")
+    # Create a new tag to hold the title
+    title_tag = posts_soup.new_tag('h3')  # 'h1' for large text
+    title_tag.string = title
+    title_tag['style'] = 'font-weight: bold; text-align: center;'  # Make the text bold and centered
+    # Add the title tag to the top of the content
+    content.insert(0, title_tag)
+    return content
+
+def print_timings(label, timings, sizes):
+    """Prints how long each page took to download and how much it transferred, on average, with the pages loading in parallel."""
+    if timings:
+        print(f"\n{label} pages: {len(timings)}, {sum(timings) / len(timings):.2f}s and {sum(sizes) / len(sizes) / 1024:.0f} KB each ({SCROLL_STRATEGY} scrolling)")
+
+def download_page(pool, link, element_locator, title, load_times):
+    """
+    Loads a chapter or appendix page with a driver from the pool and returns its posts.
+
+    Args:
+        pool (DriverPool): The pool to borrow a driver from.
+        link (bs4.element.Tag): The table of contents link to the page.
+        element_locator (tuple): Locates an element that only appears once the page has loaded.
+        title (str): The title to put at the top of the content.
+        load_times (list): Seconds it took new posts to appear on earlier pages, added to here.
+
+    Returns:
+        tuple: The posts (None if the page didn't load), the seconds it took and the bytes it transferred.
+    """
+    started = time.perf_counter()
+    with pool.driver() as driver:
+        transferred_bytes(driver) # Discard anything left over from the driver's last page
+        driver.get(f"https://fiction.live/{link.get('href')}") # Get the page
         try:
             wait =WebDriverWait(driver, 30)
             element = wait.until(EC.presence_of_element_located(element_locator)) # Wait for the element to load
         except TimeoutException:
-            print(f"{Fore.RED}Error: The required element did not load within the specified time.\n\t{chapter.text} could not be downloaded.{Style.RESET_ALL}\n")
-            continue
+            print(f"{Fore.RED}Error: The required element did not load within the specified time.\n\t{link.text} could not be downloaded.{Style.RESET_ALL}\n")
+            return None, time.perf_counter() - started, transferred_bytes(driver)
+        content = get_story_posts(driver, title, load_times)
+        size = transferred_bytes(driver)
+    return content, time.perf_counter() - started, size
+
+def download_pages(pool, links, element_locator, label, load_times):
+    """
+    Downloads pages on every driver in the pool at once, returning them in table of contents order.
+
+    Args:
+        pool (DriverPool): The pool to borrow drivers from.
+        links (list): The table of contents links to the pages.
+        element_locator (tuple): Locates an element that only appears once a page has loaded.
+        label (str): What the pages are called in progress messages.
+        load_times (list): Seconds it took new posts to appear, shared by all the pages.
+
+    Returns:
+        list: (title, posts) pairs in the order of `links`, without the pages that didn't load.
+    """
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        futures = [
+            executor.submit(download_page, pool, link, element_locator, link.text.strip(), load_times)
+            for link in links
+        ]
+        pages = []
+        timings = []
+        sizes = []
+        # Collected in submission order, so the pages stay in order whatever order they finish in
+        for count, (link, future) in enumerate(zip(links, futures)):
+            content, elapsed, size = future.result()
+            if content is None:
+                continue
+            pages.append((link.text.strip(), content))
+            timings.append(elapsed)
+            sizes.append(size)
+            print_loading(f"{label} {count+1}/{len(links)} downloaded in {elapsed:.1f}s, {size / 1024:.0f} KB.")
+    print_timings(label, timings, sizes)
+    return pages
+
+# Function to download the chapters
+def download_chapters(chapter_links, appendix_links, pool):
+    print("Downloading chapters...")
+    load_times = [] # How long new posts took to appear after a scroll, for the adaptive timeout
+    chapter_locator = (By.XPATH, "//span[text()='New Comment']")
+    chapters_dict = dict(download_pages(pool, chapter_links, chapter_locator, "Chapter", load_times))
 
-        # Continually scroll to the bottom of the page until no more new elements are loading
-        while True:
-            old_page = driver.page_source
-            chapter_soup = BeautifulSoup(old_page, 'html.parser') # Create a BeautifulSoup object
-            # Get the chapter content
-            old_chapter_content = chapter_soup.find('div', id="storyPosts")
-            old_chapter_content = old_chapter_content.find('div', class_="jadeRepeat ng-scope")
-            driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-            time.sleep(1) # Wait for any new elements to load
-            new_page = driver.page_source
-            chapter_soup = BeautifulSoup(new_page, 'html.parser') # Create a BeautifulSoup object
-            # Get the chapter content
-            chapter_content = chapter_soup.find('div', id="storyPosts")
-            chapter_content = chapter_content.find('div', class_="jadeRepeat ng-scope")
-            if old_chapter_content == chapter_content: # If no new elements loaded, break the loop
-                break
-
-        # Get the chapter title
-        chapter_title = chapter.text.strip()
-        # Create a new tag to hold the chapter title
-        title_tag = chapter_soup.new_tag('h3')  # 'h1' for large text
-        title_tag.string = chapter_title
-        title_tag['style'] = 'font-weight: bold; text-align: center;'  # Make the text bold and centered
-        # Add the title tag to the top of the chapter content
-        chapter_content.insert(0, title_tag)
-        # Add the chapter to the dictionary
-        chapters_dict[chapter_title] = chapter_content
-        print_loading(f"Chapter {count+1}/{len(chapter_links)} downloaded.")
-        
-        """COMMENT OUT TO STOP TESTING"""
-        #break
-    
     appendix_dict = {}
     if len(appendix_links) > 0:
         print("\nDownloading appendix...")
-        for count, appendix in enumerate(appendix_links):
-            driver.get(f"https://fiction.live/{appendix.get('href')}") # Get the appendix page
-            element_locator = (By.XPATH, "//a[@class='expandComments showWhenDiscussionOpened']") # Set the element locator
-            try:
-                wait =WebDriverWait(driver, 30)
-                element = wait.until(EC.presence_of_element_located(element_locator)) # Wait for the element to load
-            except TimeoutException:
-                print(f"{Fore.RED}Error: The required element did not load within the specified time.\n\t{appendix.text} could not be downloaded.{Style.RESET_ALL}\n")
-                continue
-
-            # Continually scroll to the bottom of the page until no more new elements are loading
-            while True:
-                old_page = driver.page_source
-                appendix_soup = BeautifulSoup(old_page, 'html.parser') # Create a BeautifulSoup object
-                # Get the chapter content
-                old_appendix_content = appendix_soup.find('div', id="storyPosts")
-                old_appendix_content = old_appendix_content.find('div', class_="jadeRepeat ng-scope")
-                driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-                time.sleep(1) # Wait for any new elements to load
-                new_page = driver.page_source
-                appendix_soup = BeautifulSoup(new_page, 'html.parser') # Create a BeautifulSoup object
-                # Get the chapter content
-                appendix_content = appendix_soup.find('div', id="storyPosts")
-                appendix_content = appendix_content.find('div', class_="jadeRepeat ng-scope")
-                if old_appendix_content == appendix_content: # If no new elements loaded, break the loop
-                    break
-                
-                driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-                time.sleep(1) # Wait for any new elements to load
-                new_page = driver.page_source
-                if old_page == new_page: # If no new elements loaded, break the loop
-                    break
-
-            # Get the appendix title
-            appendix_title = appendix.text.strip()
-            # Create a new tag to hold the chapter title
-            title_tag = appendix_soup.new_tag('h3')  # 'h1' for large text
-            title_tag.string = appendix_title
-            title_tag['style'] = 'font-weight: bold; text-align: center;'  # Make the text bold and centered
-            # Add the title tag to the top of the chapter content
-            appendix_content.insert(0, title_tag)
-            # Add the appendix to the dictionary
+        appendix_locator = (By.XPATH, "//a[@class='expandComments showWhenDiscussionOpened']")
+        for appendix_title, appendix_content in download_pages(pool, appendix_links, appendix_locator, "Appendix entry", load_times):
             appendix_dict[f"Appendix: {appendix_title}"] = appendix_content
-            print_loading(f"Appendix entry {count+1}/{len(appendix_links)} downloaded.")
-            
-            """COMMENT OUT TO STOP TESTING"""
-            #break
-
-    driver.quit()
 
     return chapters_dict, appendix_dict
         
@@ -478,7 +535,7 @@ def validate_filename(book, dir_path, epub_path, book_title):
     return epub_path
 
 # The main function
-def main():  # sourcery skip: hoist-statement-from-loop
+def main(pool_size=DEFAULT_POOL_SIZE, max_pages=DEFAULT_MAX_PAGES, lean=True):  # sourcery skip: hoist-statement-from-loop
     # Get the URL(s) of the Table of Contents or Chapter
     story_urls = input("Enter Story URL(s): ")
     #story_urls = "https://fiction.live/stories/Shifting-The-Temporal-Tides/8J6NzhNiq7fE6XHnd" # Testing url 1
@@ -501,14 +558,16 @@ def main():  # sourcery skip: hoist-statement-from-loop
         else:
             break
 
-    # Loop through the URLs and create an EPUB file for each one
-    for count, url in enumerate(story_urls):
-        book_properties, chapter_elements, appendix_elements = get_book_info(url)
-        if book_properties is None:
-            continue
-        book = create_book(book_properties, chapter_elements, appendix_elements, count+1, len(story_urls))
-        save_book(book, dir_path)
-        del book
+    # Loop through the URLs and create an EPUB file for each one, sharing the browsers between them
+    # Lean browsers run headless and skip images, fonts and media; lean=False gives normal windows to compare against
+    with DriverPool(pool_size, max_pages, partial(start_driver, lean=lean)) as pool:
+        for count, url in enumerate(story_urls):
+            book_properties, chapter_elements, appendix_elements = get_book_info(url, pool)
+            if book_properties is None:
+                continue
+            book = create_book(book_properties, chapter_elements, appendix_elements, count+1, len(story_urls), pool)
+            save_book(book, dir_path)
+            del book
 
 # Run the main function if the script is run directly
 if __name__ == "__main__":
@@ -1,22 +1,89 @@
+import json
 import os
-from flask import Flask, render_template, request
-from FictionLiveAPI import main
+import threading
+from flask import Flask, Response, abort, jsonify, render_template, request, send_file
+from FictionLiveStoryDownload.jobs import JobQueue, QueueFullError, FINISHED_STATUSES, DEFAULT_WORKERS
 
 app = Flask(__name__)
+app.config.setdefault('OUTPUT_DIR', os.environ.get('FICTIONLIVE_OUTPUT_DIR', os.path.abspath("output")))
+app.config.setdefault('WORKERS', int(os.environ.get('FICTIONLIVE_WORKERS', DEFAULT_WORKERS)))
+job_queue = None # started with the first job, so importing the app doesn't spawn worker processes
+job_queue_lock = threading.Lock() # so two first requests at once don't start two queues
+
+def get_job_queue():
+    global job_queue
+    with job_queue_lock:
+        if job_queue is None:
+            job_queue = JobQueue(app.config['OUTPUT_DIR'], app.config['WORKERS'])
+        return job_queue
+
+def submit_urls(story_urls):
+    """
+    Queues a job for every URL in a whitespace-separated string.
+
+    Returns:
+        list: The job ids, in URL order.
+
+    Raises:
+        QueueFullError: If the job queue is full.
+    """
+    return [get_job_queue().submit(url) for url in story_urls.split()]
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
         story_urls = request.form['story_urls']
         try:
-            main(story_urls)
-            message = 'EPUB file(s) created successfully!'
-        except Exception as e:
+            job_ids = submit_urls(story_urls)
+            message = f'Queued {len(job_ids)} download(s). Job id(s): {", ".join(job_ids)}'
+        except QueueFullError as e:
             message = f'Error: {str(e)}'
 
         return render_template('index.html', message=message)
 
     return render_template('index.html', message=None)
 
+@app.route('/jobs', methods=['POST'])
+def create_jobs():
+    """Queues one job per URL in 'story_urls' (form or JSON) and returns their ids without waiting for them."""
+    data = request.get_json(silent=True) or request.form
+    if not (story_urls := data.get('story_urls', "").strip()):
+        return jsonify(error="No story URLs given"), 400
+    try:
+        job_ids = submit_urls(story_urls)
+    except QueueFullError as e:
+        return jsonify(error=str(e)), 503
+    return jsonify(jobs=job_ids), 202
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Returns a job's status and progress: chapters done and total, bytes and ETA."""
+    if (job := get_job_queue().get(job_id)) is None:
+        abort(404)
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Streams a job's progress as server-sent events until it finishes."""
+    jobs = get_job_queue()
+    if (job := jobs.get(job_id)) is None:
+        abort(404)
+
+    def events(job):
+        while True:
+            yield f"data: {json.dumps(job)}\n\n"
+            if job is None or job['status'] in FINISHED_STATUSES:
+                return
+            job = jobs.wait(job_id, job['version'])
+
+    return Response(events(job), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/jobs/<job_id>/download')
+def job_download(job_id):
+    """Sends the EPUB file of a finished job."""
+    if (job := get_job_queue().get(job_id)) is None or job['status'] != "written":
+        abort(404)
+    return send_file(job['output_path'], as_attachment=True)
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    app.run(debug=True, threaded=True)
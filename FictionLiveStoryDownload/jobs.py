@@ -0,0 +1,164 @@
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import FictionLiveAPI
+import FictionLiveBatch
+import FictionLiveHTTP
+
+DEFAULT_WORKERS = 2 # stories downloaded at once, each in its own process
+MAX_PENDING_JOBS = 100 # jobs queued or running before new submissions are turned away
+FINISHED_JOB_TTL = 24 * 60 * 60 # seconds a finished job is kept, for its status and its book to be fetched
+MAX_FINISHED_JOBS = 1000 # the most finished jobs kept; the oldest go first
+FINISHED_STATUSES = {"written", "skipped", "failed", "invalid"}
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while MAX_PENDING_JOBS are already waiting or running."""
+
+def report_progress(updates, job_id, update):
+    """Sends a progress update from a worker process back to the JobQueue. Module-level so it can be pickled."""
+    updates.put((job_id, update))
+
+class JobQueue:
+    """
+    Runs story downloads in the background for the web front end.
+
+    Jobs are handed to a pool of `workers` processes, the same way FictionLiveBatch runs a batch, so a
+    request only has to enqueue a job and can return its id straight away. Workers send their progress
+    back through a multiprocessing queue, which a listener thread applies to the job records. Finished jobs
+    are forgotten after FINISHED_JOB_TTL, or sooner once there are more than MAX_FINISHED_JOBS of them.
+
+    Args:
+        output_dir (str): The directory to write EPUB files to.
+        workers (int, optional): The number of worker processes. Defaults to DEFAULT_WORKERS.
+        max_pending (int, optional): The most jobs queued or running at once. Defaults to MAX_PENDING_JOBS.
+        cache_dir (str, optional): The directory of the on-disk HTTP cache, or None. Defaults to FictionLiveHTTP.CACHE_DIR.
+
+    Examples:
+        >>> jobs = JobQueue("output")
+        >>> job_id = jobs.submit("https://fiction.live/stories//12345678912345678")
+        >>> jobs.get(job_id)
+        {'id': '...', 'status': 'running', 'done': 3, 'total': 26, 'bytes': 48213, 'eta': 41.5, ...}
+    """
+    def __init__(self, output_dir, workers=DEFAULT_WORKERS, max_pending=MAX_PENDING_JOBS, cache_dir=FictionLiveHTTP.CACHE_DIR):
+        self.output_dir = output_dir
+        self.max_pending = max_pending
+        os.makedirs(output_dir, exist_ok=True)
+        self._jobs = {}
+        self._changed = threading.Condition()
+        self._manager = multiprocessing.Manager()
+        self._updates = self._manager.Queue()
+        self._executor = ProcessPoolExecutor(max_workers=max(1, workers), initializer=FictionLiveBatch.init_worker,
+                                             initargs=(cache_dir, FictionLiveAPI.PARSER_BACKEND))
+        self._listener = threading.Thread(target=self._listen, daemon=True)
+        self._listener.start()
+
+    def submit(self, url):
+        """
+        Queues a story download.
+
+        Args:
+            url (str): The story URL.
+
+        Returns:
+            str: The job id.
+
+        Raises:
+            QueueFullError: If too many jobs are already pending.
+        """
+        with self._changed:
+            self._prune()
+            pending = sum(job['status'] not in FINISHED_STATUSES for job in self._jobs.values())
+            if pending >= self.max_pending:
+                raise QueueFullError(f"{pending} jobs are already pending; try again later")
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                'id': job_id, 'url': url, 'status': "queued", 'title': None, 'done': 0, 'total': None, 'bytes': 0,
+                'submitted': time.time(), 'started': None, 'finished': None, 'output_path': None, 'error': None,
+                'version': 0,
+            }
+        # rename, so different users downloading stories with the same title never overwrite each other
+        future = self._executor.submit(FictionLiveBatch.package_story, url, self.output_dir, "rename",
+                                       FictionLiveAPI.DEFAULT_JOBS, False, partial(report_progress, self._updates, job_id))
+        future.add_done_callback(partial(self._finished, job_id))
+        return job_id
+
+    def _prune(self):
+        """Forgets the finished jobs past FINISHED_JOB_TTL or MAX_FINISHED_JOBS. Called with the lock held."""
+        finished = sorted((job['finished'] or 0, job_id) for job_id, job in self._jobs.items() if job['status'] in FINISHED_STATUSES)
+        expired = time.time() - FINISHED_JOB_TTL
+        for position, (finished_at, job_id) in enumerate(finished):
+            if finished_at < expired or len(finished) - position > MAX_FINISHED_JOBS:
+                del self._jobs[job_id]
+
+    def _listen(self):
+        while (message := self._updates.get()) is not None:
+            job_id, update = message
+            if update.get('status') == "running":
+                update['started'] = time.time()
+            self._update(job_id, update)
+
+    def _finished(self, job_id, future):
+        try:
+            entry = future.result()
+        except Exception as e: # the worker process itself died
+            entry = {'status': "failed", 'error': f"{type(e).__name__}: {e}"}
+        self._update(job_id, {
+            'status': entry['status'], 'output_path': entry.get('output_path'), 'error': entry.get('error'),
+            'finished': time.time(),
+        })
+
+    def _update(self, job_id, update):
+        with self._changed:
+            if job := self._jobs.get(job_id):
+                if job['status'] in FINISHED_STATUSES: # a late progress message can't reopen the job
+                    update.pop('status', None)
+                job.update(update)
+                job['version'] += 1
+                self._changed.notify_all()
+
+    def get(self, job_id):
+        """
+        Returns a snapshot of a job, with an 'eta' in seconds estimated from its download rate so far.
+
+        Args:
+            job_id (str): The job id.
+
+        Returns:
+            dict: The job, or None if there is no such job.
+        """
+        with self._changed:
+            if (job := self._jobs.get(job_id)) is None:
+                return None
+            job = dict(job)
+        job['eta'] = None
+        if job['status'] == "running" and job['total'] and job['done']:
+            elapsed = time.time() - job['started']
+            job['eta'] = round(elapsed / job['done'] * (job['total'] - job['done']), 1)
+        return job
+
+    def wait(self, job_id, version, timeout=15):
+        """
+        Waits until a job changes past the given version, for server-sent events.
+
+        Args:
+            job_id (str): The job id.
+            version (int): The last version of the job seen.
+            timeout (float, optional): The most seconds to wait. Defaults to 15.
+
+        Returns:
+            dict: The job as get() returns it, changed or not.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: job_id not in self._jobs or self._jobs[job_id]['version'] > version, timeout)
+        return self.get(job_id)
+
+    def shutdown(self):
+        """Waits for the running jobs, cancels the queued ones and stops the worker processes."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._updates.put(None)
+        self._listener.join()
+        self._manager.shutdown()
@@ -0,0 +1,90 @@
+from bs4 import Tag
+
+KEEP_EMPTY = frozenset(('img', 'br')) # tags that mean something without any contents
+
+class Transform:
+    """
+    A step of the clean-up of a chunk or chapter tree, applied by apply_transforms during its single walk over the tree.
+
+    Subclasses override any of start, enter, leave and finish. `tags` limits enter and leave to tags of those names
+    (checked when each is called, so a tag renamed by an earlier transform is seen under its new name), which
+    keeps the walk cheap for transforms that only care about a few tags; None means every tag.
+
+    Examples:
+        >>> class Bold(Transform):
+        ...     tags = {'b'}
+        ...     def enter(self, tag):
+        ...         tag.name = 'strong'
+        >>> apply_transforms(soup, [Bold(), RemoveEmptyTags()])
+    """
+    tags = None
+
+    def start(self, soup):
+        """Called with the tree before it is walked, e.g. to keep it for new_tag."""
+
+    def enter(self, tag):
+        """Called on each tag before its children. May change the tag and its contents."""
+
+    def leave(self, tag):
+        """Called on each tag after its children. May change the tag, or remove it from its parent."""
+
+    def finish(self, soup):
+        """Called once the whole tree has been walked, e.g. to add things that shouldn't be walked themselves."""
+
+class RemoveEmptyTags(Transform):
+    """
+    Removes tags without any contents (except those in KEEP_EMPTY), bottom-up, so a tag whose contents were all
+    empty tags goes as well, in one pass.
+    """
+    def leave(self, tag):
+        if not tag.contents and tag.name not in KEEP_EMPTY:
+            tag.decompose()
+
+def overrides(transform, method):
+    return getattr(type(transform), method) is not getattr(Transform, method)
+
+def dispatch_table(transforms, method):
+    """Returns the bound `method` of each transform that overrides it, as (tag names or None, method) pairs."""
+    return [(transform.tags, getattr(transform, method)) for transform in transforms if overrides(transform, method)]
+
+def apply_transforms(soup, transforms):
+    """
+    Applies transforms to a tree in one walk over it, instead of a find_all or a pass of their own each.
+
+    The start methods of the transforms run first. Then the tags are visited in document order, running the
+    enter methods of each, so a tag's contents are visited as they are after its enter methods (tags inserted
+    there are visited too). Then the tags are visited again in reverse, so every tag comes after all of its
+    descendants, running the leave methods of each; walking a list instead of the tree, this is what lets a
+    leave method remove its tag. The root itself is not visited. Last, the finish methods run. The methods of
+    the transforms run in list order at every step.
+
+    An enter method must not remove its tag from the tree, as the walk goes on from it.
+
+    Args:
+        soup (BeautifulSoup): The tree, changed in place. It must be a whole document, not a tag inside one.
+        transforms (list): The Transform objects to apply.
+
+    Returns:
+        BeautifulSoup: The same tree.
+    """
+    entering = dispatch_table(transforms, 'enter')
+    leaving = dispatch_table(transforms, 'leave')
+    for transform in transforms:
+        transform.start(soup)
+    walked = []
+    node = soup.contents[0] if soup.contents else None
+    while node is not None:
+        if isinstance(node, Tag):
+            for names, enter in entering:
+                if names is None or node.name in names:
+                    enter(node)
+            walked.append(node)
+        node = node.next_element # read after enter, unlike soup.descendants, so it follows the changes
+    if leaving:
+        for tag in reversed(walked):
+            for names, leave in leaving:
+                if names is None or tag.name in names:
+                    leave(tag)
+    for transform in transforms:
+        transform.finish(soup)
+    return soup
@@ -0,0 +1,289 @@
+import argparse
+import heapq
+import os
+import random
+import re
+import statistics
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from colorama import Fore, Style
+import FictionLiveAPI
+import FictionLiveBatch
+import FictionLiveHTTP
+import FictionLiveLibrary
+
+DEFAULT_MAX_CHECKS = 4 # story metadata requests in flight at once, across every followed story
+MIN_CHECK_INTERVAL = 5 * 60 # seconds; no story is checked more often than this
+MAX_CHECK_INTERVAL = 24 * 3600 # seconds; nor less often than this
+DEFAULT_CHECK_INTERVAL = 3600 # seconds between checks of a story with no update history yet
+CHECK_FRACTION = 0.25 # check a story about four times per typical gap between its updates
+SILENCE_FRACTION = 0.1 # a story that has gone quiet is checked less often the longer it has been quiet
+HISTORY_SIZE = 20 # latest updates of a story its typical gap is taken from
+JITTER = 0.2 # check intervals vary by up to this fraction either way, so checks don't come in bursts
+STOP_POLL = 1.0 # seconds between looks at the stop event while waiting
+
+def check_interval(update_times, now, min_interval=MIN_CHECK_INTERVAL, max_interval=MAX_CHECK_INTERVAL):
+    """
+    Works out how long to wait before checking a story again, from when it was last updated.
+
+    A story is checked CHECK_FRACTION of the median gap between its latest updates after each check, so one
+    that updates every hour is checked every quarter of an hour and one that updates weekly a few times a
+    day. A story that has been quiet for longer than that is checked SILENCE_FRACTION of its silence after
+    each check instead, so an abandoned story fades to a daily check.
+
+    Args:
+        update_times (list): When the story was updated, in seconds since the epoch, oldest first.
+        now (float): The current time, in seconds since the epoch.
+        min_interval (float, optional): The shortest interval. Defaults to MIN_CHECK_INTERVAL.
+        max_interval (float, optional): The longest interval. Defaults to MAX_CHECK_INTERVAL.
+
+    Returns:
+        float: The seconds until the next check, before jitter.
+
+    Examples:
+        >>> check_interval([0, 3600, 7200], 7300)
+        900.0
+    """
+    gaps = [later - earlier for earlier, later in zip(update_times, update_times[1:]) if later > earlier]
+    interval = statistics.median(gaps) * CHECK_FRACTION if gaps else DEFAULT_CHECK_INTERVAL
+    if update_times:
+        interval = max(interval, (now - update_times[-1]) * SILENCE_FRACTION)
+    return float(min(max_interval, max(min_interval, interval)))
+
+def fetch_metadata(story_id):
+    """Fetches a story's metadata on a check thread, returning None if it can't be."""
+    try:
+        return FictionLiveAPI.get_book_info(f"https://fiction.live/api/node/{story_id}")
+    except Exception as e:
+        print(f"{Fore.RED}Error checking {story_id}: {type(e).__name__}: {e}{Style.RESET_ALL}")
+        return None
+
+class Watcher:
+    """
+    Keeps the books of a list of followed stories current, checking each story's metadata on a schedule of its own.
+
+    Every check is a single /api/node request. The story is rebuilt (see FictionLiveBatch.package_story, which
+    updates the book in place) only when its 'cht' or its bookmark list differs from the book's record in the
+    library; the metadata just fetched is passed on, so the rebuild doesn't fetch it again. Each 'cht' seen is
+    added to the story's update history in the library, and the next check is scheduled from that history by
+    check_interval, give or take JITTER. Stories with no history yet go by their bookmark times, and the first
+    checks are spread over the first `min_interval` seconds rather than all made at once.
+
+    The checks due are made earliest first, at most `max_checks` at once over all the stories, and the
+    rebuilds run on `workers` processes. A check that fails is retried after twice as long as the last
+    retry, starting from `min_interval`. The URL list is read again whenever the file changes.
+
+    Args:
+        list_path (str): The file of story URLs, as FictionLiveBatch.read_url_list reads it.
+        dir_path (str): The output directory.
+        library_path (str, optional): The library file. Defaults to FictionLiveLibrary.LIBRARY_NAME in the output directory.
+        max_checks (int, optional): The most metadata requests in flight at once. Defaults to DEFAULT_MAX_CHECKS.
+        workers (int, optional): The most stories rebuilt at once, each in its own process. Defaults to 1.
+        min_interval (float, optional): The shortest time between checks of a story. Defaults to MIN_CHECK_INTERVAL.
+        max_interval (float, optional): The longest time between checks of a story. Defaults to MAX_CHECK_INTERVAL.
+        seed (int, optional): Seeds the jitter, for repeatable schedules. Defaults to None.
+        **build_options: cache_dir, parser_backend, rate_limit, jobs, stream, image_options and metrics_dir,
+            as for FictionLiveBatch.run_batch.
+
+    Examples:
+        >>> watcher = Watcher("followed.txt", "output", max_checks=2)
+        >>> watcher.run() # until interrupted
+        21:04:12 updated Story Title (3 chapters changed, 41.2s)
+    """
+    def __init__(self, list_path, dir_path, library_path=None, max_checks=DEFAULT_MAX_CHECKS, workers=1,
+                 min_interval=MIN_CHECK_INTERVAL, max_interval=MAX_CHECK_INTERVAL, seed=None, **build_options):
+        self.list_path = list_path
+        self.dir_path = dir_path
+        self.library_path = library_path or os.path.join(dir_path, FictionLiveLibrary.LIBRARY_NAME)
+        self.max_checks = max(1, max_checks)
+        self.workers = max(1, workers)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.random = random.Random(seed)
+        self.build_options = build_options
+        self.urls = {} # story id -> URL of every followed story
+        self.failures = {} # story id -> checks failed in a row
+        self.counts = dict.fromkeys(("checks", "failed_checks", "rebuilds"), 0)
+        self._due = [] # heap of (due time, story id)
+        self._list_mtime = None
+
+    def jittered(self, interval):
+        return interval * self.random.uniform(1 - JITTER, 1 + JITTER)
+
+    def schedule(self, story_id, delay):
+        heapq.heappush(self._due, (time.time() + delay, story_id))
+
+    def reload_urls(self):
+        """Reads the URL list again if it changed, scheduling a first check of every story new to it."""
+        try:
+            mtime = os.path.getmtime(self.list_path)
+        except OSError:
+            return
+        if mtime == self._list_mtime:
+            return
+        self._list_mtime = mtime
+        urls = {}
+        for url in FictionLiveBatch.read_url_list(self.list_path):
+            if url_match := re.match(FictionLiveAPI.STORY_URL_PATTERN, url):
+                urls[url_match[2]] = url
+            else:
+                print(f"{Fore.RED}Not a fiction.live story URL: {url}{Style.RESET_ALL}")
+        for story_id in urls.keys() - self.urls.keys():
+            self.schedule(story_id, self.random.uniform(0, self.min_interval))
+        self.urls = urls # stories no longer listed are dropped when their check comes up
+
+    def next_check(self, story_id, book_data):
+        """Returns the seconds until a story that was just checked should be checked again, with jitter."""
+        update_times = [cht / 1000 for cht in self.library.update_history(story_id, HISTORY_SIZE)]
+        if len(update_times) < 3: # not watched for long enough, so go by when its chapters started
+            update_times = sorted({*update_times, *(bookmark['ct'] / 1000 for bookmark in book_data.get('bm') or [] if 'ct' in bookmark)})
+            update_times = update_times[-HISTORY_SIZE:]
+        return self.jittered(check_interval(update_times, time.time(), self.min_interval, self.max_interval))
+
+    def checked(self, story_id, book_data, building):
+        """
+        Handles the result of a check: records the story's 'cht', queues a rebuild if its chapters changed, and schedules the next check.
+
+        Returns:
+            bool: Whether the story should be rebuilt.
+        """
+        self.counts['checks'] += 1
+        if book_data is None:
+            self.counts['failed_checks'] += 1
+            self.failures[story_id] = failures = self.failures.get(story_id, 0) + 1
+            self.schedule(story_id, self.jittered(min(self.max_interval, self.min_interval * 2 ** (failures - 1))))
+            return False
+        self.failures.pop(story_id, None)
+        self.library.note_update(story_id, book_data.get('cht'))
+        self.schedule(story_id, self.next_check(story_id, book_data))
+        if story_id in building: # the next check will catch anything the running rebuild misses
+            return False
+        decision, _ = self.library.check(book_data)
+        return decision in (FictionLiveLibrary.NEW, FictionLiveLibrary.UPDATE) # not REBUILD: the word count alone doesn't count
+
+    def report(self, entry):
+        color = {"written": Fore.GREEN, "updated": Fore.GREEN, "unchanged": Fore.YELLOW}.get(entry['status'], Fore.RED)
+        changed = entry.get('changed_chapters')
+        details = [f"{changed} chapter{'' if changed == 1 else 's'} changed"] if changed is not None else []
+        details.append(f"{entry['timings']['total']:.1f}s")
+        print(f"{time.strftime('%H:%M:%S')} {color}{entry['status']}{Style.RESET_ALL} {entry.get('title', entry['url'])}"
+              f" ({', '.join(details)}){': ' + entry['error'] if 'error' in entry else ''}")
+
+    def run(self, stop=None):
+        """
+        Checks and rebuilds the followed stories until `stop` is set (or the process is interrupted).
+
+        Args:
+            stop (threading.Event, optional): Set to stop watching; the rebuilds already running are finished first. Defaults to None.
+
+        Returns:
+            dict: How many checks were made, how many of them failed, and how many stories were rebuilt.
+        """
+        stop = stop or threading.Event()
+        options = self.build_options
+        FictionLiveBatch.init_worker(options.get('cache_dir', FictionLiveHTTP.CACHE_DIR),
+                                     options.get('parser_backend', FictionLiveAPI.PARSER_BACKEND), options.get('rate_limit', True))
+        self.library = FictionLiveLibrary.Library(self.library_path) # only used on this thread
+        checks = {} # future -> story id
+        builds = {} # future -> story id
+        check_executor = ThreadPoolExecutor(max_workers=self.max_checks)
+        build_executor = ProcessPoolExecutor(max_workers=self.workers, initializer=FictionLiveBatch.init_worker,
+                                             initargs=(options.get('cache_dir', FictionLiveHTTP.CACHE_DIR),
+                                                       options.get('parser_backend', FictionLiveAPI.PARSER_BACKEND),
+                                                       options.get('rate_limit', True), None, None, self.library_path))
+        try:
+            while not stop.is_set():
+                self.reload_urls()
+                now = time.time()
+                while self._due and self._due[0][0] <= now and len(checks) < self.max_checks:
+                    _, story_id = heapq.heappop(self._due)
+                    if story_id in self.urls and story_id not in checks.values():
+                        checks[check_executor.submit(fetch_metadata, story_id)] = story_id
+                timeout = STOP_POLL
+                if self._due and len(checks) < self.max_checks:
+                    timeout = min(timeout, max(0.0, self._due[0][0] - now))
+                if not checks and not builds:
+                    stop.wait(timeout)
+                    continue
+                done, _ = wait([*checks, *builds], timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in builds:
+                        del builds[future]
+                        self.report(future.result())
+                        continue
+                    story_id = checks.pop(future)
+                    book_data = future.result()
+                    if self.checked(story_id, book_data, set(builds.values())):
+                        self.counts['rebuilds'] += 1
+                        builds[build_executor.submit(FictionLiveBatch.package_story, self.urls[story_id], self.dir_path, "skip",
+                                                     options.get('jobs', FictionLiveAPI.DEFAULT_JOBS), options.get('stream', False),
+                                                     None, options.get('image_options'), options.get('metrics_dir'), book_data)] = story_id
+        finally:
+            check_executor.shutdown(wait=True, cancel_futures=True)
+            build_executor.shutdown(wait=True)
+            for future in builds:
+                if not future.cancelled() and future.exception() is None:
+                    self.report(future.result())
+            self.library.close()
+        return dict(self.counts)
+
+def parse_arguments(argv=None):
+    """
+    Parses the command line options.
+
+    Args:
+        argv (list, optional): The arguments to parse. Defaults to sys.argv[1:].
+
+    Returns:
+        argparse.Namespace: The parsed options.
+    """
+    parser = argparse.ArgumentParser(description="Keep the EPUB files of followed fiction.live stories current, checking each story "
+                                                 "as often as it tends to update and rebuilding it only when its chapters change.")
+    parser.add_argument('url_list', help="file with one story URL per line ('#' starts a comment); read again whenever it changes")
+    parser.add_argument('output_dir', help="directory to write the EPUB files to")
+    parser.add_argument('--library', metavar='PATH',
+                        help=f"the SQLite library the books and update history are kept in (default: OUTPUT_DIR/{FictionLiveLibrary.LIBRARY_NAME})")
+    parser.add_argument('--max-checks', type=int, default=DEFAULT_MAX_CHECKS,
+                        help=f"most story metadata requests in flight at once (default: {DEFAULT_MAX_CHECKS})")
+    parser.add_argument('--min-interval', type=float, default=MIN_CHECK_INTERVAL, metavar='SECONDS',
+                        help=f"shortest time between checks of a story (default: {MIN_CHECK_INTERVAL})")
+    parser.add_argument('--max-interval', type=float, default=MAX_CHECK_INTERVAL, metavar='SECONDS',
+                        help=f"longest time between checks of a story (default: {MAX_CHECK_INTERVAL})")
+    parser.add_argument('--seed', type=int, help="seed the jitter, for repeatable schedules")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="number of stories to rebuild at once, each in its own process (default: 1)")
+    parser.add_argument('-j', '--jobs', type=int, default=FictionLiveAPI.DEFAULT_JOBS,
+                        help=f"number of chapters each rebuild downloads at once (default: {FictionLiveAPI.DEFAULT_JOBS})")
+    parser.add_argument('--cache-dir', default=FictionLiveHTTP.CACHE_DIR,
+                        help=f"directory of the on-disk HTTP cache (default: {FictionLiveHTTP.CACHE_DIR})")
+    parser.add_argument('--no-cache', dest='cache_dir', action='store_const', const=None,
+                        help="don't read or write the on-disk HTTP cache")
+    parser.add_argument('--no-rate-limit', dest='rate_limit', action='store_false',
+                        help="send requests as fast as the checks and jobs allow instead of adapting to how the servers respond")
+    parser.add_argument('--parser', choices=["lxml", "html5lib"], default=FictionLiveAPI.PARSER_BACKEND,
+                        help=f"HTML parser for chapter text (default: {FictionLiveAPI.PARSER_BACKEND})")
+    FictionLiveAPI.add_image_arguments(parser)
+    parser.add_argument('--metrics-dir', metavar='DIR',
+                        help="write a JSON trace (<story id>.trace.json) and Prometheus metrics (<story id>.prom) of every rebuild to DIR")
+    parser.add_argument('--stream', action='store_true', help="write chapters to the EPUB files as they are ready")
+    args = parser.parse_args(argv)
+    if args.max_checks < 1 or args.workers < 1 or args.jobs < 1:
+        parser.error("--max-checks, --workers and --jobs must be at least 1")
+    if not 0 < args.min_interval <= args.max_interval:
+        parser.error("--min-interval must be positive and no more than --max-interval")
+    if not os.path.isdir(args.output_dir):
+        parser.error(f"{args.output_dir} is not a directory")
+    return args
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    watcher = Watcher(args.url_list, args.output_dir, args.library, args.max_checks, args.workers, args.min_interval,
+                      args.max_interval, args.seed, cache_dir=args.cache_dir, parser_backend=args.parser, rate_limit=args.rate_limit,
+                      jobs=args.jobs, stream=args.stream, image_options=FictionLiveAPI.image_options_from_arguments(args),
+                      metrics_dir=args.metrics_dir)
+    print(f"Watching the stories in {args.url_list}, press Ctrl+C to stop.")
+    try:
+        counts = watcher.run()
+    except KeyboardInterrupt:
+        counts = watcher.counts
+    print(f"{counts['checks']} checks ({counts['failed_checks']} failed), {counts['rebuilds']} rebuilds.")
@@ -0,0 +1,54 @@
+"""
+Benchmarks FictionLiveAPI.get_book_content against a fake fiction.live with a fixed per-request latency.
+
+Shows the wall-clock time of downloading one book as the number of download workers goes up, and with
+--per-request, as neighbouring chapters are fetched together (see FictionLiveAPI.plan_range_requests).
+
+Usage:
+    python benchmarks/bench_concurrent_download.py [--chapters 200] [--latency 0.05] [--jobs 1 2 4 8 16] [--per-request 1 8 64]
+"""
+import argparse
+import contextlib
+import io
+import time
+
+from ebooklib import epub
+from common import FakeSession, FictionLiveAPI
+
+def make_book_data(chapter_count):
+    return {
+        '_id': 'benchmarkStory01x',
+        'ct': 1000,
+        'cht': 1000 + chapter_count * 10,
+        'bm': [{'title': f"Chapter {i}", 'ct': 1000 + i * 10} for i in range(1, chapter_count)],
+    }
+
+def time_download(book_data, jobs, per_request=1):
+    chapters_list, appendices_list, routes_list = FictionLiveAPI.get_book_map(book_data)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        FictionLiveAPI.get_book_content(chapters_list, appendices_list, routes_list, epub.EpubBook(), jobs, per_request=per_request)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chapters', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds per request")
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    parser.add_argument('--per-request', type=int, nargs='+', default=[1], help="chapters fetched with each request")
+    args = parser.parse_args()
+
+    book_data = make_book_data(args.chapters)
+
+    print(f"{args.chapters} chapters, {args.latency * 1000:.0f} ms per request")
+    print(f"{'jobs':>6} {'per req':>8} {'requests':>9} {'seconds':>10} {'speedup':>8}")
+    baseline = None
+    for per_request in args.per_request:
+        for jobs in args.jobs:
+            FictionLiveAPI.session = session = FakeSession(latency=args.latency)
+            elapsed = time_download(book_data, jobs, per_request)
+            baseline = baseline or elapsed
+            print(f"{jobs:>6} {per_request:>8} {session.requests:>9} {elapsed:>10.2f} {baseline / elapsed:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Compares the peak memory of packaging a book with ebooklib's write_epub and with FictionLiveEpub.StreamingEpubBook.
+
+Chapters of a fixed size are added one at a time, like download_and_add_to_book does, for growing chapter counts.
+The in-memory peak grows with the number of chapters, the streaming peak should stay flat.
+
+Usage:
+    python benchmarks/bench_epub_memory.py [--chapters 100 400 1600] [--chapter-kb 20]
+"""
+import argparse
+import os
+import tempfile
+import tracemalloc
+
+from ebooklib import epub
+import common # puts the repository on sys.path
+import FictionLiveEpub
+
+def package(chapter_count, chapter_bytes, out_dir, streaming):
+    epub_path = os.path.join(out_dir, f"bench_{streaming}.epub")
+    book = FictionLiveEpub.StreamingEpubBook(f"{epub_path}.part") if streaming else epub.EpubBook()
+    book.set_title("Benchmark Story")
+    book.add_item(epub.EpubNav())
+    paragraph = b"<p>" + b"All work and no play makes a long quest. " * 20 + b"</p>"
+    for number in range(1, chapter_count + 1):
+        chapter = epub.EpubHtml(title=f"Chapter {number}", file_name=f"chap_{number}.xhtml", lang="en")
+        chapter.content = paragraph * (chapter_bytes // len(paragraph))
+        book.add_item(chapter)
+        book.toc += (epub.Link(chapter.file_name, chapter.title, chapter.title),)
+    book.spine = list(book.get_items())
+    book.add_item(epub.EpubNcx())
+    if streaming:
+        book.finish(epub_path)
+    else:
+        epub.write_epub(epub_path, book)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chapters', type=int, nargs='+', default=[100, 400, 1600])
+    parser.add_argument('--chapter-kb', type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'chapters':>8} {'in memory MB':>13} {'streaming MB':>13}")
+    with tempfile.TemporaryDirectory() as out_dir:
+        for chapter_count in args.chapters:
+            peaks = []
+            for streaming in (False, True):
+                tracemalloc.start()
+                package(chapter_count, args.chapter_kb * 1024, out_dir, streaming)
+                peaks.append(tracemalloc.get_traced_memory()[1] / 2**20)
+                tracemalloc.stop()
+            print(f"{chapter_count:>8} {peaks[0]:>13.1f} {peaks[1]:>13.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+"""
+Measures how many chunk bodies per second FictionLiveAPI.make_soup parses with each parser backend.
+
+Usage:
+    python benchmarks/bench_parser.py [--repeat 200]
+"""
+import argparse
+import time
+
+from common import FictionLiveAPI, load_fixture_chapters
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=200, help="passes over the fixture chunks per backend")
+    args = parser.parse_args()
+
+    bodies = [chunk['b'] for chunks in load_fixture_chapters().values() for chunk in chunks if chunk.get('b') and chunk['nt'] == 'chapter']
+    well_formed = sum(FictionLiveAPI.is_well_formed(body) for body in bodies)
+    print(f"{len(bodies)} fixture chunks, {well_formed} well-formed")
+    print(f"{'backend':<10} {'chunks/s':>10}")
+    for backend in ["html5lib", "lxml"]:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for body in bodies:
+                FictionLiveAPI.make_soup(body, backend)
+        elapsed = time.perf_counter() - start
+        print(f"{backend:<10} {len(bodies) * args.repeat / elapsed:>10.0f}")
+
+if __name__ == "__main__":
+    main()
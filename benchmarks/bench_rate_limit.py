@@ -0,0 +1,113 @@
+"""
+Shows how FictionLiveHTTP's adaptive rate limiter settles against a local server that only tolerates a fixed
+number of requests per second, answering anything over it with 429 and Retry-After: 1.
+
+For each server capacity, prints the throughput reached, the 429s the server had to send and the limits the
+limiter ended on. A good limiter gets close to the capacity while the client never sees a 429 itself.
+
+Then a server that never throttles is sent node requests mixed with chapter-range requests for many chapters,
+which take --range-ms to answer, and the odd range for a single chapter (as the last chapter of a story always
+is), answered as fast as a node request. The slow answers are the size of the response, not overload, so the
+limiter should keep its rate up and back off (count under 'backoffs') little or not at all.
+
+Usage:
+    python benchmarks/bench_rate_limit.py [--requests 400] [--threads 32] [--capacity 20 60 150] [--range-ms 200]
+"""
+import argparse
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+import common # puts the repository on sys.path
+import FictionLiveHTTP
+
+class ThrottlingServer(ThreadingHTTPServer):
+    """A server answering 200 to at most `capacity` requests in any second, and 429 to the rest."""
+    daemon_threads = True
+
+    def __init__(self, capacity, latency=0.02, range_latency=None):
+        self.capacity = capacity
+        self.latency = latency
+        self.range_latency = range_latency if range_latency is not None else latency # for chapter-range requests
+        self.recent = deque()
+        self.statuses = Counter()
+        self.lock = threading.Lock()
+        super().__init__(('127.0.0.1', 0), ThrottlingHandler)
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        now = time.monotonic()
+        with server.lock:
+            server.recent.append(now)
+            while server.recent[0] < now - 1:
+                server.recent.popleft()
+            status = 429 if len(server.recent) > server.capacity else 200
+            server.statuses[status] += 1
+        parts = self.path.rstrip('/').split('/')
+        large_range = self.path.startswith("/api/anonkun/chapters/") and parts[-2] != parts[-1]
+        time.sleep(server.range_latency if large_range else server.latency)
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        if status == 429:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+def run(capacity, request_count, threads):
+    server = ThrottlingServer(capacity)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    session = requests.Session()
+    limiter = FictionLiveHTTP.install_rate_limiter(session, {'127.0.0.1': FictionLiveHTTP.RATE_LIMITS['fiction.live']})
+    url = f"http://127.0.0.1:{server.server_port}/"
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        client_statuses = Counter(executor.map(lambda _: session.get(url).status_code, range(request_count)))
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    host = limiter.hosts['127.0.0.1']
+    print(f"{capacity:>9} {request_count / elapsed:>10.1f} {server.statuses[429]:>11} {client_statuses[429]:>11} {host.rate:>6.1f} {host.concurrency:>7.1f}")
+
+def run_mixed(request_count, threads, range_latency):
+    server = ThrottlingServer(10 ** 6, range_latency=range_latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    session = requests.Session()
+    limiter = FictionLiveHTTP.install_rate_limiter(session)
+    FictionLiveHTTP.install_replay(session, f"http://127.0.0.1:{server.server_port}/")
+    def fetch(number): # one chapter-range request in four, one in eight of them for a single chapter
+        if number % 4 == 0:
+            end = number if number % 32 == 0 else number + 1
+            return session.get(f"https://fiction.live/api/anonkun/chapters/benchmarkStory01x/{number}/{end}/").status_code
+        return session.get(f"https://fiction.live/api/node/benchmarkStory{number:02d}").status_code
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(fetch, range(request_count)))
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    host = limiter.hosts['fiction.live']
+    print(f"{range_latency * 1000:>9.0f} {request_count / elapsed:>10.1f} {host.throttled:>9} {host.rate:>6.1f} {host.concurrency:>7.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--threads', type=int, default=32, help="threads sending requests at once")
+    parser.add_argument('--capacity', type=int, nargs='+', default=[20, 60, 150], help="requests per second the server tolerates")
+    parser.add_argument('--range-ms', type=float, default=200.0, help="milliseconds to answer a chapter-range request in the mixed run")
+    args = parser.parse_args()
+
+    print(f"{'capacity':>9} {'req/s':>10} {'server 429':>11} {'client 429':>11} {'rate':>6} {'window':>7}")
+    for capacity in args.capacity:
+        run(capacity, args.requests, args.threads)
+
+    print(f"\nnode requests mixed with chapter-range requests:")
+    print(f"{'range ms':>9} {'req/s':>10} {'backoffs':>9} {'rate':>6} {'window':>7}")
+    run_mixed(args.requests, args.threads, args.range_ms / 1000)
+
+if __name__ == "__main__":
+    main()
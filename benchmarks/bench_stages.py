@@ -0,0 +1,171 @@
+"""
+Times the stages of turning chunks into chapter XHTML, one function at a time, on the fixtures in
+fixtures/stages: long prose chunks, polls with thousands of votes, reader posts with dice, and text full of
+achievements and spoilers, plus a story with hundreds of bookmarks and routes for get_book_map.
+
+For each stage, prints the per-call latency (mean, median and 95th percentile) and the throughput in calls
+and input kilobytes per second. --save stores the results in results/<commit>.json (with "-dirty" when the
+working tree has uncommitted changes), and --compare shows how the current run differs from stored results,
+flagging stages that got slower by more than --threshold percent. Only compare results from the same machine.
+
+Usage:
+    python benchmarks/bench_stages.py [--repeat 20] [--stage count_votes ...] [--save [NAME]] [--compare NAME]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from bs4 import BeautifulSoup
+from common import BENCHMARK_DIR, FictionLiveAPI, load_fixture_story, load_stage_fixtures
+
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+MIN_CALLS = 200 # stages with few fixtures get extra passes, so their percentiles mean something
+
+def chunk_size(chunk):
+    return len(json.dumps(chunk).encode('utf-8'))
+
+def chapter_html(chunks):
+    """The HTML getChapterText parses for a chapter made of these chapter chunks."""
+    return "".join(f"<div>{FictionLiveAPI.format_chapter(chunk)}</div>\n" for chunk in chunks)
+
+def build_cases(fixtures):
+    """
+    Builds the inputs of every stage.
+
+    Returns:
+        dict: For each stage, a list of (prepare, run, size) cases. prepare() makes the argument of run()
+              outside the timed region, for stages that modify their input; size is the input size in bytes.
+    """
+    text_chunks = fixtures['prose'] + fixtures['achievements_spoilers']
+    bodies = [chunk['b'] for chunk in text_chunks]
+    soup_sources = [chapter_html(fixtures['prose'][i:i+4]) for i in range(0, len(fixtures['prose']), 4)]
+    soup_sources.append(chapter_html(fixtures['achievements_spoilers']))
+
+    def same(value):
+        return lambda: value
+
+    return {
+        'make_soup': [(same(body), FictionLiveAPI.make_soup, len(body.encode('utf-8'))) for body in bodies],
+        'format_chapter': [(same(chunk), FictionLiveAPI.format_chapter, chunk_size(chunk)) for chunk in text_chunks],
+        'count_votes': [(same(chunk), FictionLiveAPI.count_votes, chunk_size(chunk)) for chunk in fixtures['polls']],
+        'format_choice': [(same(chunk), FictionLiveAPI.format_choice, chunk_size(chunk)) for chunk in fixtures['polls']],
+        # format_readerposts deletes the posts it shows next to a roll, so every call gets its own copy
+        'format_readerposts': [(lambda chunk=chunk: dict(chunk, votes=dict(chunk['votes'])), FictionLiveAPI.format_readerposts, chunk_size(chunk))
+                               for chunk in fixtures['reader_posts']],
+        'remove_empty_tags': [(lambda source=source: BeautifulSoup(source, "html.parser"), FictionLiveAPI.remove_empty_tags, len(source.encode('utf-8')))
+                              for source in soup_sources],
+        'clean_chapter': [(lambda source=source: BeautifulSoup(source, "html.parser"), lambda soup: FictionLiveAPI.clean_chapter(soup, "Chapter"),
+                           len(source.encode('utf-8'))) for source in soup_sources],
+        'get_book_map': [(same(fixtures['book_map']), FictionLiveAPI.get_book_map, chunk_size(fixtures['book_map']))],
+    }
+
+def measure(cases, repeat):
+    """
+    Runs every case `repeat` times (or more, to make at least MIN_CALLS calls), after one untimed warm-up pass.
+
+    Returns:
+        dict: The number of calls, the latency statistics in microseconds and the throughput.
+    """
+    for prepare, run, _ in cases:
+        run(prepare())
+    timings = []
+    size = 0
+    for _ in range(max(repeat, -(-MIN_CALLS // len(cases)))):
+        for prepare, run, case_size in cases:
+            argument = prepare()
+            start = time.perf_counter()
+            run(argument)
+            timings.append(time.perf_counter() - start)
+            size += case_size
+    total = sum(timings)
+    return {
+        'calls': len(timings),
+        'mean_us': total / len(timings) * 1e6,
+        'median_us': statistics.median(timings) * 1e6,
+        'p95_us': statistics.quantiles(timings, n=20)[-1] * 1e6 if len(timings) > 1 else timings[0] * 1e6,
+        'calls_per_s': len(timings) / total,
+        'kb_per_s': size / 1024 / total,
+    }
+
+def git_revision():
+    """Returns the short hash of HEAD, with "-dirty" if tracked files have changed, or None outside a git checkout."""
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        changes = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=BENCHMARK_DIR, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{revision}-dirty" if changes.strip() else revision
+
+def results_path(name):
+    return os.path.join(RESULTS_DIR, f"{name}.json")
+
+def print_results(stages, baseline, threshold):
+    """Prints the results table, with the change against the baseline if there is one. Returns the regressed stages."""
+    header = f"{'stage':<20} {'calls':>7} {'mean µs':>10} {'median µs':>10} {'p95 µs':>10} {'calls/s':>10} {'KB/s':>10}"
+    print(header + (f" {'vs ' + baseline['revision']:>16}" if baseline else ""))
+    regressions = []
+    for name, result in stages.items():
+        line = (f"{name:<20} {result['calls']:>7} {result['mean_us']:>10.1f} {result['median_us']:>10.1f} {result['p95_us']:>10.1f}"
+                f" {result['calls_per_s']:>10.0f} {result['kb_per_s']:>10.0f}")
+        if baseline and (before := baseline['stages'].get(name)):
+            change = (result['median_us'] / before['median_us'] - 1) * 100
+            flag = ""
+            if change > threshold:
+                flag = " slower"
+                regressions.append(name)
+            line += f" {change:>+9.1f}%{flag:<6}"
+        print(line)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20, help="timed passes over each stage's fixtures")
+    parser.add_argument('--stage', nargs='+', help="only run these stages")
+    parser.add_argument('--parser', choices=["lxml", "html5lib"], default=FictionLiveAPI.PARSER_BACKEND, help="make_soup backend")
+    parser.add_argument('--save', nargs='?', const="", metavar='NAME', help="store the results as results/NAME.json (default: the git revision)")
+    parser.add_argument('--compare', metavar='NAME', help="compare with stored results/NAME.json")
+    parser.add_argument('--threshold', type=float, default=10, help="percent by which a stage's median may grow before it counts as slower (default: 10)")
+    args = parser.parse_args()
+
+    FictionLiveAPI.PARSER_BACKEND = args.parser
+    FictionLiveAPI.achievements = FictionLiveAPI.build_achievement_index(load_fixture_story())
+    cases = build_cases(load_stage_fixtures())
+    if unknown := set(args.stage or []) - set(cases):
+        parser.error(f"unknown stage(s): {', '.join(sorted(unknown))}; choose from {', '.join(cases)}")
+
+    baseline = None
+    if args.compare:
+        with open(results_path(args.compare), encoding='utf-8') as results_file:
+            baseline = json.load(results_file)
+        baseline['revision'] = baseline.get('revision') or args.compare
+
+    stages = {name: measure(stage_cases, args.repeat) for name, stage_cases in cases.items() if not args.stage or name in args.stage}
+    results = {
+        'revision': git_revision(),
+        'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'machine': f"{platform.system()} {platform.machine()} {platform.processor()}".strip(),
+        'parser': args.parser,
+        'repeat': args.repeat,
+        'stages': stages,
+    }
+    print(f"{results['revision'] or 'unknown revision'}, Python {results['python']}, {args.parser} parser, {args.repeat} passes")
+    regressions = print_results(stages, baseline, args.threshold)
+
+    if args.save is not None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = results_path(args.save or results['revision'] or time.strftime("%Y%m%d-%H%M%S"))
+        with open(path, 'w', encoding='utf-8') as results_file:
+            json.dump(results, results_file, indent=2)
+        print(f"Results saved to {path}")
+    if regressions:
+        print(f"{len(regressions)} stage(s) more than {args.threshold:g}% slower than {baseline['revision']}: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Checks that every parser backend renders the fixture chapters exactly as the golden files in fixtures/golden say.
+
+The golden files were rendered with the original double html5lib parse, so a clean run shows a backend change
+leaves the EPUB XHTML untouched. Pass --regenerate after an intended change to the output.
+
+Usage:
+    python benchmarks/check_golden.py [--regenerate]
+"""
+import argparse
+import os
+import sys
+
+from common import FIXTURE_DIR, FictionLiveAPI, load_fixture_chapters, render_chapter
+
+BACKENDS = ["html5lib", "lxml"]
+
+def golden_path(name):
+    return os.path.join(FIXTURE_DIR, "golden", f"{name}.xhtml")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--regenerate', action='store_true', help="rewrite the golden files with the html5lib backend")
+    args = parser.parse_args()
+
+    chapters = load_fixture_chapters()
+    if args.regenerate:
+        os.makedirs(os.path.join(FIXTURE_DIR, "golden"), exist_ok=True)
+        FictionLiveAPI.PARSER_BACKEND = "html5lib"
+        for name, chunks in chapters.items():
+            with open(golden_path(name), 'wb') as golden_file:
+                golden_file.write(render_chapter(name, chunks))
+        print(f"Regenerated {len(chapters)} golden files.")
+        return
+
+    failures = 0
+    for backend in BACKENDS:
+        FictionLiveAPI.PARSER_BACKEND = backend
+        for name, chunks in chapters.items():
+            with open(golden_path(name), 'rb') as golden_file:
+                expected = golden_file.read()
+            matches = render_chapter(name, chunks) == expected
+            failures += not matches
+            print(f"{'ok  ' if matches else 'FAIL'} {backend:<9} {name}")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
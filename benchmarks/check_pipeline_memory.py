@@ -0,0 +1,86 @@
+"""
+Checks that the peak memory of building a streamed book stays flat as the number of chapters grows.
+
+Books of growing length are built with FictionLiveAPI.get_book_content into a FictionLiveEpub.StreamingEpubBook,
+against a fake fiction.live, under tracemalloc. With the downloads kept CHAPTERS_AHEAD_PER_JOB chapters per
+thread ahead of the book and each chapter's tree let go of once it is packaged, the peak should only grow
+with the book's manifest, zip directory and table of contents (a KB or two per chapter), not with the
+chapters' trees. Packaging is slowed down by --package-ms per chapter, as by a slow disk or embedding images,
+so the downloads can run ahead of it; each book is also built with unbounded read-ahead, which is how the
+downloads were queued before, for comparison. Exits with status 1 if the peak grows by more than
+--max-kb-per-chapter for each chapter added.
+
+Usage:
+    python benchmarks/check_pipeline_memory.py [--chapters 50 100 200 400] [--chunks 20] [--jobs 4] [--package-ms 20] [--max-kb-per-chapter 8]
+"""
+import argparse
+import contextlib
+import gc
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from common import FakeSession, FictionLiveAPI
+import FictionLiveEpub
+
+def make_book_data(chapter_count, chunks_per_chapter):
+    spacing = chunks_per_chapter * 4 # FakeSession sends a chunk every 4 ms of a chapter-range request
+    return {
+        '_id': 'benchmarkStory01x',
+        'ct': 1000,
+        'cht': 1000 + chapter_count * spacing,
+        'bm': [{'title': f"Chapter {i}", 'ct': 1000 + i * spacing} for i in range(1, chapter_count)],
+    }
+
+def peak_memory(book_data, jobs, out_dir, package_seconds, read_ahead=None):
+    """Builds a streamed book and returns the peak traced memory in bytes, with read_ahead chapters per job if given."""
+    chapters_list, appendices_list, routes_list = FictionLiveAPI.get_book_map(book_data)
+    epub_path = os.path.join(out_dir, "pipeline.epub")
+    ahead, FictionLiveAPI.CHAPTERS_AHEAD_PER_JOB = FictionLiveAPI.CHAPTERS_AHEAD_PER_JOB, read_ahead or FictionLiveAPI.CHAPTERS_AHEAD_PER_JOB
+    FictionLiveAPI.session = FakeSession()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        book = FictionLiveEpub.StreamingEpubBook(f"{epub_path}.part")
+        book.set_title("Benchmark Story")
+        with contextlib.redirect_stdout(io.StringIO()):
+            FictionLiveAPI.get_book_content(chapters_list, appendices_list, routes_list, book, jobs,
+                                            progress=lambda size: time.sleep(package_seconds))
+        book.finish(epub_path)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        FictionLiveAPI.CHAPTERS_AHEAD_PER_JOB = ahead
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chapters', type=int, nargs='+', default=[50, 100, 200, 400])
+    parser.add_argument('--chunks', type=int, default=20, help="chunks per chapter")
+    parser.add_argument('--jobs', type=int, default=4)
+    parser.add_argument('--package-ms', type=float, default=20.0, help="extra milliseconds spent packaging each chapter")
+    parser.add_argument('--max-kb-per-chapter', type=float, default=8.0, help="most the peak may grow per chapter added")
+    args = parser.parse_args()
+
+    package_seconds = args.package_ms / 1000
+    peaks = []
+    unbounded_peaks = []
+    print(f"{'chapters':>8} {'pipeline MB':>12} {'unbounded MB':>13}")
+    with tempfile.TemporaryDirectory() as out_dir:
+        peak_memory(make_book_data(10, args.chunks), args.jobs, out_dir, 0) # warm up, so imports and caches aren't counted in the first book
+        for chapter_count in sorted(args.chapters):
+            book_data = make_book_data(chapter_count, args.chunks)
+            peaks.append(peak_memory(book_data, args.jobs, out_dir, package_seconds))
+            unbounded_peaks.append(peak_memory(book_data, args.jobs, out_dir, package_seconds, read_ahead=chapter_count))
+            print(f"{chapter_count:>8} {peaks[-1] / 2**20:>12.1f} {unbounded_peaks[-1] / 2**20:>13.1f}")
+    added = max(args.chapters) - min(args.chapters)
+    per_chapter = (peaks[-1] - peaks[0]) / 1024 / added
+    print(f"per chapter added: {per_chapter:.1f} KB, {(unbounded_peaks[-1] - unbounded_peaks[0]) / 1024 / added:.1f} KB unbounded")
+    print(f"{'ok' if per_chapter <= args.max_kb_per_chapter else 'FAIL'}: the peak grew {per_chapter:.1f} KB per chapter (at most {args.max_kb_per_chapter:g})")
+    if per_chapter > args.max_kb_per_chapter:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
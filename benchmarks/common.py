@@ -0,0 +1,103 @@
+"""
+Shared helpers for the benchmark scripts: a stand-in for FictionLiveAPI.session and the checked-in fixture chapters.
+"""
+import contextlib
+import glob
+import io
+import json
+import os
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(BENCHMARK_DIR, "fixtures")
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from ebooklib import epub
+import FictionLiveAPI
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.content = text.encode('utf-8')
+        self.status_code = 200
+
+    def json(self):
+        return json.loads(self.text)
+
+class FakeSession:
+    """
+    Answers chapter requests with `chunks` after sleeping for `latency` seconds. Without `chunks`, a chapter-range
+    request gets a generated prose chunk every 4 ms of its range, so coalesced requests get every chapter's chunks.
+    """
+    def __init__(self, chunks=None, latency=0.0):
+        self.chunks = chunks
+        self.latency = latency
+        self.requests = 0
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        chunks = self.chunks
+        if chunks is None and (range_match := FictionLiveAPI.FictionLiveHTTP.RANGE_URL_PATTERN.match(url)):
+            chunks = [{'nt': 'chapter', 'ct': ct, 'b': f"<p>Chunk {ct} of {url}</p>"} for ct in range(int(range_match[2]), int(range_match[3]) + 1, 4)]
+        elif chunks is None:
+            chunks = [{'nt': 'chapter', 'ct': i, 'b': f"<p>Chunk {i} of {url}</p>"} for i in range(3)]
+        return FakeResponse(json.dumps(chunks))
+
+def load_fixture_chapters():
+    """
+    Loads every fixtures/chapters/*.json file.
+
+    Returns:
+        dict: The chunk list of each fixture chapter, keyed by file name without extension.
+    """
+    chapters = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, "chapters", "*.json"))):
+        with open(path, encoding='utf-8') as fixture_file:
+            chapters[os.path.splitext(os.path.basename(path))[0]] = json.load(fixture_file)
+    return chapters
+
+def load_stage_fixtures():
+    """
+    Loads every fixtures/stages/*.json file, the larger inputs of the stage microbenchmarks.
+
+    Returns:
+        dict: The contents of each fixture, keyed by file name without extension.
+    """
+    fixtures = {}
+    for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, "stages", "*.json"))):
+        with open(path, encoding='utf-8') as fixture_file:
+            fixtures[os.path.splitext(os.path.basename(path))[0]] = json.load(fixture_file)
+    return fixtures
+
+def load_fixture_story():
+    """
+    Loads fixtures/story.json, the story metadata the fixture chapters belong to.
+
+    Returns:
+        dict: The story metadata.
+    """
+    with open(os.path.join(FIXTURE_DIR, "story.json"), encoding='utf-8') as fixture_file:
+        return json.load(fixture_file)
+
+def render_chapter(title, chunks):
+    """
+    Runs one chapter through the same download and clean-up path as FictionLiveAPI.download_and_add_to_book.
+
+    Args:
+        title (str): The chapter title.
+        chunks (list): The chunks the chapter-range request returns.
+
+    Returns:
+        bytes: The chapter XHTML body added to the book, or b"" for an empty chapter.
+    """
+    FictionLiveAPI.session = FakeSession(chunks)
+    FictionLiveAPI.achievements = FictionLiveAPI.build_achievement_index(load_fixture_story())
+    item = {'title': title, 'url': "https://fiction.live/api/anonkun/chapters/benchmarkStory01x/0/9999999999999/"}
+    book = epub.EpubBook()
+    with contextlib.redirect_stdout(io.StringIO()):
+        FictionLiveAPI.download_and_add_to_book(book, [item], "Chapter", "chap")
+    chapter = book.get_item_with_href("chap_1.xhtml")
+    return chapter.content if chapter else b""